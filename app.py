@@ -1,10 +1,26 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
+import sys
 import ipaddress
+import re
 import json
+import time
+import queue
+import subprocess
+import threading
+import hashlib
+import difflib
+import math
+from collections import Counter, OrderedDict
+from datetime import datetime
 from waitress import serve
+from maillog import (tail_lines, follow_log, LogTailer, MailLogIndex, log_pool, rotated_logs, log_may_overlap,
+                     LogQuery, search_file, trace_file, join_rotation, collect_in_order, encode_cursor, decode_cursor,
+                     normalize_message_id)
+from mailstats import MailStats
+from cidrtable import CidrTable, optimize, equivalent, format_entry
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this-in-production'
@@ -24,9 +40,95 @@ CONFIG_FILES = {
     'denied_senders': '/etc/postfix/denied_senders.conf', 
     'sender_restrictions': '/etc/postfix/sender_restrictions.conf',
     'recipient_restrictions': '/etc/postfix/recipient_restrictions.conf',
+    'rate_limits': '/etc/postfix/rate_limits.conf',
     'relay_clients': '/etc/postfix/relay_clients.cidr'
 }
 
+# Config types compiled into the policy server's snapshot (relay_clients is a
+# Postfix cidr table; the policy server reads rate_limits directly)
+POLICY_CONFIG_TYPES = ['blackhole_recipients', 'denied_senders', 'sender_restrictions', 'recipient_restrictions']
+
+# Config types whose entries are IP/CIDR networks matched first-match in file
+# order, which can be merged into fewer equivalent entries
+NETWORK_CONFIG_TYPES = ['relay_clients', 'sender_restrictions', 'recipient_restrictions']
+
+# Network lists Postfix reads itself; it skips entries with host bits set
+# outside the mask, where the policy server masks them off
+POSTFIX_NETWORK_CONFIG_TYPES = ['relay_clients']
+
+# Largest network list the optimizer runs on in a request. IPv6 entries count
+# four times, since aggregating them takes about four times as long.
+OPTIMIZE_MAX_ENTRIES = 5000
+
+# Rate limit lines: kind, match and count/window (seconds, or with a unit suffix)
+RATE_LIMIT_KINDS = ['client', 'cidr', 'sender']
+RATE_PATTERN = re.compile(r'^[1-9]\d*/(?:[1-9]\d*)?[smhd]?$')
+
+# Serializes read-modify-write cycles on the config files between request threads
+config_write_lock = threading.Lock()
+
+# Bulk edits report at most this many invalid lines
+BULK_MAX_ERRORS = 100
+
+# Config viewer pages; filtered views of each file are cached until it changes
+CONFIG_PAGE_SIZE = 100
+CONFIG_MAX_PAGE_SIZE = 1000
+CONFIG_FILTER_CACHE_SIZE = 8
+
+# Postfix mail log served by the log viewer
+MAIL_LOG_FILE = '/var/log/mail.log'
+
+# Search terms for and/or queries: "quoted phrases" or whitespace-separated words
+SEARCH_TERM_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+
+# Live log streaming: one shared tailer thread feeds every connected client.
+# Streams are closed after a while so they hand their Waitress thread back;
+# EventSource reconnects on its own and resumes from the last event id.
+STREAM_MAX_SECONDS = 300
+STREAM_KEEPALIVE_SECONDS = 15
+log_tailer = LogTailer(MAIL_LOG_FILE)
+
+# Persistent queue-ID/address index of mail.log used by the mail trace
+MAIL_LOG_INDEX_FILE = '/var/lib/postfixmanager/maillog_index.sqlite'
+mail_log_index = MailLogIndex(MAIL_LOG_FILE, MAIL_LOG_INDEX_FILE)
+
+# Rolling traffic statistics for the dashboard, snapshotted so a restart
+# doesn't have to read the last day of mail.log again
+MAIL_STATS_FILE = '/var/lib/postfixmanager/mailstats.json'
+mail_stats = MailStats(MAIL_LOG_FILE, MAIL_STATS_FILE)
+
+# Installed policy server, used to compile the rule files into its binary snapshot.
+# Compiles run in a background thread once edits have been quiet for the
+# debounce window, but no later than the maximum delay after the first one;
+# meanwhile the policy server reads the edited text files.
+POLICY_SERVER_SCRIPT = '/usr/local/bin/postfix-policy-server.py'
+POLICY_SNAPSHOT_FILE = '/var/lib/postfixmanager/policy_rules.bin'
+POLICY_COMPILE_DEBOUNCE_SECONDS = 1
+POLICY_COMPILE_MAX_DELAY_SECONDS = 5
+POLICY_COMPILE_TIMEOUT = 120
+
+# Prometheus text files written by the policy server (--metrics-dir), one per
+# process; files not rewritten for a while belong to processes that are gone.
+# The archive holds the counters of processes that have exited.
+POLICY_METRICS_DIR = '/var/lib/postfixmanager/policy-metrics'
+POLICY_METRICS_MAX_AGE = 300
+POLICY_METRICS_ARCHIVE = 'policy-server-archived.prom'
+# Most matched entries reported per rule list
+POLICY_TOP_ENTRIES = 10
+METRIC_SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)')
+METRIC_LABEL_PATTERN = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+# Postfix reloads run one at a time in a background thread. Requests made
+# while a reload is waiting join it; it starts once requests have been quiet
+# for the debounce window, but no later than the maximum delay after the
+# first one. The configuration is checked before every reload.
+RELOAD_CHECK_COMMAND = ['sudo', '-n', 'postfix', 'check']
+RELOAD_COMMAND = ['sudo', '-n', 'systemctl', 'reload', 'postfix']
+RELOAD_DEBOUNCE_SECONDS = 2
+RELOAD_MAX_DELAY_SECONDS = 10
+RELOAD_COMMAND_TIMEOUT = 60
+RELOAD_JOBS_KEPT = 100
+
 # User class for Flask-Login
 class User(UserMixin):
     def __init__(self, username, password_hash=None, must_change_password=False):
@@ -37,19 +139,33 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(username):
-    users = load_users()
-    if username in users:
-        user_data = users[username]
+    try:
+        user_data = user_store.get(username)
+    except Exception as e:
+        return None
+    if user_data is not None:
         return User(username, user_data.get('password_hash'), user_data.get('must_change_password', False))
     return None
 
-def load_users():
-    """Load users from JSON file"""
-    try:
-        if os.path.exists(USER_DATA_FILE):
-            with open(USER_DATA_FILE, 'r') as f:
-                return json.load(f)
-        else:
+class UserStore:
+    """users.json kept in memory, re-read only when the file's inode, size or mtime changes"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.signature = None
+        self.users = None
+
+    def file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def current(self):
+        # Caller holds the lock
+        signature = self.file_signature()
+        if signature is None:
             # Create initial root user with no password (must change on first login)
             initial_users = {
                 'root': {
@@ -57,49 +173,66 @@ def load_users():
                     'must_change_password': True
                 }
             }
-            save_users(initial_users)
-            return initial_users
+            self.write(initial_users)
+            return self.users if self.users is not None else initial_users
+        if self.users is None or signature != self.signature:
+            with open(self.path, 'r') as f:
+                self.users = json.load(f)
+            self.signature = signature
+        return self.users
+
+    def load(self):
+        """Copy of all users, safe for the caller to modify"""
+        with self.lock:
+            return {username: dict(data) for username, data in self.current().items()}
+
+    def get(self, username):
+        """Copy of one user's data, or None"""
+        with self.lock:
+            user_data = self.current().get(username)
+            return dict(user_data) if user_data is not None else None
+
+    def save(self, users):
+        with self.lock:
+            return self.write(users)
+
+    def write(self, users):
+        # Caller holds the lock. Write beside the file and rename it into
+        # place so a crash never leaves a truncated users.json
+        dir_path = os.path.dirname(self.path)
+        os.makedirs(dir_path, exist_ok=True)
+        tmp_file = f"{self.path}.tmp.{os.getpid()}"
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(users, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.path)
+        except OSError:
+            try:
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+            return False
+        self.users = {username: dict(data) for username, data in users.items()}
+        self.signature = self.file_signature()
+        return True
+
+user_store = UserStore(USER_DATA_FILE)
+
+def load_users():
+    """Load users from JSON file"""
+    try:
+        return user_store.load()
     except Exception as e:
         return {}
 
 def save_users(users):
     """Save users to JSON file"""
     try:
-        print(f"[DEBUG] Attempting to save users to: {USER_DATA_FILE}")
-        print(f"[DEBUG] Users data: {users}")
-        
-        # Check if directory exists
-        dir_path = os.path.dirname(USER_DATA_FILE)
-        print(f"[DEBUG] Directory path: {dir_path}")
-        print(f"[DEBUG] Directory exists: {os.path.exists(dir_path)}")
-        
-        # Create directory
-        os.makedirs(dir_path, exist_ok=True)
-        print(f"[DEBUG] Directory created/exists")
-        
-        # Check permissions
-        print(f"[DEBUG] Directory writable: {os.access(dir_path, os.W_OK)}")
-        print(f"[DEBUG] Current working directory: {os.getcwd()}")
-        print(f"[DEBUG] Process UID: {os.getuid()}")
-        
-        # Write file
-        with open(USER_DATA_FILE, 'w') as f:
-            json.dump(users, f, indent=2)
-        print(f"[DEBUG] File written successfully")
-        
-        # Verify file was created
-        if os.path.exists(USER_DATA_FILE):
-            print(f"[DEBUG] File exists after write: {USER_DATA_FILE}")
-            file_size = os.path.getsize(USER_DATA_FILE)
-            print(f"[DEBUG] File size: {file_size} bytes")
-        else:
-            print(f"[DEBUG] ERROR: File does not exist after write!")
-            
-        return True
+        return user_store.save(users)
     except Exception as e:
-        print(f"[DEBUG] Exception in save_users: {type(e).__name__}: {e}")
-        import traceback
-        print(f"[DEBUG] Traceback: {traceback.format_exc()}")
         return False
 
 def read_config_file(file_path):
@@ -112,17 +245,432 @@ def read_config_file(file_path):
     except Exception as e:
         return []
 
+def config_line_id(line, occurrence):
+    """Stable ID of the n-th copy of a line, unaffected by edits elsewhere in the file"""
+    return hashlib.blake2b(f"{occurrence}:{line}".encode('utf-8'), digest_size=8).hexdigest()
+
+class ConfigLines:
+    """One version of a config file's lines with their IDs and cached filter results"""
+    def __init__(self, lines):
+        self.lines = lines
+        self.ids = []
+        occurrences = {}
+        for line in lines:
+            occurrence = occurrences.get(line, 0)
+            occurrences[line] = occurrence + 1
+            self.ids.append(config_line_id(line, occurrence))
+        self.positions = {line_id: position for position, line_id in enumerate(self.ids)}
+        self.folded = [line.lower() for line in lines]
+        self.filters = {}
+        self.lock = threading.Lock()
+
+    def filter(self, query, match='substring'):
+        """Return the positions of the lines matching query (case-insensitive)"""
+        query = query.lower()
+        if not query:
+            return range(len(self.lines))
+        key = (query, match)
+        with self.lock:
+            positions = self.filters.get(key)
+        if positions is None:
+            if match == 'prefix':
+                positions = [i for i, line in enumerate(self.folded) if line.startswith(query)]
+            else:
+                positions = [i for i, line in enumerate(self.folded) if query in line]
+            with self.lock:
+                if len(self.filters) >= CONFIG_FILTER_CACHE_SIZE:
+                    self.filters.pop(next(iter(self.filters)))
+                self.filters[key] = positions
+        return positions
+
+class ConfigFileIndex:
+    """Lazily rebuilt ConfigLines of a file, keyed by its inode, size and mtime"""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.signature = None
+        self.current = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        try:
+            st = os.stat(self.file_path)
+            signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            signature = None
+        with self.lock:
+            if self.current is None or signature != self.signature:
+                self.current = ConfigLines(read_config_file(self.file_path))
+                self.signature = signature
+            return self.current
+
+config_indexes = {}
+
+def config_lines(config_type):
+    """Current ConfigLines of a config type"""
+    index = config_indexes.get(config_type)
+    if index is None or index.file_path != CONFIG_FILES[config_type]:
+        index = config_indexes[config_type] = ConfigFileIndex(CONFIG_FILES[config_type])
+    return index.get()
+
+def write_in_place(file_path, data):
+    """Overwrite a file through its existing inode, keeping its owner and mode"""
+    with open(file_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
 def write_config_file(file_path, lines):
     """Write lines to configuration file"""
     try:
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'w') as f:
-            for line in lines:
-                f.write(line + '\n')
+        directory = os.path.dirname(file_path)
+        os.makedirs(directory, exist_ok=True)
+        data = ''.join(line + '\n' for line in lines)
+        tmp_file = os.path.join(directory, f".{os.path.basename(file_path)}.tmp.{os.getpid()}.{threading.get_ident()}")
+        try:
+            f = open(tmp_file, 'w')
+        except PermissionError:
+            # Without write access to the directory only in-place writes are
+            # possible, and readers can see the file truncated or half written
+            app.logger.warning('Cannot create files in %s; rewriting %s in place, which is not atomic. '
+                               'Make the directory writable by the PostfixManager user to write configuration '
+                               'files atomically', directory, file_path)
+            write_in_place(file_path, data)
+            return True
+
+        # Write a complete copy and rename it over the file, so the policy
+        # server and Postfix never read a truncated or half-written file
+        try:
+            with f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                st = os.stat(file_path)
+            except FileNotFoundError:
+                os.chmod(tmp_file, 0o644)
+            else:
+                os.chmod(tmp_file, st.st_mode & 0o7777)
+                try:
+                    os.chown(tmp_file, st.st_uid, st.st_gid)
+                except PermissionError:
+                    # The copy would lose the file's group (postfix), which
+                    # the policy server may need to read it
+                    os.unlink(tmp_file)
+                    app.logger.warning('Cannot give a new copy of %s its owner %d:%d; rewriting it in place, '
+                                       'which is not atomic', file_path, st.st_uid, st.st_gid)
+                    write_in_place(file_path, data)
+                    return True
+            os.replace(tmp_file, file_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+            raise
+
+        # Persist the rename itself
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
         return True
     except Exception as e:
+        app.logger.error('Failed to write %s: %s', file_path, e)
         return False
 
+def compile_policy_rules():
+    """Rebuild the policy server's compiled rule snapshot; returns (success, error output)"""
+    # A stale or missing snapshot is ignored by the policy server, which then
+    # falls back to reading the text files, so failures here are not fatal
+    if not os.path.exists(POLICY_SERVER_SCRIPT):
+        return False, f'{POLICY_SERVER_SCRIPT} is not installed'
+    result = subprocess.run([sys.executable, POLICY_SERVER_SCRIPT, 'compile', '--snapshot', POLICY_SNAPSHOT_FILE],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                            timeout=POLICY_COMPILE_TIMEOUT)
+    return result.returncode == 0, result.stdout
+
+def read_policy_metrics(directory, max_age):
+    """Sum the samples of the live policy server metrics files and the archive over their pid label"""
+    samples = {}
+    processes = 0
+    now = time.time()
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return samples, processes
+    for name in names:
+        if not name.endswith('.prom'):
+            continue
+        path = os.path.join(directory, name)
+        archive = name == POLICY_METRICS_ARCHIVE
+        try:
+            if not archive and now - os.stat(path).st_mtime > max_age:
+                continue
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            continue
+        if not archive:
+            processes += 1
+        for line in lines:
+            match = METRIC_SAMPLE_PATTERN.match(line)
+            if not match:
+                continue
+            metric, labels, value = match.groups()
+            labels = tuple(sorted((key, val) for key, val in METRIC_LABEL_PATTERN.findall(labels or '') if key != 'pid'))
+            key = (metric, labels)
+            if metric.endswith('_timestamp_seconds') or metric.endswith('_start_time_seconds'):
+                samples[key] = max(samples.get(key, 0), float(value))
+            else:
+                samples[key] = samples.get(key, 0) + float(value)
+    return samples, processes
+
+def histogram_summary(samples, metric, **labels):
+    """Count, mean and bucket-interpolated percentiles (seconds) of a summed Prometheus histogram"""
+    wanted = set(labels.items())
+    buckets = sorted((float(dict(key[1])['le']), value) for key, value in samples.items()
+                     if key[0] == f'{metric}_bucket' and wanted <= set(key[1]))
+    count = sum(value for key, value in samples.items() if key[0] == f'{metric}_count' and wanted <= set(key[1]))
+    total = sum(value for key, value in samples.items() if key[0] == f'{metric}_sum' and wanted <= set(key[1]))
+
+    # Buckets of several label sets (e.g. load sources) are summed per bound
+    cumulative = {}
+    for bound, value in buckets:
+        cumulative[bound] = cumulative.get(bound, 0) + value
+    bounds = sorted(cumulative.items())
+
+    def percentile(fraction):
+        rank = fraction * count
+        lower_bound, lower_count = 0.0, 0
+        for bound, seen in bounds:
+            if seen >= rank:
+                if bound == float('inf'):
+                    return lower_bound
+                # Assume observations are spread evenly within the bucket
+                share = (rank - lower_count) / (seen - lower_count) if seen > lower_count else 1
+                return lower_bound + (bound - lower_bound) * share
+            lower_bound, lower_count = bound, seen
+        return lower_bound
+
+    if not count:
+        return {'count': 0, 'mean': None, 'p50': None, 'p90': None, 'p99': None}
+    return {'count': int(count), 'mean': total / count,
+            'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99)}
+
+def validate_config_line(config_type, line):
+    """Return why a line is invalid for a config type, or None if it is valid"""
+    if config_type in ['blackhole_recipients', 'denied_senders']:
+        if not validate_address_pattern(line):
+            return 'Invalid format - use email@domain.com, @domain.com or @.domain.com'
+    elif config_type == 'relay_clients':
+        ip_part = line.split()[0]
+        if not validate_ip_cidr(ip_part):
+            return 'Invalid IP/CIDR format'
+    elif config_type in ['sender_restrictions', 'recipient_restrictions']:
+        parts = line.split()
+        if len(parts) < 2:
+            return 'Format: IP/CIDR email1 email2...'
+        if not validate_ip_cidr(parts[0]):
+            return 'Invalid IP/CIDR format'
+    elif config_type == 'rate_limits':
+        parts = line.split()
+        if len(parts) != 3 or parts[0] not in RATE_LIMIT_KINDS:
+            return 'Format: client|cidr IP/CIDR count/window, or sender address count/window'
+        kind, match, rate = parts
+        if kind == 'sender' and match != '*' and not validate_address_pattern(match):
+            return 'Invalid sender - use email@domain.com, @domain.com, @.domain.com or *'
+        if kind != 'sender' and not validate_ip_cidr(match):
+            return 'Invalid IP/CIDR format'
+        if not RATE_PATTERN.match(rate):
+            return 'Invalid rate - use count/window, e.g. 100/60, 100/60s or 500/1h'
+    return None
+
+def config_version(lines):
+    """Token identifying one version of a config file's lines"""
+    return hashlib.blake2b('\n'.join(lines).encode('utf-8'), digest_size=8).hexdigest()
+
+def network_table(config_type, lines):
+    """Parsed network list, read the way Postfix or the policy server reads this config type"""
+    return CidrTable(lines, strict=config_type in POSTFIX_NETWORK_CONFIG_TYPES)
+
+def optimize_error(table):
+    """Error response if a parsed network list can't be optimized, or None"""
+    if table.errors:
+        return jsonify({'error': 'Some lines are not valid network entries', 'errors': table.errors[:BULK_MAX_ERRORS]}), 400
+    size = sum(4 if network.version == 6 else 1 for network, value in table.entries)
+    if size > OPTIMIZE_MAX_ENTRIES:
+        return jsonify({'error': f'Too many entries to optimize here ({len(table.entries)}; '
+                                 f'the limit is {OPTIMIZE_MAX_ENTRIES}, IPv6 entries counting four times)'}), 413
+    return None
+
+def optimize_config_lines(table):
+    """Optimized lines of a parsed network list; comments move to the top"""
+    entries = optimize(table.entries)
+    if len(entries) >= len(table.entries):
+        return table.lines
+    # Never write a table that decides any address differently
+    if not equivalent(table.entries, entries):
+        raise RuntimeError('Optimized entries are not equivalent to the file; nothing was changed')
+    return table.comments + [format_entry(network, value) for network, value in entries]
+
+def optimize_summary(table, lines, optimized, file_path):
+    """What optimizing a network list changes, with a unified diff"""
+    before, after = Counter(lines), Counter(optimized)
+    return {
+        'entries_before': len(table.entries),
+        'entries_after': len(optimized) - len(table.comments),
+        'removed': list((before - after).elements()),
+        'added': list((after - before).elements()),
+        'changed': optimized != lines,
+        'diff': '\n'.join(difflib.unified_diff(lines, optimized, file_path, f'{file_path} (optimized)', lineterm='')),
+    }
+
+def covered_lines(config_type, lines, new_lines):
+    """New network list lines whose network an existing entry already contains, with the entry that matches first"""
+    table = network_table(config_type, lines)
+    index = table.covering()
+    covered = []
+    new_table = network_table(config_type, new_lines)
+    for line, (network, value) in zip(new_table.entry_lines, new_table.entries):
+        order = index.find(network)
+        if order is not None:
+            covered.append({
+                'content': line,
+                'covered_by': table.entry_lines[order],
+                # Same value: redundant; otherwise the new line never matches
+                'redundant': table.entries[order][1] == value,
+            })
+    return covered
+
+def covered_warning(item):
+    """Message for a line that an existing entry already covers"""
+    if item['redundant']:
+        return f"Already covered by '{item['covered_by']}'; the new entry is redundant"
+    return f"Already covered by '{item['covered_by']}', which matches first; the new entry will never match"
+
+class ReloadCoordinator:
+    """Background Postfix reloads: at most one running and one pending job, which new requests join"""
+    
+    START_STATUS = 'checking'
+    
+    def __init__(self, debounce, max_delay, keep=RELOAD_JOBS_KEPT):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self.pending = None
+        self.next_id = 1
+        self.condition = threading.Condition()
+        self.thread = None
+    
+    def request(self):
+        """Queue a reload, or join the one still waiting to start; returns the job"""
+        now = time.time()
+        with self.condition:
+            job = self.pending
+            if job is None:
+                job = {'id': self.next_id, 'status': 'pending', 'requests': 0, 'requested': now,
+                       'started': None, 'finished': None, 'error': None, 'output': ''}
+                self.next_id += 1
+                self.pending = job
+                self.jobs[job['id']] = job
+                while len(self.jobs) > self.keep:
+                    self.jobs.popitem(last=False)
+            job['requests'] += 1
+            job['run_at'] = min(now + self.debounce, job['requested'] + self.max_delay)
+            # Started on first use so importing the app has no side effects
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            return self.describe(job)
+    
+    def get(self, job_id):
+        """A job's current state, or None once it has been forgotten"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return self.describe(job) if job else None
+    
+    def describe(self, job):
+        def timestamp(value):
+            return datetime.fromtimestamp(value).isoformat(timespec='seconds') if value else None
+        return {
+            'id': job['id'],
+            'status': job['status'],
+            'requests': job['requests'],
+            'requested': timestamp(job['requested']),
+            'scheduled': timestamp(job['run_at']) if job['status'] == 'pending' else None,
+            'started': timestamp(job['started']),
+            'finished': timestamp(job['finished']),
+            'error': job['error'],
+            'output': job['output'],
+        }
+    
+    def set_status(self, job, status, **fields):
+        with self.condition:
+            job['status'] = status
+            job.update(fields)
+    
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    job = self.pending
+                    if job is None:
+                        self.condition.wait()
+                        continue
+                    delay = job['run_at'] - time.time()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                # Requests from now on wait for the next job
+                self.pending = None
+                job['status'] = self.START_STATUS
+                job['started'] = time.time()
+            try:
+                self.execute(job)
+            except Exception as e:
+                self.set_status(job, 'failed', error=str(e), finished=time.time())
+    
+    def execute(self, job):
+        check = subprocess.run(RELOAD_CHECK_COMMAND, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               text=True, timeout=RELOAD_COMMAND_TIMEOUT)
+        if check.returncode != 0:
+            self.set_status(job, 'failed', error='postfix check failed; Postfix was not reloaded',
+                            output=check.stdout, finished=time.time())
+            return
+        self.set_status(job, 'reloading', output=check.stdout)
+        reload = subprocess.run(RELOAD_COMMAND, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, timeout=RELOAD_COMMAND_TIMEOUT)
+        if reload.returncode != 0:
+            self.set_status(job, 'failed', error='Failed to reload Postfix',
+                            output=check.stdout + reload.stdout, finished=time.time())
+            return
+        self.set_status(job, 'done', output=check.stdout + reload.stdout, finished=time.time())
+
+reload_coordinator = ReloadCoordinator(RELOAD_DEBOUNCE_SECONDS, RELOAD_MAX_DELAY_SECONDS)
+
+class PolicyCompileCoordinator(ReloadCoordinator):
+    """Background policy snapshot compiles, debounced and joined like reloads"""
+    
+    START_STATUS = 'compiling'
+    
+    def execute(self, job):
+        try:
+            success, output = compile_policy_rules()
+        except (OSError, subprocess.SubprocessError) as e:
+            success, output = False, str(e)
+        if not success:
+            app.logger.error('Policy snapshot compile failed: %s', output.strip())
+            self.set_status(job, 'failed', error='Failed to compile the policy snapshot; '
+                            'the policy server reads the rule files directly until a compile succeeds',
+                            output=output, finished=time.time())
+            return
+        self.set_status(job, 'done', output=output, finished=time.time())
+
+policy_compiler = PolicyCompileCoordinator(POLICY_COMPILE_DEBOUNCE_SECONDS, POLICY_COMPILE_MAX_DELAY_SECONDS)
+
 def validate_ip_cidr(ip_string):
     """Validate IP/CIDR notation"""
     try:
@@ -135,6 +683,72 @@ def validate_email(email):
     """Basic email validation"""
     return '@' in email and '.' in email.split('@')[1]
 
+def validate_address_pattern(pattern):
+    """Validate an email address, @domain or @.domain (any subdomain) entry"""
+    if pattern.startswith('@'):
+        domain = pattern[2:] if pattern.startswith('@.') else pattern[1:]
+        return '@' not in domain and '.' in domain.strip('.') and '..' not in domain
+    return validate_email(pattern)
+
+def parse_time_param(name):
+    """Parse an ISO 8601 date/time (local time unless it has an offset) or epoch query parameter"""
+    value = request.args.get(name, '').strip()
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        raise ValueError(f"Invalid {name} time: {value}")
+
+def parse_hours_back(default):
+    """The hours_back parameter of a log request; raises ValueError unless it is a non-negative number"""
+    value = request.args.get('hours_back', default)
+    try:
+        hours = float(value)
+    except ValueError:
+        raise ValueError(f'hours_back must be a number of hours, not {value!r}')
+    if not math.isfinite(hours) or hours < 0:
+        raise ValueError('hours_back must be a non-negative number of hours')
+    return int(hours) if hours.is_integer() else hours
+
+def parse_time_window(hours_back=0):
+    """Return the (since, until) epoch window of a log request; hours_back applies when since is not given"""
+    since = parse_time_param('since')
+    until = parse_time_param('until')
+    if since is None and hours_back > 0:
+        since = time.time() - hours_back * 3600
+    return since, until
+
+def rotated_log_files(log_file, since):
+    """Return the rotated logs a request should also scan (rotated=true), oldest first"""
+    if request.args.get('rotated', 'false').lower() != 'true':
+        return []
+    return [path for path in rotated_logs(log_file) if log_may_overlap(path, since)]
+
+def wants_ndjson():
+    """True when a log API request asks for a streamed NDJSON response (format=ndjson)"""
+    return request.args.get('format', 'json').lower() == 'ndjson'
+
+def ndjson_response(records):
+    """Stream an iterable of JSON-serializable records, one per line"""
+    def generate():
+        try:
+            for record in records:
+                yield json.dumps(record) + '\n'
+        except FileNotFoundError:
+            yield json.dumps({'error': 'Log file not found'}) + '\n'
+        except PermissionError:
+            yield json.dumps({'error': 'Permission denied reading log file'}) + '\n'
+        except Exception as e:
+            yield json.dumps({'error': str(e)}) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Login page"""
@@ -212,26 +826,20 @@ def change_password():
                 'password_hash': generate_password_hash(new_password),
                 'must_change_password': False
             }
-            print(f"[DEBUG] About to save users for first-time password set")
             if save_users(users):
-                print(f"[DEBUG] Password set successfully for {current_user.username}")
                 flash('Password set successfully', 'success')
                 return redirect(url_for('index'))
             else:
-                print(f"[DEBUG] Failed to save password for {current_user.username}")
                 flash('Failed to save password', 'error')
         else:
             # Verify current password for existing users
             if check_password_hash(user_data['password_hash'], current_password):
                 users[current_user.username]['password_hash'] = generate_password_hash(new_password)
                 users[current_user.username]['must_change_password'] = False
-                print(f"[DEBUG] About to save users for password change")
                 if save_users(users):
-                    print(f"[DEBUG] Password changed successfully for {current_user.username}")
                     flash('Password changed successfully', 'success')
                     return redirect(url_for('index'))
                 else:
-                    print(f"[DEBUG] Failed to save password change for {current_user.username}")
                     flash('Failed to save password', 'error')
             else:
                 flash('Current password is incorrect', 'error')
@@ -255,13 +863,43 @@ def view_config(config_type):
         flash('Invalid configuration type', 'error')
         return redirect(url_for('index'))
     
+    # Entries are fetched a page at a time from /api/config/<config_type>/lines
     file_path = CONFIG_FILES[config_type]
-    lines = read_config_file(file_path)
-    
     return render_template('config.html', 
                          config_type=config_type, 
-                         lines=lines,
-                         file_path=file_path)
+                         file_path=file_path,
+                         page_size=CONFIG_PAGE_SIZE)
+
+@app.route('/api/config/<config_type>/lines')
+@login_required
+def get_config_lines(config_type):
+    """Page through a configuration file, optionally filtered by a prefix or substring"""
+    if config_type not in CONFIG_FILES:
+        return jsonify({'error': 'Invalid configuration type'}), 400
+    try:
+        offset = max(0, int(request.args.get('offset', '0')))
+        limit = min(max(1, int(request.args.get('limit', str(CONFIG_PAGE_SIZE)))), CONFIG_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    query = request.args.get('q', '').strip()
+    match = request.args.get('match', 'substring')
+    if match not in ('substring', 'prefix'):
+        return jsonify({'error': 'match must be substring or prefix'}), 400
+    
+    try:
+        entries = config_lines(config_type)
+        positions = entries.filter(query, match)
+        page = positions[offset:offset + limit]
+        return jsonify({
+            'success': True,
+            'lines': [{'id': entries.ids[i], 'line_number': i + 1, 'content': entries.lines[i]} for i in page],
+            'total': len(positions),
+            'file_total': len(entries.lines),
+            'offset': offset,
+            'limit': limit,
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/config/<config_type>/add', methods=['POST'])
 @login_required
@@ -275,26 +913,24 @@ def add_config_line(config_type):
         return jsonify({'error': 'Line cannot be empty'}), 400
     
     # Validate based on config type
-    if config_type in ['blackhole_recipients', 'denied_senders']:
-        if not validate_email(new_line):
-            return jsonify({'error': 'Invalid email format'}), 400
-    elif config_type == 'relay_clients':
-        ip_part = new_line.split()[0]
-        if not validate_ip_cidr(ip_part):
-            return jsonify({'error': 'Invalid IP/CIDR format'}), 400
-    elif config_type in ['sender_restrictions', 'recipient_restrictions']:
-        parts = new_line.split()
-        if len(parts) < 2:
-            return jsonify({'error': 'Format: IP/CIDR email1 email2...'}), 400
-        if not validate_ip_cidr(parts[0]):
-            return jsonify({'error': 'Invalid IP/CIDR format'}), 400
+    error = validate_config_line(config_type, new_line)
+    if error:
+        return jsonify({'error': error}), 400
     
     file_path = CONFIG_FILES[config_type]
-    lines = read_config_file(file_path)
-    lines.append(new_line)
+    with config_write_lock:
+        lines = read_config_file(file_path)
+        # Flag (but still add) networks an existing entry already decides
+        covered = covered_lines(config_type, lines, [new_line]) if config_type in NETWORK_CONFIG_TYPES else []
+        lines.append(new_line)
+        written = write_config_file(file_path, lines)
     
-    if write_config_file(file_path, lines):
-        return jsonify({'success': True})
+    if written:
+        compile_job = policy_compiler.request() if config_type in POLICY_CONFIG_TYPES else None
+        if covered:
+            return jsonify({'success': True, 'warning': covered_warning(covered[0]), 'covered': covered,
+                            'compile_job': compile_job})
+        return jsonify({'success': True, 'compile_job': compile_job})
     else:
         return jsonify({'error': 'Failed to write file'}), 500
 
@@ -305,32 +941,234 @@ def delete_config_line(config_type):
     if config_type not in CONFIG_FILES:
         return jsonify({'error': 'Invalid configuration type'}), 400
     
-    line_index = int(request.form.get('index', -1))
+    # Entries are addressed by their stable ID; the positional index is still
+    # accepted from older clients
+    line_id = request.form.get('id', '').strip()
     file_path = CONFIG_FILES[config_type]
-    lines = read_config_file(file_path)
-    
-    if 0 <= line_index < len(lines):
+    with config_write_lock:
+        if line_id:
+            entries = config_lines(config_type)
+            line_index = entries.positions.get(line_id)
+            if line_index is None:
+                return jsonify({'error': 'Entry not found - it may have been changed or deleted'}), 404
+            lines = list(entries.lines)
+        else:
+            line_index = int(request.form.get('index', -1))
+            lines = read_config_file(file_path)
+            if not 0 <= line_index < len(lines):
+                return jsonify({'error': 'Invalid line index'}), 400
         lines.pop(line_index)
-        if write_config_file(file_path, lines):
-            return jsonify({'success': True})
+        written = write_config_file(file_path, lines)
+    
+    if written:
+        compile_job = policy_compiler.request() if config_type in POLICY_CONFIG_TYPES else None
+        return jsonify({'success': True, 'compile_job': compile_job})
+    else:
+        return jsonify({'error': 'Failed to write file'}), 500
+
+@app.route('/config/<config_type>/bulk', methods=['POST'])
+@login_required
+def bulk_edit_config(config_type):
+    """Apply many adds and removes, or replace the whole file, in one validated atomic write"""
+    if config_type not in CONFIG_FILES:
+        return jsonify({'error': 'Invalid configuration type'}), 400
+    
+    # JSON {"add": [...], "remove": [...]} or {"lines": [...]} to replace the
+    # file; or a form with a `mode` (add, remove or replace) and the lines
+    # in a `lines` field or an uploaded `file`
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        if not isinstance(payload, dict):
+            return jsonify({'error': 'Expected a JSON object'}), 400
+        replace = 'lines' in payload
+        adds = payload.get('lines' if replace else 'add') or []
+        removes = [] if replace else payload.get('remove') or []
+        reload_requested = bool(payload.get('reload', False))
+        if not isinstance(adds, list) or not isinstance(removes, list) \
+                or not all(isinstance(line, str) for line in adds + removes):
+            return jsonify({'error': 'add, remove and lines must be lists of strings'}), 400
+    else:
+        mode = request.form.get('mode', 'add')
+        if mode not in ('add', 'remove', 'replace'):
+            return jsonify({'error': 'mode must be add, remove or replace'}), 400
+        upload = request.files.get('file')
+        if upload:
+            text = upload.read().decode('utf-8', 'replace')
         else:
+            text = request.form.get('lines', '')
+        submitted = text.splitlines()
+        replace = mode == 'replace'
+        adds = submitted if mode != 'remove' else []
+        removes = submitted if mode == 'remove' else []
+        reload_requested = request.form.get('reload', 'false').lower() == 'true'
+    
+    # Validate everything before touching the file; comments pass through
+    adds = [line.strip() for line in adds if line.strip()]
+    removes = {line.strip() for line in removes if line.strip()}
+    errors = []
+    for number, line in enumerate(adds, 1):
+        if line.startswith('#'):
+            continue
+        error = validate_config_line(config_type, line)
+        if error:
+            errors.append({'line': number, 'content': line, 'error': error})
+            if len(errors) >= BULK_MAX_ERRORS:
+                break
+    if errors:
+        return jsonify({'error': 'Invalid lines, nothing was changed', 'errors': errors}), 400
+    
+    file_path = CONFIG_FILES[config_type]
+    with config_write_lock:
+        existing = read_config_file(file_path)
+        
+        # Removals drop every copy of the line; additions skip lines that are
+        # already in the file or earlier in the batch
+        kept = [] if replace else [line for line in existing if line not in removes]
+        missing = len(removes - set(existing))
+        covered = covered_lines(config_type, kept, adds) if config_type in NETWORK_CONFIG_TYPES else []
+        seen = set(kept)
+        added = 0
+        for line in adds:
+            if line not in seen:
+                seen.add(line)
+                kept.append(line)
+                added += 1
+        duplicates = len(adds) - added
+        removed = sum(1 for line in existing if line not in seen)
+        
+        changed = kept != existing
+        if changed and not write_config_file(file_path, kept):
             return jsonify({'error': 'Failed to write file'}), 500
+    
+    reload_job = None
+    compile_job = None
+    if changed:
+        if config_type in POLICY_CONFIG_TYPES:
+            compile_job = policy_compiler.request()
+        elif reload_requested:
+            # Postfix reads relay_clients.cidr itself; one reload for the whole batch
+            reload_job = reload_coordinator.request()
+    
+    return jsonify({
+        'success': True,
+        'added': added,
+        'removed': removed,
+        'duplicates': duplicates,
+        'not_found': missing,
+        'total': len(kept),
+        'changed': changed,
+        'reload_job': reload_job,
+        'compile_job': compile_job,
+        # Added networks that entries already in the file cover
+        'covered': covered[:BULK_MAX_ERRORS],
+        'covered_total': len(covered),
+    })
+
+@app.route('/api/config/<config_type>/optimize')
+@login_required
+def preview_optimize_config(config_type):
+    """Preview merging a network list into fewer entries that match every address the same way"""
+    if config_type not in NETWORK_CONFIG_TYPES:
+        return jsonify({'error': 'Only network lists can be optimized'}), 400
+    
+    try:
+        file_path = CONFIG_FILES[config_type]
+        lines = read_config_file(file_path)
+        table = network_table(config_type, lines)
+        error = optimize_error(table)
+        if error:
+            return error
+        optimized = optimize_config_lines(table)
+        return jsonify({'success': True, 'version': config_version(lines),
+                        **optimize_summary(table, lines, optimized, file_path)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/config/<config_type>/optimize', methods=['POST'])
+@login_required
+def optimize_config(config_type):
+    """Rewrite a network list with the optimized entries shown by the preview"""
+    if config_type not in NETWORK_CONFIG_TYPES:
+        return jsonify({'error': 'Only network lists can be optimized'}), 400
+    
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        if not isinstance(payload, dict):
+            return jsonify({'error': 'Expected a JSON object'}), 400
     else:
-        return jsonify({'error': 'Invalid line index'}), 400
+        payload = request.form
+    version = str(payload.get('version', '')).strip()
+    reload_requested = str(payload.get('reload', 'false')).lower() == 'true'
+    
+    file_path = CONFIG_FILES[config_type]
+    try:
+        lines = read_config_file(file_path)
+        # The preview's version guards against applying it to a file that
+        # has been edited since
+        if version and version != config_version(lines):
+            return jsonify({'error': 'The file has changed since the preview; preview it again'}), 409
+        table = network_table(config_type, lines)
+        error = optimize_error(table)
+        if error:
+            return error
+        # Optimized without the lock so edits aren't held up meanwhile; the
+        # result is only written over the lines it was computed from
+        optimized = optimize_config_lines(table)
+        summary = optimize_summary(table, lines, optimized, file_path)
+        with config_write_lock:
+            if read_config_file(file_path) != lines:
+                return jsonify({'error': 'The file changed while it was being optimized; preview it again'}), 409
+            if summary['changed'] and not write_config_file(file_path, optimized):
+                return jsonify({'error': 'Failed to write file'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    reload_job = None
+    compile_job = None
+    if summary['changed']:
+        if config_type in POLICY_CONFIG_TYPES:
+            compile_job = policy_compiler.request()
+        elif reload_requested:
+            reload_job = reload_coordinator.request()
+    
+    return jsonify({
+        'success': True,
+        'entries_before': summary['entries_before'],
+        'entries_after': summary['entries_after'],
+        'changed': summary['changed'],
+        'reload_job': reload_job,
+        'compile_job': compile_job,
+    })
 
 @app.route('/reload_postfix', methods=['POST'])
 @login_required
 def reload_postfix():
-    """Reload Postfix configuration"""
+    """Queue a Postfix reload (joining one that is still waiting) and return its job"""
     try:
-        result = os.system('sudo systemctl reload postfix')
-        if result == 0:
-            return jsonify({'success': True, 'message': 'Postfix reloaded successfully'})
-        else:
-            return jsonify({'error': 'Failed to reload Postfix'}), 500
+        job = reload_coordinator.request()
+        return jsonify({'success': True, 'message': 'Postfix reload queued', 'job': job,
+                        'status_url': url_for('get_reload_job', job_id=job['id'])}), 202
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/reload/<int:job_id>')
+@login_required
+def get_reload_job(job_id):
+    """Status of a Postfix reload job"""
+    job = reload_coordinator.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Reload job not found'}), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/policy/compile/<int:job_id>')
+@login_required
+def get_policy_compile_job(job_id):
+    """Status of a policy snapshot compile job"""
+    job = policy_compiler.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Compile job not found'}), 404
+    return jsonify({'success': True, 'job': job})
+
 @app.route('/logs')
 @login_required
 def logs():
@@ -345,15 +1183,11 @@ def logs():
 def get_logs():
     """Get mail.log file contents"""
     try:
-        log_file = '/var/log/mail.log'
+        log_file = MAIL_LOG_FILE
         lines = int(request.args.get('lines', '50'))
         
-        # Read log file directly
-        with open(log_file, 'r') as f:
-            # Read all lines and get the last N lines
-            all_lines = f.readlines()
-            last_lines = all_lines[-lines:] if len(all_lines) > lines else all_lines
-            content = ''.join(last_lines)
+        # Read only the tail of the file
+        content = tail_lines(log_file, lines)
         
         return jsonify({
             'success': True, 
@@ -371,21 +1205,21 @@ def get_logs():
 @app.route('/api/logs/follow')
 @login_required
 def follow_logs():
-    """Get latest mail.log file contents (for following)"""
+    """Get mail.log lines appended since the client's cursor (for following)"""
     try:
-        log_file = '/var/log/mail.log'
+        log_file = MAIL_LOG_FILE
         lines = int(request.args.get('lines', '20'))
+        cursor = request.args.get('cursor', '')
         
-        # Read log file directly (same as get_logs for simplicity)
-        with open(log_file, 'r') as f:
-            # Read all lines and get the last N lines
-            all_lines = f.readlines()
-            last_lines = all_lines[-lines:] if len(all_lines) > lines else all_lines
-            content = ''.join(last_lines)
+        # Without a cursor this returns the last N lines, like get_logs;
+        # with one, only what was appended since (reset=False)
+        content, cursor, reset = follow_log(log_file, cursor, lines)
         
         return jsonify({
             'success': True, 
             'content': content,
+            'cursor': cursor,
+            'reset': reset,
             'file': log_file
         })
             
@@ -396,50 +1230,183 @@ def follow_logs():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/logs/stream')
+@login_required
+def stream_logs():
+    """Stream new mail.log lines as Server-Sent Events"""
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id', ''))
+    last_sequence = int(last_event_id) if last_event_id.isdigit() else None
+    
+    def generate():
+        # Subscribed only once the response is being sent, so a stream that is
+        # never started (or fails before) does not leave a subscriber behind
+        subscription = log_tailer.subscribe(last_sequence)
+        try:
+            deadline = time.monotonic() + STREAM_MAX_SECONDS
+            reported_drops = 0
+            yield 'retry: 2000\n\n'
+            while time.monotonic() < deadline:
+                try:
+                    batch = subscription.get_batch(STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # Comment line; also lets Waitress notice a closed client
+                    yield ': keepalive\n\n'
+                    continue
+                
+                if subscription.dropped != reported_drops:
+                    yield f'event: dropped\ndata: {subscription.dropped - reported_drops}\n\n'
+                    reported_drops = subscription.dropped
+                
+                # A reset tells the client to clear what it shows before the
+                # lines that follow, as /api/logs/follow does with reset=true
+                lines = []
+                for sequence, line in batch + [(None, None)]:
+                    if line is None and lines:
+                        yield f'id: {lines[-1][0]}\n' + ''.join(f'data: {text}\n' for _, text in lines) + '\n'
+                        lines = []
+                    if line is None and sequence is not None:
+                        yield f'id: {sequence}\nevent: reset\ndata: \n\n'
+                    elif line is not None:
+                        lines.append((sequence, line))
+        finally:
+            log_tailer.unsubscribe(subscription)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/logs/search')
 @login_required
 def search_logs():
-    """Search mail.log file for specific terms"""
+    """Search mail.log (and optionally its rotations) for text or regex terms, a page at a time"""
     try:
-        log_file = '/var/log/mail.log'
+        log_file = MAIL_LOG_FILE
         search_term = request.args.get('q', '').strip()
-        max_results = int(request.args.get('max_results', '100'))
+        try:
+            max_results = int(request.args.get('max_results', '100'))
+        except ValueError:
+            return jsonify({'error': 'max_results must be an integer'}), 400
         case_sensitive = request.args.get('case_sensitive', 'false').lower() == 'true'
+        regex = request.args.get('regex', 'false').lower() == 'true'
+        operator = request.args.get('operator', 'phrase').lower()
+        count = request.args.get('count', 'false').lower() == 'true'
         
         if not search_term:
             return jsonify({'error': 'Search term is required'}), 400
+        if operator not in ('phrase', 'and', 'or'):
+            return jsonify({'error': 'Operator must be phrase, and or or'}), 400
+        if max_results < 1:
+            return jsonify({'error': 'max_results must be at least 1'}), 400
         
-        matching_lines = []
-        line_number = 0
+        # A phrase is one term; and/or split the query into words and "quoted phrases"
+        if operator == 'phrase':
+            terms = [search_term]
+        else:
+            terms = [quoted or word for quoted, word in SEARCH_TERM_PATTERN.findall(search_term) if quoted or word]
+            if not terms:
+                return jsonify({'error': 'Search term is required'}), 400
+        try:
+            query = LogQuery(terms, regex, case_sensitive, operator == 'and')
+        except re.error as e:
+            return jsonify({'error': f'Invalid regular expression: {e}'}), 400
         
-        # Read log file and search for matching lines
-        with open(log_file, 'r') as f:
-            for line in f:
-                line_number += 1
-                
-                # Perform search (case sensitive or insensitive)
-                search_line = line if case_sensitive else line.lower()
-                search_query = search_term if case_sensitive else search_term.lower()
-                
-                if search_query in search_line:
-                    matching_lines.append({
-                        'line_number': line_number,
-                        'content': line.rstrip('\n')
-                    })
-                    
-                    # Limit results to prevent huge responses
-                    if len(matching_lines) >= max_results:
-                        break
+        try:
+            since, until = parse_time_window(parse_hours_back('0'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        return jsonify({
-            'success': True,
+        files = rotated_log_files(log_file, since) + [log_file]
+        
+        # A cursor continues after the last match of the previous page. It
+        # names its file by inode, so it survives mail.log being renamed
+        # to mail.log.1 in between
+        resume = None
+        counted_before = []
+        cursor_token = request.args.get('cursor', '')
+        if cursor_token:
+            cursor = decode_cursor(cursor_token)
+            inodes = []
+            for path in files:
+                try:
+                    inodes.append(os.stat(path).st_ino)
+                except OSError:
+                    inodes.append(None)
+            if not cursor or not {'ino', 'offset', 'line'} <= cursor.keys() or cursor['ino'] not in inodes:
+                return jsonify({'error': 'Search cursor has expired; run the search again'}), 400
+            position = inodes.index(cursor['ino'])
+            # Matches on the earlier pages are counted separately, so
+            # total_matches covers the whole search and not just what is left
+            if count:
+                counted_before = [log_pool().submit(search_file, path, query, 0, since, until, count=True,
+                                                    stop=cursor['offset'] if i == position else None)
+                                  for i, path in enumerate(files[:position + 1])]
+            files = files[position:]
+            resume = (cursor['offset'], cursor['line'])
+        
+        # Rotated logs are scanned in the worker pool; each file stops at
+        # max_results on its own unless every match is being counted
+        futures = [log_pool().submit(search_file, path, query, max_results, since, until,
+                                     resume if i == 0 else None, count)
+                   for i, path in enumerate(files[:-1])]
+        summary = {'total': 0, 'shown': 0, 'last': None}
+        
+        def page_matches():
+            # Oldest file first; mail.log is searched here once the rotated
+            # logs have been merged, and skipped if they already filled the page
+            for matches, file_total in collect_in_order(futures, None if count else max_results,
+                                                        count=lambda result: len(result[0])):
+                summary['total'] += file_total or 0
+                for match in matches[:max_results - summary['shown']]:
+                    summary['shown'] += 1
+                    summary['last'] = match
+                    yield match
+            if count or summary['shown'] < max_results:
+                matches, file_total = search_file(log_file, query, max_results, since, until,
+                                                  resume if len(files) == 1 else None, count,
+                                                  mail_log_index.line_number_at)
+                summary['total'] += file_total or 0
+                for match in matches[:max_results - summary['shown']]:
+                    summary['shown'] += 1
+                    summary['last'] = match
+                    yield match
+        
+        def page_summary():
+            next_cursor = None
+            if summary['shown'] == max_results and (not count or summary['total'] > max_results):
+                last = summary['last']
+                next_cursor = encode_cursor({'ino': os.stat(last['file']).st_ino, 'offset': last['offset'],
+                                             'line': last['line_number']})
+            total = summary['total'] + sum(future.result()[1] for future in counted_before)
+            return {
+                'counted': count,
+                'total_matches': total if count else summary['shown'],
+                'next_cursor': next_cursor,
+            }
+        
+        meta = {
             'search_term': search_term,
+            'terms': terms,
+            'operator': operator,
+            'regex': regex,
             'case_sensitive': case_sensitive,
-            'total_matches': len(matching_lines),
+            'since': request.args.get('since', ''),
+            'until': request.args.get('until', ''),
             'max_results': max_results,
-            'matches': matching_lines,
-            'file': log_file
-        })
+            'file': log_file,
+            'files': files
+        }
+        
+        if wants_ndjson():
+            # {"meta": ...}, then one {"match": ...} per line as each file is
+            # merged, then {"summary": ...} (or {"error": ...})
+            def records():
+                yield {'meta': meta}
+                for match in page_matches():
+                    yield {'match': match}
+                yield {'summary': page_summary()}
+            return ndjson_response(records())
+        
+        matching_lines = list(page_matches())
+        return jsonify({'success': True, **meta, **page_summary(), 'matches': matching_lines})
             
     except FileNotFoundError:
         return jsonify({'error': 'Log file not found'}), 404
@@ -453,182 +1420,107 @@ def search_logs():
 def trace_mail():
     """Trace mail flow through Postfix logs using message IDs and email addresses"""
     try:
-        log_file = '/var/log/mail.log'
+        log_file = MAIL_LOG_FILE
         source_email = request.args.get('source', '').strip()
         dest_email = request.args.get('destination', '').strip()
         message_id = request.args.get('message_id', '').strip()
-        hours_back = int(request.args.get('hours_back', '24'))
         
         if not any([source_email, dest_email, message_id]):
             return jsonify({'error': 'At least one search criteria is required (source, destination, or message_id)'}), 400
         
-        import re
-        import datetime
-        from collections import defaultdict
+        try:
+            hours_back = parse_hours_back('24')
+            since, until = parse_time_window(hours_back)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Message tracking
-        message_traces = defaultdict(list)
-        queue_ids = set()
-        related_queue_ids = set()
-        
-        # Regex patterns for Postfix log parsing
-        patterns = {
-            'message_id': re.compile(r'message-id=<([^>]+)>', re.IGNORECASE),
-            'queue_id': re.compile(r'postfix/[^:]+\[[\d]+\]: ([A-F0-9]+):'),
-            'from': re.compile(r'from=<([^>]*)>', re.IGNORECASE),
-            'to': re.compile(r'to=<([^>]*)>', re.IGNORECASE),
-            'status': re.compile(r'status=(\w+)', re.IGNORECASE),
-            'delay': re.compile(r'delay=([\d.]+)', re.IGNORECASE),
-            'dsn': re.compile(r'dsn=([\d.]+)', re.IGNORECASE),
-            'relay': re.compile(r'relay=([^,\s]+)', re.IGNORECASE),
-            'timestamp': re.compile(r'(\w{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2}|\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})'),
-            # Additional patterns for rejections and NOQUEUE entries
-            'rejection_email': re.compile(r'<([^@\s>]+@[^@\s>]+\.[^@\s>]+)>'),
-            'noqueue': re.compile(r'NOQUEUE:', re.IGNORECASE),
-            'reject': re.compile(r'reject:', re.IGNORECASE),
-        }
+        # Rotated logs are scanned in the worker pool. mail.log itself is
+        # looked up in the persistent index, reading every line of the
+        # matched queue IDs in the time window directly by offset
+        rotations = rotated_log_files(log_file, since)
         
-        matching_entries = []
-        line_number = 0
+        def start_trace(message_id_prefix):
+            futures = [log_pool().submit(trace_file, path, source_email, dest_email, message_id, since, until,
+                                         message_id_prefix)
+                       for path in rotations]
+            return futures, mail_log_index.lookup(source_email, dest_email, message_id, since, until,
+                                                  message_id_prefix)
         
-        # Read log file and find relevant entries
-        with open(log_file, 'r') as f:
-            for line in f:
-                line_number += 1
-                line = line.rstrip('\n')
-                
-                # Skip non-postfix lines
-                if 'postfix/' not in line:
-                    continue
-                
-                # Extract basic info
-                timestamp_match = patterns['timestamp'].search(line)
-                queue_id_match = patterns['queue_id'].search(line)
-                noqueue_match = patterns['noqueue'].search(line)
-                
-                # Handle both regular queue entries and NOQUEUE entries
-                if queue_id_match:
-                    current_queue_id = queue_id_match.group(1)
-                elif noqueue_match:
-                    current_queue_id = 'NOQUEUE'
-                else:
-                    continue
-                
-                # Check if this line matches our search criteria
-                matches_criteria = False
-                match_reasons = []
-                
-                # Check message ID
-                if message_id:
-                    msg_id_match = patterns['message_id'].search(line)
-                    if msg_id_match and message_id.lower() in msg_id_match.group(1).lower():
-                        matches_criteria = True
-                        match_reasons.append(f"Message-ID: {msg_id_match.group(1)}")
-                        queue_ids.add(current_queue_id)
-                
-                # Check source email (exact match for precision)
-                if source_email:
-                    from_match = patterns['from'].search(line)
-                    if from_match and source_email.lower() == from_match.group(1).lower():
-                        matches_criteria = True
-                        match_reasons.append(f"From: {from_match.group(1)}")
-                        queue_ids.add(current_queue_id)
-                
-                # Check destination email (exact match for precision)
-                if dest_email:
-                    to_match = patterns['to'].search(line)
-                    if to_match and dest_email.lower() == to_match.group(1).lower():
-                        matches_criteria = True
-                        match_reasons.append(f"To: {to_match.group(1)}")
-                        queue_ids.add(current_queue_id)
-                    else:
-                        # Also check for emails in rejection messages (might not have to= format)
-                        # Use exact match to avoid false positives
-                        email_matches = patterns['rejection_email'].findall(line)
-                        for email in email_matches:
-                            # Only exact match to prevent showing rejections for other users
-                            if dest_email.lower() == email.lower():
-                                matches_criteria = True
-                                match_reasons.append(f"Email in rejection: {email}")
-                                queue_ids.add(current_queue_id)
-                                break
+        futures, current = start_trace(False)
+        message_id_match = 'exact'
+        if message_id and normalize_message_id(message_id):
+            # A message-id that matches nothing in any log is retried as the
+            # start of one, e.g. when only part of it was copied. The whole
+            # trace uses one mode, so this waits for the rotated logs first
+            if not current.queue_ids and not any(future.result()[1] for future in futures):
+                current.close()
+                futures, current = start_trace(True)
+                message_id_match = 'prefix'
+        carried = set()
+        
+        def rotated_traces():
+            # The newest rotated log meets mail.log: a message still queued
+            # when it was rotated has lines on both sides of the boundary
+            for i, (entries, file_queue_ids, in_flight) in enumerate(collect_in_order(futures)):
+                if i == len(futures) - 1:
+                    entries, continued = join_rotation(entries, file_queue_ids, in_flight, current.queue_ids)
+                    carried.update(continued)
+                yield entries, file_queue_ids
+        meta = {
+            'source_email': source_email,
+            'dest_email': dest_email,
+            'message_id': message_id,
+            'message_id_match': message_id_match,
+            'hours_back': hours_back,
+            'file': log_file,
+            'files': rotations + [log_file]
+        }
+        
+        if wants_ndjson():
+            # {"meta": ...}, one {"entry": ...} per line in log order as each
+            # file is read, then {"summary": ...} grouping the entries by
+            # queue ID as positions in the entry stream
+            def records():
+                yield {'meta': meta}
+                queue_ids = set(current.queue_ids)
+                groups = {}
+                position = 0
                 
-                # Check if this queue ID was already identified as relevant
-                if current_queue_id in queue_ids or current_queue_id in related_queue_ids:
-                    matches_criteria = True
-                    if not match_reasons:
-                        match_reasons.append(f"Related to Queue-ID: {current_queue_id}")
+                def emit(entries):
+                    nonlocal position
+                    for entry in entries:
+                        groups.setdefault(entry['queue_id'], []).append(position)
+                        position += 1
+                        yield {'entry': entry}
                 
-                if matches_criteria:
-                    # Extract detailed information
-                    # Extract timestamp properly handling both formats
-                    timestamp_str = ''
-                    if timestamp_match:
-                        timestamp_str = timestamp_match.group(1)
-                    
-                    entry_info = {
-                        'line_number': line_number,
-                        'content': line,
-                        'timestamp': timestamp_str,
-                        'queue_id': current_queue_id,
-                        'match_reasons': match_reasons,
-                        'details': {}
-                    }
-                    
-                    # Extract additional details with error handling
-                    for key, pattern in patterns.items():
-                        if key not in ['timestamp', 'queue_id', 'noqueue', 'reject']:
-                            try:
-                                match = pattern.search(line)
-                                if match and match.group(1):
-                                    entry_info['details'][key] = match.group(1)
-                            except (IndexError, AttributeError):
-                                # Skip patterns that don't match or don't have the expected group
-                                continue
-                    
-                    # Determine entry type
-                    if 'NOQUEUE: reject' in line:
-                        entry_info['type'] = 'rejection'
-                    elif 'cleanup' in line:
-                        entry_info['type'] = 'message_accepted'
-                    elif 'qmgr' in line and 'from=' in line:
-                        entry_info['type'] = 'queue_manager'
-                    elif ('smtp' in line or 'lmtp' in line) and 'status=sent' in line:
-                        entry_info['type'] = 'delivery_sent'
-                    elif 'smtp' in line or 'lmtp' in line:
-                        entry_info['type'] = 'delivery_attempt'
-                    elif 'smtpd' in line:
-                        entry_info['type'] = 'smtp_session'
-                    elif 'bounce' in line:
-                        entry_info['type'] = 'bounce'
-                    elif 'error' in line.lower():
-                        entry_info['type'] = 'error'
-                    else:
-                        entry_info['type'] = 'other'
-                    
-                    matching_entries.append(entry_info)
-                    related_queue_ids.add(current_queue_id)
-        
-        # Group entries by queue ID for better organization
-        grouped_traces = defaultdict(list)
-        for entry in matching_entries:
-            grouped_traces[entry['queue_id']].append(entry)
+                for entries, file_queue_ids in rotated_traces():
+                    queue_ids |= file_queue_ids
+                    yield from emit(entries)
+                yield from emit(current.entries(carried))
+                yield {'summary': {'total_entries': position, 'queue_ids': list(queue_ids), 'groups': groups}}
+            return ndjson_response(records())
         
-        # Sort entries within each group by line number
-        for queue_id in grouped_traces:
-            grouped_traces[queue_id].sort(key=lambda x: x['line_number'])
+        # Entries are in log order within each file; files go oldest first
+        matching_entries = []
+        queue_ids = set()
+        for entries, file_queue_ids in rotated_traces():
+            matching_entries.extend(entries)
+            queue_ids |= file_queue_ids
+        matching_entries.extend(current.entries(carried))
+        queue_ids |= current.queue_ids
+        
+        # Group entries by queue ID for better organization (keeping log order)
+        grouped_traces = {}
+        for entry in matching_entries:
+            grouped_traces.setdefault(entry['queue_id'], []).append(entry)
         
         return jsonify({
             'success': True,
-            'source_email': source_email,
-            'dest_email': dest_email,
-            'message_id': message_id,
-            'hours_back': hours_back,
+            **meta,
             'total_entries': len(matching_entries),
             'queue_ids': list(queue_ids),
-            'grouped_traces': dict(grouped_traces),
-            'chronological_entries': sorted(matching_entries, key=lambda x: x['line_number']),
-            'file': log_file
+            'grouped_traces': grouped_traces,
+            'chronological_entries': matching_entries,
         })
             
     except FileNotFoundError:
@@ -638,6 +1530,72 @@ def trace_mail():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/stats')
+@login_required
+def get_stats():
+    """Mail traffic statistics for the last `minutes` minutes (default 60, up to a day)"""
+    try:
+        minutes = int(request.args.get('minutes', '60'))
+        top = int(request.args.get('top', '10'))
+        
+        # Answered from the aggregator's memory; the log itself is never read here
+        mail_stats.start()
+        stats = mail_stats.summary(minutes, top)
+        stats['success'] = True
+        stats['file'] = mail_stats.log_path
+        return jsonify(stats)
+    except ValueError:
+        return jsonify({'error': 'minutes and top must be integers'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/policy/metrics')
+@login_required
+def get_policy_metrics():
+    """Decision counters and latency of the running policy server processes"""
+    try:
+        samples, processes = read_policy_metrics(POLICY_METRICS_DIR, POLICY_METRICS_MAX_AGE)
+
+        def labelled(metric, label):
+            return {dict(key[1])[label]: int(value) for key, value in samples.items()
+                    if key[0] == metric and label in dict(key[1])}
+
+        def single(metric):
+            return samples.get((metric, ()), 0)
+
+        entries = {}
+        for (metric, labels), value in samples.items():
+            labels = dict(labels)
+            if metric == 'policy_rule_entry_matches_total' and 'rule' in labels and 'entry' in labels:
+                entry = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), labels['entry'])
+                entries.setdefault(labels['rule'], []).append({'entry': entry, 'count': int(value)})
+        top_entries = {rule: sorted(items, key=lambda item: -item['count'])[:POLICY_TOP_ENTRIES]
+                       for rule, items in entries.items()}
+
+        loaded = single('policy_rules_loaded_timestamp_seconds')
+        return jsonify({
+            'success': True,
+            'processes': processes,
+            'directory': POLICY_METRICS_DIR,
+            'actions': labelled('policy_requests_total', 'action'),
+            'rules': labelled('policy_rule_matches_total', 'rule'),
+            'top_entries': top_entries,
+            'errors': int(single('policy_errors_total')),
+            'request_latency': histogram_summary(samples, 'policy_request_duration_seconds'),
+            'load_config_latency': histogram_summary(samples, 'policy_load_config_duration_seconds'),
+            'cache': {'hits': int(single('policy_decision_cache_hits_total')),
+                      'misses': int(single('policy_decision_cache_misses_total'))},
+            'rules_loaded': datetime.fromtimestamp(loaded).isoformat(timespec='seconds') if loaded else None,
+        })
+    except PermissionError:
+        return jsonify({'error': f'Permission denied reading {POLICY_METRICS_DIR}'}), 403
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 if __name__ == '__main__':
     # Use Waitress for production
-    serve(app, host='0.0.0.0', port=8080)
\ No newline at end of file
+    mail_log_index.start_updater()
+    mail_stats.start()
+    
+    # Extra threads so long-lived log streams don't starve normal requests
+    serve(app, host='0.0.0.0', port=8080, threads=32)
\ No newline at end of file
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Compares the policy server's CIDR index against the original linear scan of
+# the restriction lists for growing rule counts.
+#
+#   python3 benchmarks/bench_cidr_index.py --rules 10 100 1000 10000
+
+import argparse
+import importlib.util
+import ipaddress
+import os
+import random
+import time
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'postfix-policy-server.py')
+
+def load_server_module():
+    spec = importlib.util.spec_from_file_location('postfix_policy_server', SERVER_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def random_network(rng):
+    if rng.random() < 0.8:
+        prefix = rng.choice([8, 16, 20, 24, 28, 32])
+        address = ipaddress.IPv4Address(rng.getrandbits(32))
+    else:
+        prefix = rng.choice([32, 48, 64, 128])
+        address = ipaddress.IPv6Address(rng.getrandbits(128))
+    return ipaddress.ip_network(f"{address}/{prefix}", strict=False)
+
+def random_client(rng, networks):
+    # Half of the probes land inside a configured network
+    if networks and rng.random() < 0.5:
+        network = rng.choice(networks)
+        offset = rng.randrange(network.num_addresses) if network.num_addresses < 2 ** 32 else rng.getrandbits(32)
+        return str(network.network_address + offset)
+    if rng.random() < 0.8:
+        return str(ipaddress.IPv4Address(rng.getrandbits(32)))
+    return str(ipaddress.IPv6Address(rng.getrandbits(128)))
+
+def linear_lookup(restrictions, client_ip):
+    ip = ipaddress.ip_address(client_ip)
+    for network, allowed in restrictions:
+        if ip in network:
+            return allowed
+    return None
+
+def run(rule_count, probes, module, seed):
+    rng = random.Random(seed)
+    senders = [(random_network(rng), [f"app{i}@example.com"]) for i in range(rule_count)]
+    recipients = [(random_network(rng), [f"@dest{i}.example.com"]) for i in range(rule_count)]
+    networks = [network for network, _ in senders + recipients]
+    clients = [random_client(rng, networks) for _ in range(probes)]
+
+    start = time.perf_counter()
+    index = module.CidrIndex(senders, recipients)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = [(linear_lookup(senders, c), linear_lookup(recipients, c)) for c in clients]
+    linear_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [index.lookup(c) for c in clients]
+    index_time = time.perf_counter() - start
+
+    if actual != expected:
+        raise SystemExit(f"Index result differs from linear scan at {rule_count} rules")
+
+    print(f"{rule_count:>8} rules  build {build_time * 1000:9.2f} ms  "
+          f"linear {linear_time / probes * 1e6:10.2f} us/lookup  "
+          f"index {index_time / probes * 1e6:7.2f} us/lookup  "
+          f"speedup {linear_time / index_time:8.1f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark CIDR restriction lookups')
+    parser.add_argument('--rules', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--probes', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    module = load_server_module()
+    for rule_count in args.rules:
+        run(rule_count, args.probes, module, args.seed)
+
+if __name__ == '__main__':
+    main()
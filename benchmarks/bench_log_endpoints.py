@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Times the log viewer endpoints (tail, follow, search and trace) against
+# synthetic mail.logs of increasing size, through the Flask test client with
+# login disabled. Each scenario runs in a fresh interpreter with its own
+# empty trace index, so the reported peak RSS is that scenario's alone;
+# "trace (warm)" repeats the trace once the index has been built.
+#
+#   python3 benchmarks/bench_log_endpoints.py --sizes 100M 1G 5G --dir /var/tmp
+#   python3 benchmarks/bench_log_endpoints.py --sizes 100M --scenarios search_count trace --output bench.json
+#
+# Logs are written by generate_maillog.py and reused between runs when
+# --keep is given and the sidecar matches the requested size.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate_maillog import generate, parse_size
+
+# name -> (description, request URLs). {sender}, {recipient} and
+# {message_id} come from the generator's sidecar; a scenario with several
+# URLs times each of them in order against the same process
+SCENARIOS = {
+    'tail': ('tail 1000 lines', ['/api/logs?lines=1000']),
+    'follow': ('follow, first poll of 500 lines', ['/api/logs/follow?lines=500']),
+    'search': ('search, first page', ['/api/logs/search?q=status%3Ddeferred&max_results=100']),
+    'search_count': ('search, count every match', ['/api/logs/search?q=status%3Ddeferred&count=true']),
+    'search_regex': ('regex search, count every match',
+                     ['/api/logs/search?q=dsn%3D5%5C.%5Cd%5C.%5Cd&regex=true&count=true']),
+    'search_window': ('search the last hour', ['/api/logs/search?q=status%3Dbounced&count=true&hours_back=1']),
+    'trace': ('trace busiest sender (cold, warm)',
+              ['/api/logs/trace?source={sender}&hours_back=24'] * 2),
+    'trace_ndjson': ('trace busiest sender as NDJSON (cold)',
+                     ['/api/logs/trace?source={sender}&hours_back=24&format=ndjson']),
+    'trace_message_id': ('trace one message-id (cold)', ['/api/logs/trace?message_id={message_id}&hours_back=24']),
+}
+
+MEASURE = r'''
+import json, resource, sys, time
+sys.path.insert(0, sys.argv[1])
+log_path, index_path, urls = sys.argv[2], sys.argv[3], json.loads(sys.argv[4])
+import app as postfixmanager
+from maillog import MailLogIndex
+postfixmanager.MAIL_LOG_FILE = log_path
+postfixmanager.mail_log_index = MailLogIndex(log_path, index_path)
+postfixmanager.app.config['LOGIN_DISABLED'] = True
+client = postfixmanager.app.test_client()
+results = []
+for url in urls:
+    start = time.perf_counter()
+    response = client.get(url)
+    body = response.get_data()
+    elapsed = time.perf_counter() - start
+    results.append({'url': url, 'status': response.status_code, 'seconds': elapsed, 'bytes': len(body)})
+print(json.dumps({'requests': results, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+'''
+
+def prepare_log(path, size, timestamps):
+    # Reuses a kept log if it was generated with the same size and format
+    try:
+        with open(path + '.json') as f:
+            info = json.load(f)
+        if info['bytes'] >= size * 0.99 and info['timestamps'] == timestamps and os.path.getsize(path) == info['bytes']:
+            return info
+    except (OSError, ValueError, KeyError):
+        pass
+    started = time.perf_counter()
+    info = generate(path, size, timestamps=timestamps)
+    print(f"generated {path}: {info['lines']} lines in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return info
+
+def measure(path, urls):
+    with tempfile.TemporaryDirectory() as index_dir:
+        output = subprocess.check_output([sys.executable, '-c', MEASURE, REPO_DIR, path,
+                                          os.path.join(index_dir, 'index.sqlite'), json.dumps(urls)])
+    return json.loads(output)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the log viewer endpoints')
+    parser.add_argument('--sizes', nargs='+', default=['100M'], help='log sizes, e.g. 100M 1G 5G')
+    parser.add_argument('--dir', default='/tmp', help='where to generate the test logs')
+    parser.add_argument('--timestamps', choices=['classic', 'iso', 'mixed'], default='classic')
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--keep', action='store_true', help='keep the generated logs for the next run')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+    os.makedirs(args.dir, exist_ok=True)
+
+    results = []
+    for size_text in args.sizes:
+        path = os.path.join(args.dir, f'bench-maillog-{size_text}-{args.timestamps}.log')
+        info = prepare_log(path, parse_size(size_text), args.timestamps)
+        values = {'sender': info['busiest_sender'], 'recipient': info['recipient'], 'message_id': info['message_id']}
+        for name in args.scenarios:
+            description, urls = SCENARIOS[name]
+            result = measure(path, [url.format(**values) for url in urls])
+            for i, request in enumerate(result['requests']):
+                label = name if len(urls) == 1 else f"{name} ({'cold' if i == 0 else 'warm'})"
+                row = {
+                    'size': size_text,
+                    'bytes': info['bytes'],
+                    'log_lines': info['lines'],
+                    'scenario': label,
+                    'description': description,
+                    'url': request['url'],
+                    'status': request['status'],
+                    'seconds': request['seconds'],
+                    'lines_per_second': info['lines'] / request['seconds'] if request['seconds'] else None,
+                    'response_bytes': request['bytes'],
+                    'max_rss_kb': result['max_rss_kb'],
+                }
+                results.append(row)
+                print(f"{size_text:>6}  {label:<22} {request['seconds'] * 1000:10.1f} ms  "
+                      f"{row['lines_per_second'] / 1e6:8.2f} M lines/s  "
+                      f"peak RSS {result['max_rss_kb'] / 1024:8.1f} MB  "
+                      f"HTTP {request['status']}  {request['bytes']} bytes")
+        if not args.keep:
+            os.unlink(path)
+            os.unlink(path + '.json')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'timestamps': args.timestamps, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Compares the single-pass Postfix line parser in maillog.py against the
+# previous approach of running every regex in the trace `patterns` dict over
+# each line (queue ID, then the details loop, then classification). Entry
+# types are not compared: the old substring classifier took smtpd lines for
+# delivery attempts, which classify_record() no longer does.
+#
+#   python3 benchmarks/bench_log_parser.py --lines 200000
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maillog import parse_postfix_line, build_trace_entry
+
+SAMPLE_LINES = [
+    'Oct 17 09:14:03 relay1 postfix/smtpd[2817]: 4F1A22C0B31: client=app1.example.com[192.168.40.21]',
+    'Oct 17 09:14:03 relay1 postfix/cleanup[2820]: 4F1A22C0B31: message-id=<20261017091403.1234@app1.example.com>',
+    'Oct 17 09:14:03 relay1 postfix/qmgr[1022]: 4F1A22C0B31: from=<app1@company.com>, size=2310, nrcpt=1 (queue active)',
+    'Oct 17 09:14:04 relay1 postfix/smtp[2823]: 4F1A22C0B31: to=<user@example.org>, relay=mx.example.org[203.0.113.5]:25, '
+    'delay=0.62, delays=0.05/0.01/0.3/0.26, dsn=2.0.0, status=sent (250 2.0.0 Ok: queued as 91B3C1E0F)',
+    'Oct 17 09:14:04 relay1 postfix/qmgr[1022]: 4F1A22C0B31: removed',
+    'Oct 17 09:15:11 relay1 postfix/smtpd[2817]: NOQUEUE: reject: RCPT from unknown[198.51.100.7]: 554 5.7.1 '
+    '<someone@example.net>: Recipient address rejected: Access denied; from=<spam@bad.example> '
+    'to=<someone@example.net> proto=ESMTP helo=<bad.example>',
+]
+
+# The per-pattern approach trace_mail used before the structured parser
+PATTERNS = {
+    'message_id': re.compile(r'message-id=<([^>]+)>', re.IGNORECASE),
+    'queue_id': re.compile(r'postfix/[^:]+\[[\d]+\]: ([A-F0-9]+):'),
+    'from': re.compile(r'from=<([^>]*)>', re.IGNORECASE),
+    'to': re.compile(r'to=<([^>]*)>', re.IGNORECASE),
+    'status': re.compile(r'status=(\w+)', re.IGNORECASE),
+    'delay': re.compile(r'delay=([\d.]+)', re.IGNORECASE),
+    'dsn': re.compile(r'dsn=([\d.]+)', re.IGNORECASE),
+    'relay': re.compile(r'relay=([^,\s]+)', re.IGNORECASE),
+    'timestamp': re.compile(r'(\w{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2}|\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})'),
+    'rejection_email': re.compile(r'<([^@\s>]+@[^@\s>]+\.[^@\s>]+)>'),
+    'noqueue': re.compile(r'NOQUEUE:', re.IGNORECASE),
+    'reject': re.compile(r'reject:', re.IGNORECASE),
+}
+
+def classify(line):
+    if 'NOQUEUE: reject' in line:
+        return 'rejection'
+    elif 'cleanup' in line:
+        return 'message_accepted'
+    elif 'qmgr' in line and 'from=' in line:
+        return 'queue_manager'
+    elif ('smtp' in line or 'lmtp' in line) and 'status=sent' in line:
+        return 'delivery_sent'
+    elif 'smtp' in line or 'lmtp' in line:
+        return 'delivery_attempt'
+    elif 'bounce' in line:
+        return 'bounce'
+    elif 'error' in line.lower():
+        return 'error'
+    return 'other'
+
+def patterns_entry(line, line_number):
+    queue_id_match = PATTERNS['queue_id'].search(line)
+    if queue_id_match:
+        queue_id = queue_id_match.group(1)
+    elif PATTERNS['noqueue'].search(line):
+        queue_id = 'NOQUEUE'
+    else:
+        return None
+    timestamp_match = PATTERNS['timestamp'].search(line)
+    entry = {
+        'line_number': line_number,
+        'content': line,
+        'timestamp': timestamp_match.group(1) if timestamp_match else '',
+        'queue_id': queue_id,
+        'match_reasons': [f"Related to Queue-ID: {queue_id}"],
+        'details': {},
+        'type': classify(line),
+    }
+    for key, pattern in PATTERNS.items():
+        if key not in ['timestamp', 'queue_id', 'noqueue', 'reject']:
+            match = pattern.search(line)
+            if match and match.group(1):
+                entry['details'][key] = match.group(1)
+    return entry
+
+def parser_entry(line, line_number):
+    record = parse_postfix_line(line)
+    if record is None:
+        return None
+    return build_trace_entry(record, line, line_number, [])
+
+def measure(function, lines):
+    start = time.perf_counter()
+    for line_number, line in enumerate(lines, 1):
+        function(line, line_number)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Postfix log line parsing')
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    lines = [SAMPLE_LINES[i % len(SAMPLE_LINES)] for i in range(args.lines)]
+    for line_number, line in enumerate(SAMPLE_LINES, 1):
+        expected = dict(patterns_entry(line, line_number), type=None)
+        if expected != dict(parser_entry(line, line_number), type=None):
+            raise SystemExit(f"Parser output differs from the patterns approach for: {line}")
+
+    for name, function in (('patterns', patterns_entry), ('parser', parser_entry)):
+        best = min(measure(function, lines) for _ in range(args.repeat))
+        print(f"{name:<10} {args.lines / best:12,.0f} lines/sec  ({best * 1000:.1f} ms for {args.lines} lines)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Compares reading the last N lines of a large mail.log with the block tail
+# reader against the previous readlines() approach. Each measurement runs in
+# a fresh interpreter so its peak RSS is reported on its own.
+#
+#   python3 benchmarks/bench_log_tail.py --sizes 10M 1G 5G --dir /var/tmp
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SAMPLE_LINES = [
+    'Oct 17 09:14:03 relay1 postfix/smtpd[2817]: 4F1A22C0B31: client=app1.example.com[192.168.40.21]\n',
+    'Oct 17 09:14:03 relay1 postfix/cleanup[2820]: 4F1A22C0B31: message-id=<20261017091403.1234@app1.example.com>\n',
+    'Oct 17 09:14:03 relay1 postfix/qmgr[1022]: 4F1A22C0B31: from=<app1@company.com>, size=2310, nrcpt=1 (queue active)\n',
+    'Oct 17 09:14:04 relay1 postfix/smtp[2823]: 4F1A22C0B31: to=<user@example.org>, relay=mx.example.org[203.0.113.5]:25, '
+    'delay=0.62, delays=0.05/0.01/0.3/0.26, dsn=2.0.0, status=sent (250 2.0.0 Ok: queued as 91B3C1E0F)\n',
+    'Oct 17 09:14:04 relay1 postfix/qmgr[1022]: 4F1A22C0B31: removed\n',
+]
+
+MEASURE = r'''
+import json, resource, sys, time
+sys.path.insert(0, sys.argv[4])
+method, path, count = sys.argv[1], sys.argv[2], int(sys.argv[3])
+start = time.perf_counter()
+if method == 'readlines':
+    with open(path, 'r') as f:
+        all_lines = f.readlines()
+        content = ''.join(all_lines[-count:] if len(all_lines) > count else all_lines)
+else:
+    from maillog import tail_lines
+    content = tail_lines(path, count)
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'lines': content.count('\n')}))
+'''
+
+def parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+def generate(path, size):
+    if os.path.exists(path) and os.path.getsize(path) >= size:
+        return
+    chunk = ''.join(SAMPLE_LINES * 2000).encode()
+    written = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            f.write(chunk)
+            written += len(chunk)
+
+def measure(method, path, count):
+    output = subprocess.check_output([sys.executable, '-c', MEASURE, method, path, str(count), REPO_DIR])
+    return json.loads(output)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mail.log tail reading')
+    parser.add_argument('--sizes', nargs='+', default=['10M'], help='log sizes, e.g. 10M 1G 5G')
+    parser.add_argument('--lines', type=int, default=500)
+    parser.add_argument('--dir', default='/tmp', help='where to generate the test logs')
+    parser.add_argument('--skip-readlines', action='store_true',
+                        help='only run the tail reader (readlines on 5G needs >5 GB of RAM)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated logs')
+    args = parser.parse_args()
+    os.makedirs(args.dir, exist_ok=True)
+
+    for size_text in args.sizes:
+        path = os.path.join(args.dir, f'bench-mail-{size_text}.log')
+        generate(path, parse_size(size_text))
+        methods = ['tail'] if args.skip_readlines else ['readlines', 'tail']
+        for method in methods:
+            result = measure(method, path, args.lines)
+            print(f"{size_text:>6}  {method:<10} {result['seconds'] * 1000:10.2f} ms  "
+                  f"peak RSS {result['max_rss_kb'] / 1024:9.1f} MB  ({result['lines']} lines)")
+        if not args.keep:
+            os.unlink(path)
+
+if __name__ == '__main__':
+    main()
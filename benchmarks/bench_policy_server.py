@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+# Load test for the policy server. Generates the four rule files at the given
+# sizes and a stream of smtpd_access_policy requests (multi-RCPT sessions from
+# IPv4 and IPv6 clients), then replays it through concurrent simulated smtpd
+# clients over the policy protocol: one spawned stdin/stdout server process
+# per client as with the master.cf spawn service, or one --listen daemon
+# serving every client. Prints the results as JSON so runs of different
+# versions (--server) can be compared.
+#
+#   python3 benchmarks/bench_policy_server.py --clients 20 --sessions 20000 \
+#       --denied 10000 --blackhole 200000 --sender-rules 5000 --recipient-rules 5000
+#   python3 benchmarks/bench_policy_server.py --daemon --compile --output after.json
+
+import argparse
+import ipaddress
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'postfix-policy-server.py')
+
+def random_network(rng, ipv6_ratio):
+    if rng.random() >= ipv6_ratio:
+        prefix = rng.choice([16, 20, 24, 24, 28, 32])
+        address = ipaddress.IPv4Address(rng.getrandbits(32))
+    else:
+        prefix = rng.choice([48, 56, 64, 128])
+        address = ipaddress.IPv6Address(rng.getrandbits(128))
+    return ipaddress.ip_network(f"{address}/{prefix}", strict=False)
+
+def address_in(rng, network):
+    offset = rng.randrange(min(network.num_addresses, 2 ** 32))
+    return str(network.network_address + offset)
+
+def random_address(rng, domains):
+    return f"user{rng.randrange(100000)}@{rng.choice(domains)}"
+
+def generate_rules(config_dir, args, rng):
+    # Address lists mix exact addresses, @domain and @.domain entries; each
+    # restriction network allows a few addresses and domains
+    # The domain pool is large enough that domain entries cover only a small
+    # share of the generated traffic
+    domains = [f"d{i}.example.com" for i in range(10 * max(1000, args.denied + args.blackhole))]
+
+    def address_entry():
+        kind = rng.random()
+        if kind < 0.8:
+            return random_address(rng, domains)
+        if kind < 0.95:
+            return '@' + rng.choice(domains)
+        return '@.' + rng.choice(domains)
+
+    rules = {
+        'denied_senders': [address_entry() for _ in range(args.denied)],
+        'blackhole_recipients': [address_entry() for _ in range(args.blackhole)],
+        'sender_restrictions': [],
+        'recipient_restrictions': [],
+    }
+    for _ in range(args.sender_rules):
+        allowed = [f"app{rng.randrange(1000)}@company.com" for _ in range(rng.randint(1, 3))]
+        rules['sender_restrictions'].append((random_network(rng, args.ipv6_ratio), allowed))
+    for _ in range(args.recipient_rules):
+        allowed = [random_address(rng, domains) for _ in range(rng.randint(1, 3))]
+        allowed += ['@' + rng.choice(domains) for _ in range(rng.randint(0, 2))]
+        rules['recipient_restrictions'].append((random_network(rng, args.ipv6_ratio), allowed))
+
+    for name, entries in rules.items():
+        with open(os.path.join(config_dir, f"{name}.conf"), 'w') as f:
+            for entry in entries:
+                if isinstance(entry, tuple):
+                    network, allowed = entry
+                    f.write(f"{network} {' '.join(allowed)}\n")
+                else:
+                    f.write(entry + '\n')
+    return rules, domains
+
+def generate_sessions(rules, domains, args, rng):
+    # Each session is one message: a client, a sender and 1..max_rcpt RCPT
+    # requests. Some clients fall inside restriction networks, some senders
+    # are denied or outside their network's allowed list, some recipients
+    # are blackholed.
+    networks = [network for network, _ in rules['sender_restrictions'] + rules['recipient_restrictions']]
+    denied = [entry for entry in rules['denied_senders'] if not entry.startswith('@')]
+    sessions = []
+    for number in range(args.sessions):
+        if networks and rng.random() < 0.5:
+            network = rng.choice(networks)
+            client = address_in(rng, network)
+        elif rng.random() < args.ipv6_ratio:
+            client = str(ipaddress.IPv6Address(rng.getrandbits(128)))
+        else:
+            client = str(ipaddress.IPv4Address(rng.getrandbits(32)))
+
+        kind = rng.random()
+        if kind < 0.05 and denied:
+            sender = rng.choice(denied)
+        elif kind < 0.5 and rules['sender_restrictions']:
+            sender = rng.choice(rng.choice(rules['sender_restrictions'])[1])
+        else:
+            sender = random_address(rng, domains)
+
+        # Geometric recipient count: most messages have one or two recipients
+        count = 1
+        while count < args.max_rcpt and rng.random() < 0.4:
+            count += 1
+        recipients = []
+        for _ in range(count):
+            if rules['blackhole_recipients'] and rng.random() < 0.02:
+                entry = rng.choice(rules['blackhole_recipients'])
+                recipients.append(entry if not entry.startswith('@') else 'someone' + entry.replace('@.', '@x.'))
+            else:
+                recipients.append(random_address(rng, domains))
+
+        requests = []
+        for index, recipient in enumerate(recipients, 1):
+            requests.append(
+                'request=smtpd_access_policy\n'
+                'protocol_state=RCPT\n'
+                'protocol_name=ESMTP\n'
+                f'client_address={client}\n'
+                'client_name=unknown\n'
+                f'reverse_client_name=host{number % 997}.example.net\n'
+                f'helo_name=host{number % 997}.example.net\n'
+                f'sender={sender}\n'
+                f'recipient={recipient}\n'
+                f'recipient_count={index - 1}\n'
+                'queue_id=\n'
+                f'instance={number:x}.{int(time.time()):x}.0\n'
+                'size=0\n'
+                'etrn_domain=\n'
+                'stress=\n'
+                'sasl_method=\n'
+                'sasl_username=\n'
+                'sasl_sender=\n'
+                'ccert_subject=\n'
+                'ccert_issuer=\n'
+                'ccert_fingerprint=\n'
+                'encryption_protocol=TLSv1.3\n'
+                'encryption_cipher=TLS_AES_256_GCM_SHA384\n'
+                'encryption_keysize=256\n'
+                '\n'
+            )
+        sessions.append(requests)
+    return sessions
+
+def read_response(stream):
+    response = []
+    while True:
+        line = stream.readline()
+        if not line:
+            raise EOFError('policy server closed the connection')
+        line = line.strip()
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        if not line:
+            return response
+        response.append(line)
+
+def replay(sessions, writer, reader, latencies, actions):
+    for requests in sessions:
+        for request in requests:
+            start = time.perf_counter()
+            writer.write(request)
+            writer.flush()
+            response = read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            action = response[0].split('=', 1)[1].split(None, 1)[0] if response else 'NONE'
+            actions[action] = actions.get(action, 0) + 1
+
+def process_memory(pid):
+    # Current and peak resident set size in KiB, from /proc (Linux only)
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    memory[line.split(':')[0]] = int(line.split()[1])
+    except OSError:
+        return None
+    return {'rss_kb': memory.get('VmRSS'), 'peak_rss_kb': memory.get('VmHWM')}
+
+def wait_for_socket(path, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('policy server exited during startup')
+        if os.path.exists(path):
+            return
+        time.sleep(0.05)
+    raise SystemExit('policy server did not create its socket')
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run(args):
+    rng = random.Random(args.seed)
+    config_dir = tempfile.mkdtemp(prefix='policy-bench-')
+    try:
+        rules, domains = generate_rules(config_dir, args, rng)
+        sessions = generate_sessions(rules, domains, args, rng)
+        snapshot = os.path.join(config_dir, 'policy_rules.bin') if args.compile else ''
+        command = [sys.executable, args.server, '--config-dir', config_dir, '--snapshot', snapshot,
+                   '--cache-size', str(args.cache_size), '--reload-interval', '0']
+        if args.compile:
+            subprocess.run(command + ['compile'], check=True)
+
+        # Sessions are dealt round-robin; each client replays its share
+        shares = [sessions[i::args.clients] for i in range(args.clients)]
+        latencies = [[] for _ in range(args.clients)]
+        actions = [{} for _ in range(args.clients)]
+        processes = []
+        connections = []
+        sockets = []
+        started = time.perf_counter()
+        if args.daemon:
+            socket_path = os.path.join(config_dir, 'policy.sock')
+            processes.append(subprocess.Popen(command + ['--listen', f"unix:{socket_path}"]))
+            wait_for_socket(socket_path, processes[0])
+            for _ in range(args.clients):
+                conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                conn.connect(socket_path)
+                sockets.append(conn)
+                connections.append((conn.makefile('w', encoding='utf-8'), conn.makefile('rb')))
+        else:
+            for _ in range(args.clients):
+                process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                           text=True, bufsize=1)
+                processes.append(process)
+                connections.append((process.stdin, process.stdout))
+        startup = time.perf_counter() - started
+
+        # Replay a few sessions per client first so startup and cold caches
+        # don't count towards the latency figures
+        warmup = [share[:args.warmup] for share in shares]
+        measured = [share[args.warmup:] for share in shares]
+        for i, (writer, reader) in enumerate(connections):
+            replay(warmup[i], writer, reader, [], {})
+
+        threads = [threading.Thread(target=replay, args=(measured[i], writer, reader, latencies[i], actions[i]))
+                   for i, (writer, reader) in enumerate(connections)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        memory = [process_memory(process.pid) for process in processes]
+        for writer, reader in connections:
+            writer.close()
+            reader.close()
+        for conn in sockets:
+            conn.close()
+        for process in processes:
+            if args.daemon:
+                process.terminate()
+            process.wait(timeout=30)
+
+        all_latencies = sorted(latency for client in latencies for latency in client)
+        action_counts = {}
+        for client in actions:
+            for action, count in client.items():
+                action_counts[action] = action_counts.get(action, 0) + count
+        known_memory = [m for m in memory if m]
+        return {
+            'server': os.path.abspath(args.server),
+            'commit': git_commit(args.server),
+            'python': platform.python_version(),
+            'mode': 'daemon' if args.daemon else 'spawn',
+            'snapshot': bool(args.compile),
+            'rules': {name: len(entries) for name, entries in rules.items()},
+            'clients': args.clients,
+            'sessions': sum(len(share) for share in measured),
+            'requests': len(all_latencies),
+            'seconds': elapsed,
+            'startup_seconds': startup,
+            'requests_per_second': len(all_latencies) / elapsed if elapsed else None,
+            'latency_ms': {
+                'mean': sum(all_latencies) / len(all_latencies) * 1000 if all_latencies else None,
+                'p50': percentile(all_latencies, 0.5) * 1000 if all_latencies else None,
+                'p99': percentile(all_latencies, 0.99) * 1000 if all_latencies else None,
+                'p999': percentile(all_latencies, 0.999) * 1000 if all_latencies else None,
+                'max': all_latencies[-1] * 1000 if all_latencies else None,
+            },
+            'actions': action_counts,
+            'memory_kb': {
+                'processes': len(processes),
+                'rss_per_process_max': max((m['rss_kb'] for m in known_memory), default=None),
+                'peak_rss_per_process_max': max((m['peak_rss_kb'] for m in known_memory), default=None),
+                'rss_total': sum(m['rss_kb'] for m in known_memory) if known_memory else None,
+            },
+        }
+    finally:
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+def git_commit(server):
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(server)),
+                                capture_output=True, text=True, timeout=10)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the Postfix policy server')
+    parser.add_argument('--server', default=SERVER_SCRIPT, help='policy server script to benchmark')
+    parser.add_argument('--denied', type=int, default=1000, help='denied_senders.conf entries')
+    parser.add_argument('--blackhole', type=int, default=1000, help='blackhole_recipients.conf entries')
+    parser.add_argument('--sender-rules', type=int, default=500, help='sender_restrictions.conf networks')
+    parser.add_argument('--recipient-rules', type=int, default=500, help='recipient_restrictions.conf networks')
+    parser.add_argument('--ipv6-ratio', type=float, default=0.2, help='share of IPv6 clients and networks')
+    parser.add_argument('--sessions', type=int, default=5000, help='messages to replay')
+    parser.add_argument('--max-rcpt', type=int, default=10, help='most recipients per message')
+    parser.add_argument('--clients', type=int, default=10, help='concurrent simulated smtpd clients')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured sessions per client')
+    parser.add_argument('--daemon', action='store_true',
+                        help='serve every client from one --listen daemon instead of a process each')
+    parser.add_argument('--compile', action='store_true', help='compile and use the binary rule snapshot')
+    parser.add_argument('--cache-size', type=int, default=10000, help='decision cache size (0 disables)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    args = parser.parse_args()
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
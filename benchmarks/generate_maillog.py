@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# Writes a synthetic Postfix mail.log of a given size for the log benchmarks.
+# Messages go through smtpd, cleanup, qmgr and smtp (sent, deferred or bounced
+# with a bounce notification), with NOQUEUE rejects and connect/disconnect
+# noise in between. Messages overlap in time, so the lines of different queue
+# IDs interleave as in a real log. Timestamps run evenly up to now, in the
+# traditional syslog format, RFC 3339 (rsyslog high precision) or both.
+#
+#   python3 benchmarks/generate_maillog.py /var/tmp/mail.log --size 1G
+#   python3 benchmarks/generate_maillog.py /var/tmp/mail.log --size 100M --timestamps iso --hours 6
+#
+# A JSON sidecar (<path>.json) records the line count and sample values
+# (a busy sender, a recipient, a message-id) that benchmarks can query.
+
+import argparse
+import heapq
+import json
+import os
+import random
+import time
+from datetime import datetime
+
+# Rough bytes per message (all of its lines), used to spread the timestamps
+# before the real figure is known
+ESTIMATED_MESSAGE_BYTES = 1000
+CALIBRATE_MESSAGES = 2000
+
+def parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+class TimestampFormatter:
+    # Formats each second once; consecutive lines mostly share it
+    def __init__(self, style, rng):
+        self.style = style
+        self.rng = rng
+        self.second = None
+        self.text = None
+
+    def __call__(self, t):
+        style = self.style
+        if style == 'mixed':
+            style = 'iso' if self.rng.random() < 0.5 else 'classic'
+        if style == 'iso':
+            return datetime.fromtimestamp(t).astimezone().isoformat(timespec='microseconds')
+        second = int(t)
+        if second != self.second:
+            self.second = second
+            self.text = datetime.fromtimestamp(second).strftime('%b %e %H:%M:%S')
+        return self.text
+
+class MessageFactory:
+    def __init__(self, rng, host):
+        self.rng = rng
+        self.host = host
+        # A few application senders send most of the mail
+        self.senders = [f"app{i}@company.com" for i in range(20)] + [f"user{i}@company.com" for i in range(2000)]
+        self.sender_weights = [200.0 / (i + 1) for i in range(20)] + [1.0] * 2000
+        self.recipient_domains = [f"example{i}.org" for i in range(500)]
+        self.clients = [(f"app{i}.company.com", f"192.168.{i // 250}.{i % 250 + 1}") for i in range(300)]
+        self.clients += [(f"host{i}.example.net", f"2001:db8:{i:x}::25") for i in range(50)]
+        self.pid = 1000
+
+    def next_pid(self):
+        self.pid = self.pid % 60000 + 1
+        return self.pid
+
+    def queue_id(self):
+        return f"{self.rng.getrandbits(44):011X}"
+
+    def recipient(self):
+        rng = self.rng
+        return f"{rng.choice(['info', 'sales', 'ops', 'alerts', 'user'])}{rng.randrange(5000)}@{rng.choice(self.recipient_domains)}"
+
+    def message(self, start):
+        # Returns ([(time, service, text)], sender, first recipient, message-id)
+        # for one message or NOQUEUE reject (without a message-id)
+        rng = self.rng
+        client_name, client_ip = rng.choice(self.clients)
+        smtpd = f"postfix/smtpd[{self.next_pid()}]"
+        sender = rng.choices(self.senders, self.sender_weights)[0]
+
+        if rng.random() < 0.08:
+            rcpt = self.recipient()
+            return [
+                (start, smtpd, f"connect from {client_name}[{client_ip}]"),
+                (start + 0.05, smtpd, f"NOQUEUE: reject: RCPT from {client_name}[{client_ip}]: 554 5.7.1 <{rcpt}>: "
+                                      f"Recipient address rejected: Access denied; from=<{sender}> to=<{rcpt}> "
+                                      f"proto=ESMTP helo=<{client_name}>"),
+                (start + 0.06, smtpd, f"disconnect from {client_name}[{client_ip}] ehlo=1 mail=1 rcpt=0/1 quit=1 commands=3/4"),
+            ], sender, rcpt, None
+
+        qid = self.queue_id()
+        recipients = [self.recipient() for _ in range(1 if rng.random() < 0.7 else rng.randint(2, 5))]
+        size = rng.randrange(800, 200000)
+        message_id = f"{int(start)}.{rng.getrandbits(32):08x}@{client_name}"
+        qmgr = "postfix/qmgr[1022]"
+        lines = [
+            (start, smtpd, f"connect from {client_name}[{client_ip}]"),
+            (start + 0.01, smtpd, f"{qid}: client={client_name}[{client_ip}]"),
+            (start + 0.02, f"postfix/cleanup[{self.next_pid()}]", f"{qid}: message-id=<{message_id}>"),
+            (start + 0.03, qmgr, f"{qid}: from=<{sender}>, size={size}, nrcpt={len(recipients)} (queue active)"),
+            (start + 0.04, smtpd, f"disconnect from {client_name}[{client_ip}] ehlo=2 starttls=1 mail=1 "
+                                  f"rcpt={len(recipients)} data=1 quit=1 commands={6 + len(recipients)}"),
+        ]
+        t = start + 0.05
+        bounced = False
+        for rcpt in recipients:
+            delay = rng.lognormvariate(-0.5, 1.0)
+            t += delay
+            smtp = f"postfix/smtp[{self.next_pid()}]"
+            domain = rcpt.split('@')[1]
+            relay = f"mx.{domain}[203.0.{rng.randrange(256)}.{rng.randrange(1, 255)}]:25"
+            delays = f"{delay * 0.1:.2g}/{delay * 0.05:.2g}/{delay * 0.4:.2g}/{delay * 0.45:.2g}"
+            outcome = rng.random()
+            if outcome < 0.9:
+                lines.append((t, smtp, f"{qid}: to=<{rcpt}>, relay={relay}, delay={delay:.2f}, delays={delays}, "
+                                       f"dsn=2.0.0, status=sent (250 2.0.0 Ok: queued as {self.queue_id()})"))
+            elif outcome < 0.97:
+                lines.append((t, smtp, f"{qid}: to=<{rcpt}>, relay=none, delay={delay:.2f}, delays={delays}, "
+                                       f"dsn=4.4.1, status=deferred (connect to mx.{domain}[203.0.113.9]:25: "
+                                       f"Connection timed out)"))
+            else:
+                bounced = True
+                lines.append((t, smtp, f"{qid}: to=<{rcpt}>, relay={relay}, delay={delay:.2f}, delays={delays}, "
+                                       f"dsn=5.1.1, status=bounced (host mx.{domain} said: 550 5.1.1 <{rcpt}>: "
+                                       f"Recipient address rejected: User unknown (in reply to RCPT TO command))"))
+        if bounced:
+            t += 0.01
+            lines.append((t, f"postfix/bounce[{self.next_pid()}]",
+                          f"{qid}: sender non-delivery notification: {self.queue_id()}"))
+        lines.append((t + 0.01, qmgr, f"{qid}: removed"))
+        return lines, sender, recipients[0], message_id
+
+def generate(path, size, hours=24, timestamps='classic', seed=1, host='relay1'):
+    rng = random.Random(seed)
+    factory = MessageFactory(rng, host)
+    formatter = TimestampFormatter(timestamps, rng)
+    end = time.time()
+    start = end - hours * 3600
+    step = hours * 3600 / max(1, size // ESTIMATED_MESSAGE_BYTES)
+
+    pending = []
+    sequence = 0
+    written = 0
+    lines = 0
+    messages = 0
+    sent_by = {}
+    sample_recipient = sample_message_id = None
+    now = start
+    with open(path, 'w', buffering=1024 * 1024) as f:
+        while written < size:
+            events, sender, recipient, message_id = factory.message(now)
+            sent_by[sender] = sent_by.get(sender, 0) + 1
+            if message_id and (sample_message_id is None or rng.random() < 0.0001):
+                sample_recipient, sample_message_id = recipient, message_id
+            for event in events:
+                heapq.heappush(pending, (event[0], sequence, event[1], event[2]))
+                sequence += 1
+
+            # Lines are written once every message that could precede them
+            # has been generated
+            now += rng.expovariate(1.0 / step)
+            while pending and pending[0][0] <= now and written < size:
+                t, _, service, text = heapq.heappop(pending)
+                line = f"{formatter(min(t, end))} {host} {service}: {text}\n"
+                f.write(line)
+                written += len(line)
+                lines += 1
+
+            messages += 1
+            if messages == CALIBRATE_MESSAGES:
+                # Respread the remaining messages over the rest of the window
+                remaining = max(1, (size - written) * messages // max(1, written))
+                step = max(1e-6, (end - now) / remaining)
+
+        # Flush what is left of the last messages if the size allows
+        while pending and written < size:
+            t, _, service, text = heapq.heappop(pending)
+            line = f"{formatter(min(t, end))} {host} {service}: {text}\n"
+            f.write(line)
+            written += len(line)
+            lines += 1
+
+    info = {
+        'path': path,
+        'bytes': written,
+        'lines': lines,
+        'hours': hours,
+        'timestamps': timestamps,
+        'seed': seed,
+        'busiest_sender': max(sent_by, key=sent_by.get) if sent_by else None,
+        'busiest_sender_messages': max(sent_by.values()) if sent_by else 0,
+        'recipient': sample_recipient,
+        'message_id': sample_message_id,
+    }
+    with open(path + '.json', 'w') as f:
+        json.dump(info, f, indent=2)
+    return info
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Postfix mail.log')
+    parser.add_argument('path')
+    parser.add_argument('--size', default='100M', help='log size, e.g. 100M, 1G, 5G')
+    parser.add_argument('--hours', type=float, default=24, help='time span of the log, ending now')
+    parser.add_argument('--timestamps', choices=['classic', 'iso', 'mixed'], default='classic',
+                        help='syslog timestamp format (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    info = generate(args.path, parse_size(args.size), args.hours, args.timestamps, args.seed)
+    info['generate_seconds'] = time.perf_counter() - started
+    print(json.dumps(info, indent=2))
+
+if __name__ == '__main__':
+    main()
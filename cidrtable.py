@@ -0,0 +1,173 @@
+import heapq
+import ipaddress
+from bisect import bisect_right
+
+# Network lists ("IP/CIDR value...") as used by relay_clients.cidr and the
+# sender/recipient restriction files. Postfix cidr tables and the policy
+# server both answer with the first entry in file order whose network
+# contains the client, so an entry behind a broader one is never reached and
+# adjacent networks with the same value can be merged.
+#
+# optimize() rewrites a table into an equivalent one with fewer entries: the
+# entries are flattened into the address ranges they actually decide, and
+# the ranges are re-aggregated into as few prefixes as the ORTC algorithm
+# (Draves et al., "Constructing Optimal IP Routing Tables") finds, most
+# specific first so first match equals longest match. Addresses no entry
+# matches can't be covered by a broader entry, since nothing could then
+# undo it. The result is flattened again and compared before it is used.
+#
+# Postfix skips cidr table entries with host bits set outside the mask
+# ("non-null host address bits"), while the policy server masks them off;
+# strict tables report such entries as errors rather than guess.
+
+class CidrTable:
+    """Entries of a network list: (network, value) in file order, with comments and unparsable lines set aside"""
+
+    def __init__(self, lines, strict=False):
+        self.lines = list(lines)
+        self.comments = []
+        self.entries = []
+        self.entry_lines = []
+        self.errors = []
+        for number, line in enumerate(self.lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                self.comments.append(line)
+                continue
+            parts = line.split()
+            try:
+                if len(parts) < 2:
+                    raise ValueError('expected a network followed by a value')
+                network = ipaddress.ip_network(parts[0], strict=False)
+                if strict and ipaddress.ip_interface(parts[0]).ip != network.network_address:
+                    raise ValueError(f'host bits set outside the mask, so Postfix skips this entry '
+                                     f'(perhaps use {network.with_prefixlen})')
+            except ValueError as e:
+                self.errors.append({'line': number, 'content': line, 'error': str(e)})
+                continue
+            self.entries.append((network, tuple(parts[1:])))
+            self.entry_lines.append(line)
+
+    def covering(self):
+        """Index of the networks in the table, for finding entries that already cover a new one"""
+        return CoverIndex(self.entries)
+
+def format_entry(network, value):
+    """Table line of an entry"""
+    return f"{network.with_prefixlen} {' '.join(value)}"
+
+def effective_ranges(entries, version):
+    """Ranges of one address family as sorted (starts, values) lists, each range decided by its first match (None: unmatched)"""
+    space = 1 << (32 if version == 4 else 128)
+    rules = sorted((int(network.network_address), int(network.broadcast_address) + 1, order, value)
+                   for order, (network, value) in enumerate(entries) if network.version == version)
+    starts = [0]
+    values = [None]
+    boundaries = sorted({rule[0] for rule in rules} | {rule[1] for rule in rules if rule[1] < space})
+    active = []
+    next_rule = 0
+    for boundary in boundaries:
+        while next_rule < len(rules) and rules[next_rule][0] == boundary:
+            start, end, order, value = rules[next_rule]
+            heapq.heappush(active, (order, end, value))
+            next_rule += 1
+        # Drop expired rules lazily; only the earliest active one matters
+        while active and active[0][1] <= boundary:
+            heapq.heappop(active)
+        current = active[0][2] if active else None
+        if current != values[-1]:
+            if starts[-1] == boundary:
+                values[-1] = current
+            else:
+                starts.append(boundary)
+                values.append(current)
+    return starts, values
+
+def aggregate(starts, values, version, rank):
+    """Fewest (network, value) prefixes, in no particular order, whose longest match gives these ranges"""
+    bits = 32 if version == 4 else 128
+    network_class = ipaddress.IPv4Network if version == 4 else ipaddress.IPv6Network
+
+    def build(address, prefixlen):
+        # Node: (address, prefixlen, candidate values, contains unmatched
+        # addresses, left, right); a range with one value is a leaf
+        size = 1 << (bits - prefixlen)
+        i = bisect_right(starts, address)
+        if i == len(starts) or starts[i] >= address + size:
+            value = values[i - 1]
+            return (address, prefixlen, frozenset([value]), value is None, None, None)
+        left = build(address, prefixlen + 1)
+        right = build(address + (size >> 1), prefixlen + 1)
+        # ORTC: values common to both halves if any, otherwise either's
+        candidates = (left[2] & right[2]) or (left[2] | right[2])
+        return (address, prefixlen, candidates, left[3] or right[3], left, right)
+
+    prefixes = []
+
+    def assign(node, inherited):
+        address, prefixlen, candidates, unmatched, left, right = node
+        if unmatched:
+            # Nothing above covers this node either, so its halves start afresh
+            if left is not None:
+                assign(left, None)
+                assign(right, None)
+            return
+        value = inherited
+        if inherited not in candidates:
+            value = min(candidates, key=rank)
+            prefixes.append((network_class((address, prefixlen)), value))
+        if left is not None:
+            assign(left, value)
+            assign(right, value)
+
+    assign(build(0, 0), None)
+    return prefixes
+
+def optimize(entries):
+    """Equivalent entries with contained, shadowed and adjacent networks merged, most specific first"""
+    first_seen = {}
+    for order, (network, value) in enumerate(entries):
+        first_seen.setdefault(value, order)
+
+    def rank(value):
+        return first_seen[value]
+
+    result = []
+    for version in (4, 6):
+        starts, values = effective_ranges(entries, version)
+        prefixes = aggregate(starts, values, version, rank)
+        prefixes.sort(key=lambda entry: (-entry[0].prefixlen, int(entry[0].network_address)))
+        result.extend(prefixes)
+    return result
+
+def equivalent(entries, other):
+    """True if both entry lists decide every address the same way"""
+    return all(effective_ranges(entries, version) == effective_ranges(other, version) for version in (4, 6))
+
+class CoverIndex:
+    """Finds the first entry whose network contains a given network"""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.first = {}
+        prefixlens = {4: set(), 6: set()}
+        for order, (network, value) in enumerate(entries):
+            self.first.setdefault((network.version, network.prefixlen, int(network.network_address)), order)
+            prefixlens[network.version].add(network.prefixlen)
+        self.prefixlens = {version: sorted(lengths) for version, lengths in prefixlens.items()}
+
+    def find(self, network):
+        """Index of the earliest entry containing network, or None"""
+        bits = network.max_prefixlen
+        address = int(network.network_address)
+        found = None
+        for prefixlen in self.prefixlens[network.version]:
+            if prefixlen > network.prefixlen:
+                break
+            mask = ((1 << bits) - 1) ^ ((1 << (bits - prefixlen)) - 1)
+            order = self.first.get((network.version, prefixlen, address & mask))
+            if order is not None and (found is None or order < found):
+                found = order
+        return found
@@ -136,17 +136,28 @@ setup_config_permissions() {
     # Create config directory if it doesn't exist
     mkdir -p "$CONFIG_DIR"
     
-    # Create data directory for user data
+    # Create data directory for user data and the compiled policy rule snapshot
     mkdir -p "/var/lib/postfixmanager"
     chown "$SERVICE_USER:$SERVICE_USER" "/var/lib/postfixmanager"
     chmod 755 "/var/lib/postfixmanager"
     
+    # Policy server metrics files (--metrics-dir), written by the postfix user
+    mkdir -p "/var/lib/postfixmanager/policy-metrics"
+    chown postfix:postfix "/var/lib/postfixmanager/policy-metrics"
+    chmod 755 "/var/lib/postfixmanager/policy-metrics"
+    
+    # Rate limit counters shared by the policy server processes
+    mkdir -p "/var/lib/postfixmanager/policy-ratelimit"
+    chown postfix:postfix "/var/lib/postfixmanager/policy-ratelimit"
+    chmod 750 "/var/lib/postfixmanager/policy-ratelimit"
+    
     # Create empty config files if they don't exist (without changing permissions)
     local config_files=(
         "blackhole_recipients.conf"
         "denied_senders.conf" 
         "sender_restrictions.conf"
         "recipient_restrictions.conf"
+        "rate_limits.conf"
         "relay_clients.cidr"
     )
     
@@ -176,6 +187,16 @@ setup_config_permissions() {
     log_success "Configuration directories and log access set up"
 }
 
+install_policy_server() {
+    log_info "Installing policy server..."
+    
+    # Postfix runs the policy server from here; the web interface runs it to
+    # compile the rule snapshot into /var/lib/postfixmanager/policy_rules.bin
+    install -m 755 "$INSTALL_DIR/postfix-policy-server.py" /usr/local/bin/postfix-policy-server.py
+    
+    log_success "Policy server installed to /usr/local/bin/postfix-policy-server.py"
+}
+
 install_systemd_service() {
     log_info "Installing systemd service..."
     
@@ -194,6 +215,7 @@ setup_sudo_permissions() {
     cat > "/etc/sudoers.d/$SERVICE_USER" << EOF
 # PostfixManager sudo permissions
 $SERVICE_USER ALL=(ALL) NOPASSWD: /bin/systemctl reload postfix
+$SERVICE_USER ALL=(ALL) NOPASSWD: /usr/sbin/postfix check
 EOF
     chmod 440 "/etc/sudoers.d/$SERVICE_USER"
     
@@ -256,6 +278,7 @@ main() {
     clone_repository
     install_python_deps
     setup_config_permissions
+    install_policy_server
     install_systemd_service
     setup_sudo_permissions
     start_service
@@ -0,0 +1,1093 @@
+import os
+import re
+import json
+import gzip
+import time
+import queue
+import base64
+import sqlite3
+import mmap
+import threading
+import multiprocessing
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+# Log reading helpers shared by the /api/logs endpoints. Files are read in
+# binary and only decoded once the wanted lines have been cut out, so a
+# multi-byte UTF-8 character is never split across a block boundary.
+
+TAIL_BLOCK_SIZE = 64 * 1024
+
+def decode_log_bytes(data):
+    """Decode raw log bytes, replacing anything that is not valid UTF-8"""
+    return data.decode('utf-8', errors='replace')
+
+def tail_bytes(f, count, block_size=TAIL_BLOCK_SIZE, end=None):
+    """Return the last count lines of a binary file object, reading backwards from the end"""
+    pos = f.seek(0, os.SEEK_END) if end is None else end
+    if count <= 0 or pos == 0:
+        return b''
+
+    # Read whole blocks backwards until enough line breaks have been seen to
+    # know where the first wanted line starts. A trailing newline ends the
+    # last line rather than starting a new one, so it is not counted.
+    blocks = []
+    newlines = 0
+    while pos > 0 and newlines < count:
+        size = min(block_size, pos)
+        pos -= size
+        f.seek(pos)
+        block = f.read(size)
+        if not blocks and block.endswith(b'\n'):
+            newlines -= 1
+        newlines += block.count(b'\n')
+        blocks.append(block)
+
+    data = b''.join(reversed(blocks))
+    start = len(data) - 1 if data.endswith(b'\n') else len(data)
+    for _ in range(count):
+        start = data.rfind(b'\n', 0, start)
+        if start < 0:
+            # Fewer lines than requested in the whole file
+            return data
+    return data[start + 1:]
+
+def tail_lines(path, count):
+    """Return the last count lines of a log file as text"""
+    with open(path, 'rb') as f:
+        return decode_log_bytes(tail_bytes(f, count))
+
+# Following reads at most this much new data per request; a client that has
+# fallen further behind is resynchronised from the tail instead
+FOLLOW_MAX_BYTES = 1024 * 1024
+
+def encode_cursor(values):
+    """Pack cursor values into an opaque URL-safe token"""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    """Unpack a token from encode_cursor, or None if it is missing or malformed"""
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, dict) else None
+
+def decode_log_position(token):
+    """Unpack a follow_log cursor into (inode, offset), or None if it is missing or malformed"""
+    values = decode_cursor(token)
+    if values is None:
+        return None
+    inode, offset = values.get('inode'), values.get('offset')
+    for value in (inode, offset):
+        # bool is an int too, but never a valid position
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            return None
+    return inode, offset
+
+def read_complete_lines(f, offset, max_bytes):
+    """Read whole lines from offset, returning (data, offset after the last complete line)"""
+    f.seek(offset)
+    data = f.read(max_bytes)
+    end = data.rfind(b'\n') + 1
+    if end == 0 and len(data) == max_bytes:
+        # A single line longer than max_bytes; hand it over in pieces
+        end = len(data)
+    return data[:end], offset + end
+
+def follow_log(path, cursor, count, max_bytes=FOLLOW_MAX_BYTES):
+    """Return (text, cursor token, reset) for the lines appended to a log since cursor
+
+    Without a usable cursor, or when the reader is too far behind, the last
+    count lines are returned with reset=True so the client replaces what it
+    shows. The cursor records the file's inode; after logrotate the rest of
+    the rotated file (path.1) is sent first and reading continues from the
+    start of the new file.
+    """
+    position = decode_log_position(cursor)
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        chunks = []
+        offset = None
+
+        if position and position[0] == st.st_ino:
+            offset = position[1]
+            if offset > st.st_size:
+                # Truncated in place (copytruncate)
+                offset = 0
+        elif position:
+            # Rotated: finish the old file if it is still around, then start
+            # the new one from the beginning
+            offset = 0
+            try:
+                with open(f"{path}.1", 'rb') as rotated:
+                    if os.fstat(rotated.fileno()).st_ino == position[0]:
+                        rotated.seek(position[1])
+                        chunks.append(rotated.read(max_bytes))
+            except OSError:
+                pass
+
+        if offset is None or st.st_size - offset > max_bytes:
+            data = tail_bytes(f, count, end=st.st_size)
+            # Leave a partial last line for the next poll
+            partial = len(data) - (data.rfind(b'\n') + 1)
+            data = data[:len(data) - partial]
+            offset = st.st_size - partial
+            return decode_log_bytes(data), encode_cursor({'inode': st.st_ino, 'offset': offset}), True
+
+        data, offset = read_complete_lines(f, offset, max_bytes)
+        chunks.append(data)
+        return decode_log_bytes(b''.join(chunks)), encode_cursor({'inode': st.st_ino, 'offset': offset}), False
+
+class LogSubscription:
+    """Bounded queue of (sequence, line) pairs for one consumer of a LogTailer; line is None for a reset"""
+    def __init__(self, max_size):
+        self.queue = queue.Queue(max_size)
+        self.dropped = 0
+
+    def offer(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # Slow consumer; drop rather than hold up the tailer
+            self.dropped += 1
+
+    def get_batch(self, timeout, max_items=500):
+        """Wait up to timeout for the next line, then take whatever else is already queued"""
+        batch = [self.queue.get(timeout=timeout)]
+        while len(batch) < max_items:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+class LogTailer:
+    """Single background reader that fans new log lines out to all subscribers
+
+    The file is polled with a short stat loop through follow_log, so it is
+    read once however many clients are watching. Each line gets a sequence
+    number and the most recent ones are kept so a reconnecting client can
+    resume from the last sequence it saw. When follow_log skips ahead to the
+    tail, a reset (line None) precedes the tail lines, so clients replace
+    what they show instead of appending to it.
+    """
+    def __init__(self, path, poll_interval=0.5, queue_size=1000, history_size=1000):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.history = deque(maxlen=history_size)
+        self.sequence = 0
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='log-tailer', daemon=True)
+                self.thread.start()
+
+    def subscribe(self, last_sequence=None, queue_size=None):
+        """Register a consumer, replaying retained lines after last_sequence"""
+        self.start()
+        subscription = LogSubscription(queue_size or self.queue_size)
+        with self.lock:
+            if last_sequence is not None:
+                for item in self.history:
+                    if item[0] > last_sequence:
+                        subscription.offer(item)
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def publish(self, lines, reset=False):
+        with self.lock:
+            for line in ([None] if reset else []) + lines:
+                self.sequence += 1
+                item = (self.sequence, line)
+                self.history.append(item)
+                for subscription in self.subscribers:
+                    subscription.offer(item)
+
+    def run(self):
+        cursor = None
+        resync = False
+        while True:
+            try:
+                text, new_cursor, reset = follow_log(self.path, cursor, self.history.maxlen)
+                # The first read only positions the cursor at the end of the
+                # file; after an error the tail is sent again as a reset
+                if (cursor is not None or resync) and (text or reset):
+                    self.publish(text.splitlines(), reset)
+                cursor = new_cursor
+                resync = False
+            except OSError:
+                # Missing or unreadable (e.g. mid-rotation); try again shortly
+                pass
+            except Exception:
+                cursor = None
+                resync = True
+            time.sleep(self.poll_interval)
+
+# Structured syslog line: timestamp (traditional 'Mon DD HH:MM:SS' or ISO
+# 8601, whose fraction and zone are not kept), host, service, optional PID,
+# then the Postfix queue ID (or NOQUEUE) when the line has one
+LINE_PATTERN = re.compile(
+    r'(?P<timestamp>\w{3}\s+\d{1,2}\s+\d{2}:\d{2}:\d{2}|\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})\S*\s+'
+    r'(?P<host>\S+)\s+(?P<service>[^\s\[:]+)(?:\[(?P<pid>\d+)\])?:\s+'
+    r'(?:(?P<queue_id>[0-9A-F]+|NOQUEUE):\s+)?(?P<message>.*)')
+
+# key=value and key=<value> fields (from, to, relay, delay, dsn, status, message-id, ...)
+FIELD_PATTERN = re.compile(r'(?<![\w-])([a-z][a-z_-]*)=(?:<([^>]*)>|([^,\s]*))')
+
+# Addresses quoted in reject messages, which may not be in a to= field
+REJECTION_EMAIL_PATTERN = re.compile(r'<([^@\s>]+@[^@\s>]+\.[^@\s>]+)>')
+
+# Trace entry details and the log fields they come from
+DETAIL_FIELDS = [('message_id', 'message-id'), ('from', 'from'), ('to', 'to'), ('status', 'status'),
+                 ('delay', 'delay'), ('dsn', 'dsn'), ('relay', 'relay')]
+
+LogRecord = namedtuple('LogRecord', ['timestamp', 'host', 'service', 'pid', 'queue_id', 'message', 'fields'])
+
+def parse_line(line):
+    """Parse a syslog line into a LogRecord in a single pass, or None if it is not one"""
+    match = LINE_PATTERN.match(line)
+    if not match:
+        return None
+    message = match.group('message')
+    fields = {}
+    for key, quoted, bare in FIELD_PATTERN.findall(message):
+        if key not in fields:
+            fields[key] = quoted or bare
+    return LogRecord(match.group('timestamp'), match.group('host'), match.group('service'),
+                     match.group('pid'), match.group('queue_id'), message, fields)
+
+def parse_postfix_line(line):
+    """Parse a Postfix line that carries a queue ID or NOQUEUE, or return None"""
+    if 'postfix/' not in line:
+        return None
+    record = parse_line(line)
+    if record is None or record.queue_id is None or 'postfix/' not in record.service:
+        return None
+    return record
+
+# Postfix delivery agents whose lines report a delivery attempt
+DELIVERY_SERVICES = {'smtp', 'lmtp', 'local', 'virtual', 'pipe'}
+
+def classify_record(record):
+    """Determine the trace entry type of a parsed Postfix line"""
+    # Service is 'postfix/smtpd', or e.g. 'postfix-out/smtp' for another instance
+    daemon = record.service.rsplit('/', 1)[-1]
+    status = record.fields.get('status')
+    if record.queue_id == 'NOQUEUE' and record.message.startswith(('reject:', 'milter-reject:')):
+        return 'rejection'
+    elif daemon == 'cleanup':
+        return 'message_accepted'
+    elif daemon == 'qmgr' and 'from' in record.fields:
+        return 'queue_manager'
+    elif daemon in DELIVERY_SERVICES and status == 'sent':
+        return 'delivery_sent'
+    elif daemon in DELIVERY_SERVICES:
+        return 'delivery_attempt'
+    elif daemon == 'smtpd':
+        return 'smtp_session'
+    elif daemon == 'bounce' or status == 'bounced':
+        return 'bounce'
+    elif daemon == 'error' or record.message.startswith(('error:', 'fatal:', 'panic:')):
+        return 'error'
+    return 'other'
+
+def normalize_message_id(message_id):
+    """Message-id as indexed and compared: without angle brackets, lowercased"""
+    return message_id.strip().strip('<>').strip().lower()
+
+def message_id_matches(message_id, found_id, prefix=False):
+    """True if a logged message-id is the one asked for, or with prefix=True starts with it"""
+    wanted = normalize_message_id(message_id)
+    found = normalize_message_id(found_id)
+    return found.startswith(wanted) if prefix else found == wanted
+
+def match_reasons(record, line, source_email, dest_email, message_id, message_id_prefix=False):
+    """Return why a parsed line matches the trace criteria (empty if it does not)"""
+    reasons = []
+    fields = record.fields
+    
+    # Check message ID (exact match, or prefix match, like the index lookup)
+    if message_id:
+        found_id = fields.get('message-id')
+        if found_id and message_id_matches(message_id, found_id, message_id_prefix):
+            reasons.append(f"Message-ID: {found_id}")
+    
+    # Check source email (exact match for precision)
+    if source_email:
+        found_from = fields.get('from')
+        if found_from is not None and source_email.lower() == found_from.lower():
+            reasons.append(f"From: {found_from}")
+    
+    # Check destination email (exact match for precision)
+    if dest_email:
+        found_to = fields.get('to')
+        if found_to is not None and dest_email.lower() == found_to.lower():
+            reasons.append(f"To: {found_to}")
+        else:
+            # Also check for emails in rejection messages (might not have to= format)
+            # Only exact match to prevent showing rejections for other users
+            for email in REJECTION_EMAIL_PATTERN.findall(line):
+                if dest_email.lower() == email.lower():
+                    reasons.append(f"Email in rejection: {email}")
+                    break
+    
+    return reasons
+
+def build_trace_entry(record, line, line_number, reasons):
+    """Build the trace entry for a matching log line"""
+    details = {}
+    for key, field in DETAIL_FIELDS:
+        if record.fields.get(field):
+            details[key] = record.fields[field]
+    rejection_email = REJECTION_EMAIL_PATTERN.search(line)
+    if rejection_email:
+        details['rejection_email'] = rejection_email.group(1)
+    
+    return {
+        'line_number': line_number,
+        'content': line,
+        'timestamp': record.timestamp,
+        'queue_id': record.queue_id,
+        'match_reasons': reasons or [f"Related to Queue-ID: {record.queue_id}"],
+        'details': details,
+        'type': classify_record(record)
+    }
+
+def index_keys(record, line):
+    """Return the (kind, lowercased value) pairs a trace can look a line up by"""
+    keys = []
+    fields = record.fields
+    if fields.get('message-id'):
+        keys.append(('message_id', normalize_message_id(fields['message-id'])))
+    if fields.get('from'):
+        keys.append(('from', fields['from'].lower()))
+    if fields.get('to'):
+        keys.append(('to', fields['to'].lower()))
+    if '@' in record.message:
+        for email in set(email.lower() for email in REJECTION_EMAIL_PATTERN.findall(line)):
+            keys.append(('email', email))
+    return keys
+
+# Leading syslog timestamp of a raw line, traditional or ISO 8601 (with
+# optional fraction and zone)
+TIMESTAMP_PATTERN = re.compile(
+    rb'(?:([A-Z][a-z]{2})\s+(\d{1,2})\s+(\d{2}):(\d{2}):(\d{2})'
+    rb'|(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.\d+)?(Z|[+-]\d{2}:?\d{2})?)')
+
+MONTHS = {name: number for number, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+
+COUNT_BLOCK_SIZE = 1024 * 1024
+
+def parse_log_timestamp(data, reference):
+    """Return the epoch time of a raw log line's leading timestamp, or None
+
+    Traditional timestamps have no year. They are placed in the year of
+    `reference` (the log's mtime) unless that would put them more than a
+    day after it, so December lines in a log written in January read as
+    the previous year.
+    """
+    match = TIMESTAMP_PATTERN.match(data)
+    if not match:
+        return None
+    try:
+        if match.group(1):
+            month = MONTHS.get(match.group(1).decode())
+            if month is None:
+                return None
+            day, hour, minute, second = (int(value) for value in match.group(2, 3, 4, 5))
+            when = datetime(reference.year, month, day, hour, minute, second)
+            if when > reference + timedelta(days=1):
+                when = when.replace(year=reference.year - 1)
+            return when.timestamp()
+
+        when = datetime(*(int(value) for value in match.group(6, 7, 8, 9, 10, 11)))
+        zone = match.group(12)
+        if zone is None:
+            return when.timestamp()
+        if zone == b'Z':
+            minutes = 0
+        else:
+            digits = zone[1:].replace(b':', b'')
+            minutes = int(digits[:2]) * 60 + int(digits[2:])
+            if zone.startswith(b'-'):
+                minutes = -minutes
+        return when.replace(tzinfo=timezone(timedelta(minutes=minutes))).timestamp()
+    except ValueError:
+        return None
+
+def line_time_after(f, offset, end, reference):
+    """Return (offset, time) of the first timestamped line starting at or after offset
+
+    Returns (end, None) when no timestamped line starts before end.
+    """
+    if offset > 0:
+        # Finish the line that offset falls inside
+        f.seek(offset - 1)
+        offset += len(f.readline()) - 1
+    else:
+        f.seek(0)
+    while offset < end:
+        line = f.readline()
+        if not line:
+            break
+        when = parse_log_timestamp(line[:64], reference)
+        if when is not None:
+            return offset, when
+        offset += len(line)
+    return end, None
+
+def bisect_log_time(f, target, reference, end, after=False):
+    """Return the offset of the first line timestamped at or after target
+
+    With after=True the line must be strictly after target, which gives the
+    exclusive end of an inclusive `until`. Assumes the log is in time order.
+    """
+    low, high = 0, end
+    while low < high:
+        middle = (low + high) // 2
+        start, when = line_time_after(f, middle, end, reference)
+        if when is None or (when > target if after else when >= target):
+            high = middle
+        else:
+            # Every position up to start resolves to the same line
+            low = start + 1
+    return line_time_after(f, low, end, reference)[0]
+
+def log_time_window(f, since=None, until=None):
+    """Return the (start, end) byte offsets of the lines between since and until (epoch seconds)"""
+    st = os.fstat(f.fileno())
+    reference = datetime.fromtimestamp(st.st_mtime)
+    start = 0 if since is None else bisect_log_time(f, since, reference, st.st_size)
+    end = st.st_size if until is None else bisect_log_time(f, until, reference, st.st_size, after=True)
+    return start, max(start, end)
+
+def count_lines(f, start, end):
+    """Count the newlines between two byte offsets of an open log"""
+    f.seek(start)
+    count = 0
+    remaining = end - start
+    while remaining > 0:
+        block = f.read(min(COUNT_BLOCK_SIZE, remaining))
+        if not block:
+            break
+        count += block.count(b'\n')
+        remaining -= len(block)
+    return count
+
+class MailLogIndex:
+    """Incremental on-disk index of mail.log lines by queue ID, message-id and address
+
+    Rows map each lookup key and each queue ID to the byte offset and line
+    number of the lines that carry it, and checkpoints record the line
+    number at regular offsets so any offset can be numbered without reading
+    the log from the start. The index remembers the inode and offset it has
+    reached and only parses what has been appended since; a rotated or
+    truncated log is indexed again from the start.
+    """
+    CHUNK_SIZE = 8 * 1024 * 1024
+    CHECKPOINT_INTERVAL = 1024 * 1024
+
+    def __init__(self, log_path, db_path):
+        self.log_path = log_path
+        self.db_path = db_path
+        self.db = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # Opened on first use so importing the app has no side effects
+        if self.db is not None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+        except (OSError, sqlite3.Error):
+            # Not writable: keep the index in memory for the life of the process
+            db = sqlite3.connect(':memory:', check_same_thread=False)
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript('''
+            CREATE TABLE IF NOT EXISTS state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                inode INTEGER, offset INTEGER, line_number INTEGER);
+            CREATE TABLE IF NOT EXISTS queue_lines (
+                queue_id TEXT, offset INTEGER, line_number INTEGER,
+                PRIMARY KEY (queue_id, offset)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS keys (
+                kind TEXT, value TEXT, offset INTEGER, line_number INTEGER, queue_id TEXT,
+                PRIMARY KEY (kind, value, offset)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                offset INTEGER PRIMARY KEY, line_number INTEGER);
+        ''')
+        self.db = db
+
+    def _state(self):
+        row = self.db.execute('SELECT inode, offset, line_number FROM state WHERE id = 1').fetchone()
+        return row or (None, 0, 0)
+
+    def _reset(self, inode):
+        self.db.execute('DELETE FROM queue_lines')
+        self.db.execute('DELETE FROM keys')
+        self.db.execute('DELETE FROM checkpoints')
+        self.db.execute('INSERT OR REPLACE INTO state VALUES (1, ?, 0, 0)', (inode,))
+
+    def update(self):
+        """Index everything appended to the log since the last update"""
+        with self.lock, open(self.log_path, 'rb') as f:
+            self._update(f)
+
+    def _update(self, f):
+        # Index the open log `f` up to its current end; the caller holds the
+        # lock. A different inode than the indexed one starts a new index.
+        self._connect()
+        st = os.fstat(f.fileno())
+        inode, offset, line_number = self._state()
+        if inode != st.st_ino or offset > st.st_size:
+            with self.db:
+                self._reset(st.st_ino)
+            offset, line_number = 0, 0
+
+        while offset < st.st_size:
+            data, end = read_complete_lines(f, offset, self.CHUNK_SIZE)
+            if not data:
+                break
+            queue_rows = []
+            key_rows = []
+            checkpoint_rows = []
+            next_checkpoint = offset
+            line_offset = offset
+            raw_lines = data.split(b'\n')
+            if not raw_lines[-1]:
+                raw_lines.pop()
+            for raw in raw_lines:
+                if line_offset >= next_checkpoint:
+                    checkpoint_rows.append((line_offset, line_number))
+                    next_checkpoint = line_offset + self.CHECKPOINT_INTERVAL
+                line_number += 1
+                if b'postfix/' in raw:
+                    line = decode_log_bytes(raw)
+                    record = parse_postfix_line(line)
+                    if record:
+                        queue_id = record.queue_id
+                        if queue_id != 'NOQUEUE':
+                            queue_rows.append((queue_id, line_offset, line_number))
+                        for kind, value in index_keys(record, line):
+                            key_rows.append((kind, value, line_offset, line_number, queue_id))
+                line_offset += len(raw) + 1
+
+            # One transaction per chunk keeps the index consistent with
+            # the recorded offset if the process stops part way
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO queue_lines VALUES (?, ?, ?)', queue_rows)
+                self.db.executemany('INSERT OR IGNORE INTO keys VALUES (?, ?, ?, ?, ?)', key_rows)
+                self.db.executemany('INSERT OR IGNORE INTO checkpoints VALUES (?, ?)', checkpoint_rows)
+                self.db.execute('UPDATE state SET offset = ?, line_number = ? WHERE id = 1', (end, line_number))
+            offset = end
+
+    def line_number_at(self, f, offset):
+        """Return how many lines precede a byte offset of the open log `f`"""
+        with self.lock:
+            self._connect()
+            inode, indexed_offset, line_number = self._state()
+            base, count = 0, 0
+            if inode == os.fstat(f.fileno()).st_ino:
+                if offset == indexed_offset:
+                    return line_number
+                row = self.db.execute('SELECT offset, line_number FROM checkpoints WHERE offset <= ? '
+                                      'ORDER BY offset DESC LIMIT 1', (offset,)).fetchone()
+                if row:
+                    base, count = row
+        return count + count_lines(f, base, offset)
+
+    def trace(self, source_email='', dest_email='', message_id='', since=None, until=None, message_id_prefix=False):
+        """Return (entries in log order, queue IDs of the directly matching lines)
+
+        since/until (epoch seconds) limit the trace to the lines logged in
+        that window, found by bisecting the log on its timestamps. With
+        message_id_prefix, message_id matches every message-id starting
+        with it rather than only itself.
+        """
+        entries, queue_ids = self.iter_trace(source_email, dest_email, message_id, since, until, message_id_prefix)
+        return list(entries), queue_ids
+
+    def iter_trace(self, source_email='', dest_email='', message_id='', since=None, until=None,
+                   message_id_prefix=False):
+        """Like trace(), but the entries are a generator reading each line as it is consumed"""
+        lookup = self.lookup(source_email, dest_email, message_id, since, until, message_id_prefix)
+        return lookup.entries(), lookup.queue_ids
+
+    def lookup(self, source_email='', dest_email='', message_id='', since=None, until=None, message_id_prefix=False):
+        """Find the lines matching a trace in the index; returns an IndexedTrace to read them from"""
+        f = open(self.log_path, 'rb')
+        try:
+            # Index and look up through the same open file, so a rotation
+            # can't pair the offsets with a different log
+            with self.lock:
+                self._update(f)
+                start, end = log_time_window(f, since, until)
+                window = ' AND offset >= ? AND offset < ?'
+                hits = []
+                if message_id and message_id_prefix:
+                    # A range scan of the primary key; U+10FFFF sorts after
+                    # every character that can follow the prefix
+                    value = normalize_message_id(message_id)
+                    hits += self.db.execute(
+                        "SELECT offset, line_number, queue_id FROM keys WHERE kind = 'message_id' "
+                        "AND value >= ? AND value < ?" + window, (value, value + '\U0010ffff', start, end)).fetchall()
+                elif message_id:
+                    hits += self.db.execute(
+                        "SELECT offset, line_number, queue_id FROM keys WHERE kind = 'message_id' AND value = ?"
+                        + window, (normalize_message_id(message_id), start, end)).fetchall()
+                if source_email:
+                    hits += self.db.execute(
+                        "SELECT offset, line_number, queue_id FROM keys WHERE kind = 'from' AND value = ?" + window,
+                        (source_email.lower(), start, end)).fetchall()
+                if dest_email:
+                    hits += self.db.execute(
+                        "SELECT offset, line_number, queue_id FROM keys WHERE kind IN ('to', 'email') AND value = ?"
+                        + window, (dest_email.lower(), start, end)).fetchall()
+
+                queue_ids = {queue_id for offset, line_number, queue_id in hits}
+                lines = {offset: (line_number, queue_id) for offset, line_number, queue_id in hits}
+                lines.update(self._queue_lines(queue_ids, start, end))
+        except BaseException:
+            f.close()
+            raise
+        return IndexedTrace(self, f, (start, end), lines, queue_ids,
+                            (source_email, dest_email, message_id, message_id_prefix))
+
+    def _queue_lines(self, queue_ids, start, end):
+        # {offset: (line number, queue ID)} of the indexed lines of these
+        # queue IDs in the window; the caller holds the lock
+        lines = {}
+        for queue_id in set(queue_ids) - {'NOQUEUE'}:
+            for offset, line_number in self.db.execute(
+                    'SELECT offset, line_number FROM queue_lines WHERE queue_id = ? AND offset >= ? AND offset < ?',
+                    (queue_id, start, end)):
+                lines[offset] = (line_number, queue_id)
+        return lines
+
+    def start_updater(self, interval=60):
+        """Keep the index current in the background so traces rarely wait for it"""
+        def run():
+            while True:
+                try:
+                    self.update()
+                except Exception:
+                    pass
+                time.sleep(interval)
+        thread = threading.Thread(target=run, name='maillog-index', daemon=True)
+        thread.start()
+        return thread
+
+class IndexedTrace:
+    """Lines of the indexed log that match a trace, read when entries() is consumed
+
+    queue_ids are the queue IDs of the directly matching lines. The open
+    file keeps the offsets valid even if mail.log is rotated before the
+    entries are read.
+    """
+
+    def __init__(self, index, f, window, lines, queue_ids, criteria):
+        self.index = index
+        self.f = f
+        self.window = window
+        self.lines = lines
+        self.queue_ids = queue_ids
+        self.criteria = criteria
+
+    def close(self):
+        """Release the log file when the entries will not be read"""
+        self.f.close()
+
+    def entries(self, carried=()):
+        """Yield the trace entries in log order
+
+        carried are queue IDs matched in the previous log that were still
+        queued when it was rotated; their lines here are included up to the
+        one logging the queue file as removed, after which the ID may be
+        reused.
+        """
+        lines = self.lines
+        carried = set(carried) - self.queue_ids
+        if carried:
+            with self.index.lock:
+                inode = self.index._state()[0]
+                # Only if the index still describes this file
+                if inode == os.fstat(self.f.fileno()).st_ino:
+                    lines = {**self.index._queue_lines(carried, *self.window), **lines}
+        with self.f as f:
+            for offset in sorted(lines):
+                line_number, queue_id = lines[offset]
+                if queue_id not in self.queue_ids and queue_id not in carried:
+                    continue
+                f.seek(offset)
+                line = decode_log_bytes(f.readline()).rstrip('\n')
+                record = parse_postfix_line(line)
+                if record is None:
+                    continue
+                reasons = match_reasons(record, line, *self.criteria)
+                entry = build_trace_entry(record, line, line_number, reasons)
+                entry['file'] = self.index.log_path
+                yield entry
+                if queue_id in carried and record.message == 'removed':
+                    carried.discard(queue_id)
+
+# Rotated logs. logrotate leaves mail.log.1 plain (delaycompress) and
+# mail.log.2.gz onwards compressed; searches and traces that include them
+# scan each file in a shared process pool, newest file in-process.
+
+LOG_WORKERS = os.cpu_count() or 1
+
+log_pool_executor = None
+log_pool_lock = threading.Lock()
+
+def log_pool():
+    """Return the shared process pool used to scan rotated logs"""
+    global log_pool_executor
+    with log_pool_lock:
+        if log_pool_executor is None:
+            # spawn rather than fork: the web server's threads may hold locks
+            log_pool_executor = ProcessPoolExecutor(max_workers=LOG_WORKERS,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+        return log_pool_executor
+
+def rotated_logs(path):
+    """Return the rotations of a log (path.N, path.N.gz), oldest first, excluding path itself"""
+    directory, name = os.path.split(path)
+    pattern = re.compile(re.escape(name) + r'\.(\d+)(\.gz)?$')
+    rotations = []
+    try:
+        for entry in os.listdir(directory or '.'):
+            match = pattern.match(entry)
+            if match:
+                rotations.append((int(match.group(1)), os.path.join(directory, entry)))
+    except OSError:
+        return []
+    return [rotation for number, rotation in sorted(rotations, reverse=True)]
+
+def open_log(path):
+    """Open a plain or gzip-compressed log for binary reading"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def log_may_overlap(path, since=None):
+    """Return False if a log was last written before since, so it has nothing in the window"""
+    try:
+        return since is None or os.stat(path).st_mtime >= since
+    except OSError:
+        return False
+
+def window_lines(path, since=None, until=None):
+    """Yield (line_number, raw line) for the lines of a log between since and until
+
+    Plain files are bisected on their timestamps; gzip streams are read from
+    the start, skipping lines before since and stopping after until.
+    """
+    reference = datetime.fromtimestamp(os.stat(path).st_mtime)
+    with open_log(path) as f:
+        if path.endswith('.gz'):
+            start, end = 0, None
+            line_number = 0
+        else:
+            start, end = log_time_window(f, since, until)
+            line_number = count_lines(f, 0, start) if start else 0
+            f.seek(start)
+        offset = start
+        started = end is not None or since is None
+        for raw in f:
+            if end is not None:
+                if offset >= end:
+                    break
+                offset += len(raw)
+            line_number += 1
+            if end is None and (not started or until is not None):
+                when = parse_log_timestamp(raw[:64], reference)
+                if when is not None:
+                    if until is not None and when > until:
+                        break
+                    if not started and when >= since:
+                        started = True
+                if not started:
+                    continue
+            yield line_number, raw
+
+SEARCH_CHUNK_SIZE = 8 * 1024 * 1024
+
+class LogQuery:
+    """A search over raw log bytes for one or more terms
+
+    Terms are literal text or, with regex=True, regular expressions (with ^
+    and $ anchored at line boundaries). A line matches when it contains all
+    of the terms (match_all) or any of them. Case-insensitive text is found
+    with bytes.find in a lowercased copy of each block, which only folds
+    ASCII letters.
+    """
+
+    def __init__(self, terms, regex=False, case_sensitive=False, match_all=False):
+        self.terms = list(terms)
+        self.regex = regex
+        self.case_sensitive = case_sensitive
+        self.match_all = match_all and len(self.terms) > 1
+        if regex:
+            flags = re.MULTILINE if case_sensitive else re.MULTILINE | re.IGNORECASE
+            # re.error for an invalid expression is left to the caller
+            self.needles = [re.compile(term.encode(), flags) for term in self.terms]
+        else:
+            self.needles = [(term if case_sensitive else term.lower()).encode() for term in self.terms]
+        if self.match_all:
+            # Look for the longest (usually rarest) text and check the rest per line
+            primary = max(range(len(self.needles)), key=lambda i: 0 if regex else len(self.needles[i]))
+            self.primary = [self.needles[primary]]
+            self.others = self.needles[:primary] + self.needles[primary + 1:]
+        else:
+            self.primary = self.needles
+            self.others = []
+
+    def _find(self, needle, hay, position):
+        if self.regex:
+            match = needle.search(hay, position)
+            return match.start() if match else -1
+        return hay.find(needle, position)
+
+    def _in_line(self, needle, hay, start, end):
+        if self.regex:
+            return needle.search(hay, start, end) is not None
+        return hay.find(needle, start, end) >= 0
+
+    def find_lines(self, data):
+        """Yield the (start, end) offsets of each matching line in a block of whole lines"""
+        hay = data if self.regex or self.case_sensitive else data.lower()
+        size = len(hay)
+        # Next hit of each primary term, refreshed only once passed
+        hits = [self._find(needle, hay, 0) for needle in self.primary]
+        position = 0
+        while position < size:
+            for i, needle in enumerate(self.primary):
+                if 0 <= hits[i] < position:
+                    hits[i] = self._find(needle, hay, position)
+            live = [hit for hit in hits if hit >= 0]
+            if not live:
+                return
+            hit = min(live)
+            start = hay.rfind(b'\n', 0, hit) + 1
+            end = hay.find(b'\n', hit)
+            if end < 0:
+                end = size
+            # A regex hit may run past the end of its line, so recheck it
+            if self.regex and not any(self._in_line(needle, hay, start, end) for needle in self.primary):
+                position = hit + 1
+                continue
+            if all(self._in_line(needle, hay, start, end) for needle in self.others):
+                yield start, end
+            position = end + 1
+
+def iter_line_chunks(f, start, end=None, chunk_size=SEARCH_CHUNK_SIZE):
+    """Yield (offset, data) blocks of whole lines from start up to end (or the end of the file)
+
+    Plain files are memory-mapped so each block is a single copy out of the
+    page cache; gzip streams are decompressed a block at a time, with end
+    counted in decompressed bytes.
+    """
+    if not isinstance(f, gzip.GzipFile):
+        size = os.fstat(f.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            offset = start
+            while offset < end:
+                cut = offset + chunk_size
+                if cut < end:
+                    newline = mapped.rfind(b'\n', offset, cut)
+                    if newline < 0:
+                        # A line longer than the block; take all of it
+                        newline = mapped.find(b'\n', cut, end)
+                    cut = end if newline < 0 else newline + 1
+                else:
+                    cut = end
+                yield offset, mapped[offset:cut]
+                offset = cut
+        return
+
+    f.seek(start)
+    offset = start
+    carry = b''
+    while end is None or offset < end:
+        block = f.read(chunk_size)
+        if not block:
+            break
+        data = carry + block if carry else block
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            carry = data
+            continue
+        if end is not None:
+            cut = min(cut, end - offset)
+        yield offset, data[:cut] if cut < len(data) else data
+        offset += cut
+        carry = data[cut:]
+    if carry and (end is None or offset < end):
+        yield offset, carry if end is None else carry[:end - offset]
+
+def search_file(path, query, max_results, since=None, until=None, resume=None, count=False, line_number_at=None,
+                stop=None):
+    """Search one plain or gzip log, returning (matches, total matching lines or None)
+
+    Stops at max_results unless count is set, in which case the rest of the
+    file is scanned only to count matching lines. resume=(offset, line
+    number) continues after the line at that offset, as left by a previous
+    page. Plain logs are bisected to the since/until window; in a gzip log,
+    blocks and hit lines outside the window are skipped by their timestamps.
+    line_number_at(f, offset) numbers the first line of a bisected window;
+    without it the preceding newlines are counted. stop=offset ends the
+    search after the line at that offset, e.g. to count the matches on
+    the pages before a cursor.
+    """
+    matches = []
+    total = 0
+    compressed = path.endswith('.gz')
+    reference = datetime.fromtimestamp(os.stat(path).st_mtime)
+    with open_log(path) as f:
+        if compressed:
+            start, end = 0, None
+        else:
+            start, end = log_time_window(f, since, until)
+        if resume:
+            offset, line_number = resume
+            if offset >= start:
+                f.seek(offset)
+                start = offset + len(f.readline())
+            else:
+                resume = None
+        if stop is not None:
+            f.seek(stop)
+            stop += len(f.readline())
+            end = stop if end is None else min(end, stop)
+        if not resume:
+            if not start:
+                line_number = 0
+            elif line_number_at:
+                line_number = line_number_at(f, start)
+            else:
+                line_number = count_lines(f, 0, start)
+
+        windowed = compressed and (since is not None or until is not None)
+        inside = since is None
+        for base, data in iter_line_chunks(f, start, end):
+            if windowed:
+                first = parse_log_timestamp(data[:64], reference)
+                if until is not None and first is not None and first > until:
+                    break
+                last = parse_log_timestamp(data[data.rfind(b'\n', 0, len(data) - 1) + 1:][:64], reference)
+                if since is not None and last is not None and last < since:
+                    line_number += data.count(b'\n')
+                    continue
+            position = 0
+            for line_start, line_end in query.find_lines(data):
+                # Line numbers are only needed while the page is filling
+                if len(matches) < max_results:
+                    line_number += data.count(b'\n', position, line_start)
+                    position = line_start
+                if windowed:
+                    when = parse_log_timestamp(data[line_start:line_start + 64], reference)
+                    if when is not None:
+                        if until is not None and when > until:
+                            return matches, total if count else None
+                        inside = since is None or when >= since
+                    if not inside:
+                        continue
+                total += 1
+                if len(matches) < max_results:
+                    matches.append({
+                        'line_number': line_number + 1,
+                        'content': decode_log_bytes(data[line_start:line_end]),
+                        'file': path,
+                        'offset': base + line_start
+                    })
+                    if len(matches) >= max_results and not count:
+                        return matches, None
+            if len(matches) < max_results:
+                line_number += data.count(b'\n', position)
+    return matches, total if count else None
+
+def trace_file(path, source_email='', dest_email='', message_id='', since=None, until=None, message_id_prefix=False):
+    """Trace messages through one log without the index: (entries in log order, matching queue IDs, in flight)
+
+    Lines of a queue ID are held back until one of them matches, and dropped
+    when Postfix logs the queue file as removed, so memory stays bounded by
+    the messages in flight rather than the size of the log. In flight maps
+    each queue ID still queued at the end of the log to the entries of its
+    held lines (none for matched ones), so a trace can follow it into the
+    next log.
+    """
+    entries = []
+    queue_ids = set()
+    matched = set()
+    pending = {}
+    for line_number, raw in window_lines(path, since, until):
+        if b'postfix/' not in raw:
+            continue
+        line = decode_log_bytes(raw).rstrip('\n')
+        record = parse_postfix_line(line)
+        if record is None:
+            continue
+        queue_id = record.queue_id
+        reasons = match_reasons(record, line, source_email, dest_email, message_id, message_id_prefix)
+        if reasons:
+            queue_ids.add(queue_id)
+            if queue_id != 'NOQUEUE' and queue_id not in matched:
+                matched.add(queue_id)
+                for held in pending.pop(queue_id, []):
+                    entries.append(build_trace_entry(*held, []))
+            entries.append(build_trace_entry(record, line, line_number, reasons))
+        elif queue_id in matched:
+            entries.append(build_trace_entry(record, line, line_number, []))
+        elif queue_id != 'NOQUEUE':
+            pending.setdefault(queue_id, []).append((record, line, line_number))
+        if record.message == 'removed':
+            # Queue IDs are reused once the queue file is gone
+            pending.pop(queue_id, None)
+            matched.discard(queue_id)
+    in_flight = {queue_id: [build_trace_entry(*held, []) for held in lines] for queue_id, lines in pending.items()}
+    in_flight.update((queue_id, []) for queue_id in matched)
+    for entry in entries + [entry for held in in_flight.values() for entry in held]:
+        entry['file'] = path
+    entries.sort(key=lambda entry: entry['line_number'])
+    return entries, queue_ids, in_flight
+
+def join_rotation(entries, queue_ids, in_flight, next_queue_ids):
+    """Join a rotated log's trace to the next log's: (its entries with the held lines of queue IDs the next log matched, queue IDs to carry into the next log)"""
+    held = [entry for queue_id in next_queue_ids & in_flight.keys() for entry in in_flight[queue_id]]
+    if held:
+        entries = sorted(entries + held, key=lambda entry: entry['line_number'])
+    return entries, queue_ids & in_flight.keys()
+
+def collect_in_order(futures, limit=None, count=len):
+    """Yield the results of per-file futures in submission order
+
+    Once limit items (measured with count) have been yielded, the files
+    that have not started yet are cancelled.
+    """
+    total = 0
+    for future in futures:
+        if limit is not None and total >= limit:
+            future.cancel()
+            continue
+        result = future.result()
+        total += count(result)
+        yield result
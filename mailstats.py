@@ -0,0 +1,406 @@
+import os
+import re
+import json
+import math
+import heapq
+import time
+import threading
+from collections import Counter
+from datetime import datetime
+
+from maillog import read_complete_lines, log_time_window, parse_log_timestamp, parse_postfix_line
+
+# Rolling mail traffic statistics for the dashboard. A background thread
+# follows mail.log with the structured parser and folds each line into
+# per-minute counters and delay sketches plus hourly heavy-hitter sketches,
+# so /api/stats answers from a bounded amount of memory however large the
+# log is.
+
+STATUSES = ('sent', 'deferred', 'bounced', 'rejected')
+
+# Relative accuracy of the delay percentiles
+QUANTILE_ACCURACY = 0.02
+QUANTILE_GAMMA = (1 + QUANTILE_ACCURACY) / (1 - QUANTILE_ACCURACY)
+QUANTILE_LOG_GAMMA = math.log(QUANTILE_GAMMA)
+# Delays at or below this (seconds) share one bucket
+QUANTILE_MIN_VALUE = 0.001
+
+# Client of an smtpd line: "host[address]"
+CLIENT_PATTERN = re.compile(r'\[([^\]]+)\]')
+# Client of a reject line: "RCPT from host[address]:"
+REJECT_CLIENT_PATTERN = re.compile(r' from [^\s\[]*\[([^\]]+)\]')
+
+class HeavyHitters:
+    """Space-Saving top-k counter that tracks at most `capacity` keys
+
+    When a new key arrives and the table is full it replaces the key with
+    the smallest count and inherits that count as its error, so a reported
+    count overestimates the true one by at most its error.
+
+    The smallest count is found through a min-heap with one (count, key)
+    entry per key. Counts only grow, so an increment leaves the key's entry
+    as it is; entries that have fallen behind are refreshed when they reach
+    the top, which keeps adding a key O(log capacity) amortized.
+    """
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+
+    def add(self, key, weight=1):
+        if key in self.counts:
+            self.counts[key] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = weight
+            self.errors[key] = 0
+            heapq.heappush(self.heap, (weight, key))
+        else:
+            while True:
+                count, victim = self.heap[0]
+                if count == self.counts[victim]:
+                    break
+                heapq.heapreplace(self.heap, (self.counts[victim], victim))
+            floor = self.counts.pop(victim)
+            del self.errors[victim]
+            self.counts[key] = floor + weight
+            self.errors[key] = floor
+            heapq.heapreplace(self.heap, (floor + weight, key))
+
+    def to_dict(self):
+        return {'counts': self.counts, 'errors': self.errors}
+
+    @classmethod
+    def from_dict(cls, data, capacity=100):
+        sketch = cls(capacity)
+        sketch.counts = dict(data.get('counts', {}))
+        sketch.errors = {key: data.get('errors', {}).get(key, 0) for key in sketch.counts}
+        sketch.heap = [(count, key) for key, count in sketch.counts.items()]
+        heapq.heapify(sketch.heap)
+        return sketch
+
+def merge_top(sketches, count):
+    """Combine heavy-hitter sketches and return the top `count` as [{'value', 'count', 'error'}]"""
+    counts = Counter()
+    errors = Counter()
+    for sketch in sketches:
+        counts.update(sketch.counts)
+        errors.update(sketch.errors)
+    return [{'value': key, 'count': total, 'error': errors[key]} for key, total in counts.most_common(count)]
+
+class QuantileSketch:
+    """Mergeable log-bucketed quantile sketch (relative error QUANTILE_ACCURACY)
+
+    Each value lands in bucket ceil(log_gamma(value)), so every bucket spans
+    a fixed ratio and the sketch of a day of delays stays a few hundred
+    integers however many messages were delivered.
+    """
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+
+    def add(self, value):
+        if value <= QUANTILE_MIN_VALUE:
+            index = 0
+        else:
+            index = max(1, math.ceil(math.log(value / QUANTILE_MIN_VALUE) / QUANTILE_LOG_GAMMA))
+        self.buckets[index] += 1
+        self.count += 1
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+
+    def quantile(self, q):
+        """Return the value at quantile q (0..1), or None if the sketch is empty"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                if index == 0:
+                    return 0.0
+                # Midpoint of the bucket, in relative terms
+                return QUANTILE_MIN_VALUE * 2 * QUANTILE_GAMMA ** index / (QUANTILE_GAMMA + 1)
+        return None
+
+    def to_dict(self):
+        return {str(index): count for index, count in self.buckets.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls()
+        for index, count in data.items():
+            sketch.buckets[int(index)] = count
+            sketch.count += count
+        return sketch
+
+class MinuteStats:
+    """Delivery counts and delay sketch for one minute"""
+    __slots__ = ('counts', 'delays')
+
+    def __init__(self):
+        self.counts = dict.fromkeys(STATUSES, 0)
+        self.delays = QuantileSketch()
+
+class HourStats:
+    """Heavy-hitter sketches for one hour"""
+    __slots__ = ('senders', 'recipients', 'client_ips', 'rejected_client_ips')
+
+    def __init__(self, capacity):
+        self.senders = HeavyHitters(capacity)
+        self.recipients = HeavyHitters(capacity)
+        self.client_ips = HeavyHitters(capacity)
+        self.rejected_client_ips = HeavyHitters(capacity)
+
+class MailStats:
+    """Background aggregator of mail.log into rolling per-minute statistics
+
+    Keeps `retention_minutes` of per-minute counters and delay sketches and
+    the matching hours of heavy-hitter sketches. It follows the log by inode
+    and offset, finishing a rotated file from mail.log.1 before moving on,
+    and writes a compact snapshot (aggregates plus position) every
+    `snapshot_interval` seconds so a restart carries on where it stopped
+    instead of re-reading the log.
+    """
+    CHUNK_SIZE = 4 * 1024 * 1024
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, log_path, snapshot_path, retention_minutes=1440, capacity=100,
+                 poll_interval=2, snapshot_interval=60):
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+        self.retention_minutes = retention_minutes
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.snapshot_interval = snapshot_interval
+        self.minutes = {}
+        self.hours = {}
+        self.inode = None
+        self.offset = 0
+        self.lines = 0
+        self.updated = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='mail-stats', daemon=True)
+                self.thread.start()
+
+    # Ingestion
+
+    def _hour(self, minute):
+        hour = minute - minute % 3600
+        stats = self.hours.get(hour)
+        if stats is None:
+            stats = self.hours[hour] = HourStats(self.capacity)
+        return stats
+
+    def ingest(self, data, reference, now):
+        """Fold a block of raw log lines into the aggregates"""
+        oldest = now - self.retention_minutes * 60
+        current = None
+        for raw in data.splitlines():
+            if b'postfix/' not in raw:
+                continue
+            when = parse_log_timestamp(raw[:64], reference)
+            if when is None or when < oldest:
+                continue
+            line = raw.decode('utf-8', errors='replace')
+            record = parse_postfix_line(line)
+            if record is None:
+                continue
+            minute = int(min(when, now)) // 60 * 60
+            if current is None or current[0] != minute:
+                stats = self.minutes.get(minute)
+                if stats is None:
+                    stats = self.minutes[minute] = MinuteStats()
+                current = (minute, stats, self._hour(minute))
+            self._count(record, current[1], current[2])
+            self.lines += 1
+
+    def _count(self, record, minute, hour):
+        fields = record.fields
+        message = record.message
+        status = fields.get('status')
+        if status in ('sent', 'deferred', 'bounced'):
+            minute.counts[status] += 1
+            if fields.get('to'):
+                hour.recipients.add(fields['to'].lower())
+            if status == 'sent' and fields.get('delay'):
+                try:
+                    minute.delays.add(float(fields['delay']))
+                except ValueError:
+                    pass
+        elif message.startswith(('reject:', 'milter-reject:')):
+            minute.counts['rejected'] += 1
+            client = REJECT_CLIENT_PATTERN.search(message)
+            if client:
+                hour.rejected_client_ips.add(client.group(1))
+        elif 'client' in fields and record.service.endswith('smtpd'):
+            client = CLIENT_PATTERN.search(fields['client'])
+            if client:
+                hour.client_ips.add(client.group(1))
+        elif 'nrcpt' in fields and fields.get('from') is not None:
+            # qmgr logs each queued message once with its envelope sender
+            hour.senders.add(fields['from'].lower() or '<>')
+
+    def _expire(self, now):
+        oldest = now - self.retention_minutes * 60
+        for minute in [minute for minute in self.minutes if minute < oldest - 60]:
+            del self.minutes[minute]
+        for hour in [hour for hour in self.hours if hour < oldest - 3600]:
+            del self.hours[hour]
+
+    def _read(self, f, start, now):
+        reference = datetime.fromtimestamp(os.fstat(f.fileno()).st_mtime)
+        offset = start
+        while True:
+            data, end = read_complete_lines(f, offset, self.CHUNK_SIZE)
+            if not data:
+                return offset
+            with self.lock:
+                self.ingest(data, reference, now)
+            offset = end
+
+    def update(self):
+        """Ingest whatever has been appended to the log since the last update"""
+        now = time.time()
+        with open(self.log_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if self.inode is None:
+                # First run without a snapshot: backfill the retention window
+                start, _ = log_time_window(f, now - self.retention_minutes * 60)
+            elif st.st_ino != self.inode:
+                self._finish_rotated(now)
+                start = 0
+            elif st.st_size < self.offset:
+                start = 0
+            else:
+                start = self.offset
+            offset = self._read(f, start, now)
+        with self.lock:
+            self.inode, self.offset = st.st_ino, offset
+            self._expire(now)
+            self.updated = now
+
+    def _finish_rotated(self, now):
+        # logrotate renamed the file we were reading; read what it gained
+        # after our last update before starting on the new mail.log
+        try:
+            with open(self.log_path + '.1', 'rb') as f:
+                if os.fstat(f.fileno()).st_ino == self.inode:
+                    self._read(f, self.offset, now)
+        except OSError:
+            pass
+
+    def run(self):
+        self.load_snapshot()
+        last_snapshot = time.time()
+        while True:
+            try:
+                self.update()
+            except Exception:
+                # Missing or unreadable (e.g. mid-rotation); try again shortly
+                pass
+            if time.time() - last_snapshot >= self.snapshot_interval:
+                try:
+                    self.save_snapshot()
+                except Exception:
+                    pass
+                last_snapshot = time.time()
+            time.sleep(self.poll_interval)
+
+    # Snapshots
+
+    def save_snapshot(self):
+        """Atomically write the aggregates and log position to the snapshot file"""
+        with self.lock:
+            data = {
+                'version': self.SNAPSHOT_VERSION,
+                'inode': self.inode,
+                'offset': self.offset,
+                'lines': self.lines,
+                'minutes': {minute: [stats.counts[status] for status in STATUSES] + [stats.delays.to_dict()]
+                            for minute, stats in self.minutes.items()},
+                'hours': {hour: {name: getattr(stats, name).to_dict() for name in HourStats.__slots__}
+                          for hour, stats in self.hours.items()},
+            }
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(temp_path, self.snapshot_path)
+
+    def load_snapshot(self):
+        """Restore aggregates from the snapshot file; returns False if there is none usable"""
+        try:
+            with open(self.snapshot_path) as f:
+                data = json.load(f)
+            if data.get('version') != self.SNAPSHOT_VERSION:
+                return False
+            minutes = {}
+            for minute, values in data['minutes'].items():
+                stats = MinuteStats()
+                stats.counts = dict(zip(STATUSES, values[:len(STATUSES)]))
+                stats.delays = QuantileSketch.from_dict(values[len(STATUSES)])
+                minutes[int(minute)] = stats
+            hours = {}
+            for hour, sketches in data['hours'].items():
+                stats = HourStats(self.capacity)
+                for name in HourStats.__slots__:
+                    setattr(stats, name, HeavyHitters.from_dict(sketches.get(name, {}), self.capacity))
+                hours[int(hour)] = stats
+        except (OSError, ValueError, KeyError, TypeError, IndexError):
+            return False
+        with self.lock:
+            self.minutes, self.hours = minutes, hours
+            self.inode, self.offset, self.lines = data['inode'], data['offset'], data.get('lines', 0)
+        return True
+
+    # Queries
+
+    def summary(self, minutes=60, top=10):
+        """Return the statistics of the last `minutes` minutes
+
+        Counts, the per-minute series and delay percentiles are exact to the
+        minute; top lists cover the whole hours the window touches.
+        """
+        minutes = max(1, min(minutes, self.retention_minutes))
+        now = time.time()
+        end = int(now) // 60 * 60
+        start = end - (minutes - 1) * 60
+        with self.lock:
+            series = []
+            totals = dict.fromkeys(STATUSES, 0)
+            delays = QuantileSketch()
+            for minute in range(start, end + 60, 60):
+                stats = self.minutes.get(minute)
+                counts = stats.counts if stats else dict.fromkeys(STATUSES, 0)
+                series.append(dict(counts, minute=minute))
+                if stats:
+                    for status in STATUSES:
+                        totals[status] += counts[status]
+                    delays.merge(stats.delays)
+            hours = [stats for hour, stats in self.hours.items() if hour + 3600 > start]
+            result = {
+                'window_minutes': minutes,
+                'start': start,
+                'end': end + 60,
+                'totals': totals,
+                'series': series,
+                'delay_percentiles': {name: delays.quantile(q)
+                                      for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))},
+                'delay_samples': delays.count,
+                'top_senders': merge_top([stats.senders for stats in hours], top),
+                'top_recipients': merge_top([stats.recipients for stats in hours], top),
+                'top_client_ips': merge_top([stats.client_ips for stats in hours], top),
+                'top_rejected_client_ips': merge_top([stats.rejected_client_ips for stats in hours], top),
+                'lines_processed': self.lines,
+                'updated': self.updated,
+            }
+        return result
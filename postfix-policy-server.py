@@ -1,117 +1,1059 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 import socket
 import ipaddress
 import re
+import time
+import heapq
+import threading
+import signal
+import asyncio
+import argparse
+import struct
+from collections import OrderedDict
+import mmap
+import hashlib
+import atexit
+import fcntl
+import sqlite3
+from bisect import bisect_left, bisect_right
 
-class PostfixPolicyServer:
-    def __init__(self):
-        self.sender_restrictions_file = '/etc/postfix/sender_restrictions.conf'
-        self.recipient_restrictions_file = '/etc/postfix/recipient_restrictions.conf'
-        self.denied_senders_file = '/etc/postfix/denied_senders.conf'
-        self.blackhole_recipients_file = '/etc/postfix/blackhole_recipients.conf'
+class CidrIndex:
+    # Flattens the sender and recipient restriction lists into sorted,
+    # non-overlapping integer ranges per address family. Each range carries the
+    # position of the first matching entry of both lists, so one bisect answers
+    # both lookups with the same first-match semantics as walking the lists in
+    # file order.
+    def __init__(self, sender_restrictions, recipient_restrictions):
+        self.restrictions = (tuple(sender_restrictions), tuple(recipient_restrictions))
+        self.tables = {}
+        for version in (4, 6):
+            rules = []
+            for kind, restrictions in enumerate(self.restrictions):
+                for order, (network, allowed) in enumerate(restrictions):
+                    if network.version == version:
+                        rules.append((int(network.network_address),
+                                      int(network.broadcast_address) + 1,
+                                      kind, order))
+            self.tables[version] = self._build(rules, 2 ** (32 if version == 4 else 128))
 
-        self.sender_restrictions = []
-        self.recipient_restrictions = []
-        self.denied_senders = set()
-        self.blackhole_recipients = set()
+    def _build(self, rules, address_space):
+        starts = [0]
+        values = [(None, None)]
+        if not rules:
+            return starts, values
 
-        self.load_config()
+        opening = sorted(range(len(rules)), key=lambda i: rules[i][0])
+        # The end of the last network may fall just past the address space
+        boundaries = sorted({rule[0] for rule in rules} | {rule[1] for rule in rules if rule[1] < address_space})
+        active = ([], [])
+        next_rule = 0
 
-    def load_config(self):
-        # Load denied senders
+        for boundary in boundaries:
+            while next_rule < len(opening) and rules[opening[next_rule]][0] == boundary:
+                start, end, kind, order = rules[opening[next_rule]]
+                heapq.heappush(active[kind], (order, end))
+                next_rule += 1
+
+            # Drop expired rules lazily; only the head of each heap matters
+            current = []
+            for heap in active:
+                while heap and heap[0][1] <= boundary:
+                    heapq.heappop(heap)
+                current.append(heap[0][0] if heap else None)
+            current = tuple(current)
+
+            if current != values[-1]:
+                if starts[-1] == boundary:
+                    values[-1] = current
+                else:
+                    starts.append(boundary)
+                    values.append(current)
+
+        return starts, values
+
+    def lookup_entries(self, client_ip):
+        # (network, allowed list) of the first matching sender and recipient
+        # restriction, either None when no entry matches
         try:
-            with open(self.denied_senders_file, 'r') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        self.denied_senders.add(line.lower())
-        except FileNotFoundError:
-            pass
+            ip = ipaddress.ip_address(client_ip)
+        except ValueError:
+            return None, None
+        starts, values = self.tables[ip.version]
+        sender, recipient = values[bisect_right(starts, int(ip)) - 1]
+        return (None if sender is None else self.restrictions[0][sender],
+                None if recipient is None else self.restrictions[1][recipient])
+
+    def lookup(self, client_ip):
+        # (allowed senders, allowed recipients), either None
+        return tuple(entry and entry[1] for entry in self.lookup_entries(client_ip))
+
+def domain_suffixes(address):
+    # Yields the rule keys that can match an address besides the address
+    # itself: '@example.com' for its domain, then '@.example.com',
+    # '@.com' for every parent domain it is a subdomain of
+    user, at, domain = address.rpartition('@')
+    if not at or not domain:
+        return
+    yield '@' + domain
+    labels = domain.split('.')
+    for i in range(1, len(labels)):
+        yield '@.' + '.'.join(labels[i:])
+
+class AddressMatcher:
+    # Case-insensitive address list: exact addresses go in a set, '@domain'
+    # and '@.domain' (any subdomain) entries in a trie of reversed domain
+    # labels, so a lookup costs O(address length) whatever the list size
+    EXACT = '@'
+    WILDCARD = '@.'
+
+    def __init__(self, entries):
+        self.entries = frozenset(entry.lower() for entry in entries)
+        self.addresses = set()
+        self.domains = {}
+        for entry in self.entries:
+            if entry.startswith(self.WILDCARD):
+                self._add_domain(entry[2:], self.WILDCARD)
+            elif entry.startswith(self.EXACT):
+                self._add_domain(entry[1:], self.EXACT)
+            else:
+                self.addresses.add(entry)
+
+    def _add_domain(self, domain, flag):
+        node = self.domains
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        node[flag] = True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, address):
+        return self.match(address) is not None
+
+    def match(self, address):
+        # The most specific entry that matches address: the address itself,
+        # '@domain', then the nearest '@.domain' (lowercased), or None
+        address = address.lower()
+        if address in self.addresses:
+            return address
+        user, at, domain = address.rpartition('@')
+        if not at or not self.domains:
+            return None
+
+        node = self.domains
+        labels = domain.split('.')
+        parent = None
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.get(label)
+            if node is None:
+                return parent
+            if depth < len(labels) and self.WILDCARD in node:
+                parent = self.WILDCARD + '.'.join(labels[-depth:])
+        return self.EXACT + domain if self.EXACT in node else parent
+
+class PolicyRules:
+    # Immutable snapshot of the four rule files. The server swaps in a whole
+    # new snapshot on reload, so a request never sees a half-loaded rule set.
+    def __init__(self, denied_senders, blackhole_recipients, sender_restrictions, recipient_restrictions):
+        self.denied_senders = AddressMatcher(denied_senders)
+        self.blackhole_recipients = AddressMatcher(blackhole_recipients)
+        self.sender_restrictions = tuple(sender_restrictions)
+        self.recipient_restrictions = tuple(recipient_restrictions)
+        self.cidr_index = CidrIndex(self.sender_restrictions, self.recipient_restrictions)
+        self.recipient_matchers = {allowed: AddressMatcher(allowed)
+                                   for network, allowed in self.recipient_restrictions}
+
+    def recipient_matcher(self, allowed):
+        return self.recipient_matchers[allowed]
+
+    @classmethod
+    def load(cls, denied_senders_file, blackhole_recipients_file,
+             sender_restrictions_file, recipient_restrictions_file):
+        # Load denied senders
+        denied_senders = read_rule_lines(denied_senders_file)
 
         # Load blackhole recipients
+        blackhole_recipients = read_rule_lines(blackhole_recipients_file)
+
+        # Load sender and recipient restrictions
+        sender_restrictions = parse_restrictions(read_rule_lines(sender_restrictions_file))
+        recipient_restrictions = parse_restrictions(read_rule_lines(recipient_restrictions_file))
+
+        return cls(denied_senders, blackhole_recipients, sender_restrictions, recipient_restrictions)
+
+def read_rule_lines(path):
+    try:
+        with open(path, 'r') as f:
+            lines = [line.strip() for line in f]
+    except FileNotFoundError:
+        return []
+    return [line for line in lines if line and not line.startswith('#')]
+
+def parse_restrictions(lines):
+    restrictions = []
+    for line in lines:
+        parts = line.split()
+        if len(parts) >= 2:
+            try:
+                network = ipaddress.ip_network(parts[0], strict=False)
+            except ValueError:
+                continue
+            restrictions.append((network, tuple(parts[1:])))
+    return restrictions
+
+# Compiled rule snapshot layout (little-endian):
+#   header   magic, format version, (size, mtime_ns) of the four source files,
+#            then (offset, length) of each section
+#   strings  UTF-8 blob referenced by the address and list tables
+#   denied / blackhole
+#            (blake2b-64 hash, string offset, string length) sorted by hash
+#   lists    (string offset, string length) of each space-joined allowed list
+#   sender / recipient entries
+#            (string offset, string length, list id) of each restriction's
+#            network and allowed list, in file order
+#   v4/v6 starts and values
+#            CidrIndex ranges: big-endian range starts (4 or 16 bytes) and
+#            (sender entry, recipient entry) positions, -1 meaning no match
+SNAPSHOT_MAGIC = b'PFPR'
+# Written by the web interface, which can't create files in /etc/postfix
+DEFAULT_SNAPSHOT_FILE = '/var/lib/postfixmanager/policy_rules.bin'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_SECTIONS = ('strings', 'denied_senders', 'blackhole_recipients', 'lists',
+                     'sender_entries', 'recipient_entries',
+                     'v4_starts', 'v4_values', 'v6_starts', 'v6_values')
+SNAPSHOT_HEADER = struct.Struct('<4sI' + 'qq' * 4 + 'QQ' * len(SNAPSHOT_SECTIONS))
+ADDRESS_ENTRY = struct.Struct('<QII')
+LIST_ENTRY = struct.Struct('<II')
+RESTRICTION_ENTRY = struct.Struct('<IIi')
+RANGE_VALUE = struct.Struct('<ii')
+
+def address_hash(address):
+    return int.from_bytes(hashlib.blake2b(address.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def write_snapshot(rules, source_signature, output_file):
+    strings = bytearray()
+
+    def add_string(text):
+        data = text.encode('utf-8')
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    def address_table(addresses):
+        entries = sorted((address_hash(address),) + add_string(address) for address in addresses)
+        return b''.join(ADDRESS_ENTRY.pack(*entry) for entry in entries)
+
+    list_ids = {}
+    lists = bytearray()
+
+    def list_id(allowed):
+        if allowed is None:
+            return -1
+        if allowed not in list_ids:
+            list_ids[allowed] = len(list_ids)
+            lists.extend(LIST_ENTRY.pack(*add_string(' '.join(allowed))))
+        return list_ids[allowed]
+
+    def entry_position(order):
+        return -1 if order is None else order
+
+    sections = {
+        'denied_senders': address_table(rules.denied_senders),
+        'blackhole_recipients': address_table(rules.blackhole_recipients),
+    }
+    for name, restrictions in zip(('sender_entries', 'recipient_entries'), rules.cidr_index.restrictions):
+        sections[name] = b''.join(RESTRICTION_ENTRY.pack(*add_string(str(network)), list_id(allowed))
+                                  for network, allowed in restrictions)
+    for version, width in ((4, 4), (6, 16)):
+        starts, values = rules.cidr_index.tables[version]
+        sections[f'v{version}_starts'] = b''.join(start.to_bytes(width, 'big') for start in starts)
+        sections[f'v{version}_values'] = b''.join(RANGE_VALUE.pack(entry_position(s), entry_position(r))
+                                                  for s, r in values)
+    sections['lists'] = bytes(lists)
+    sections['strings'] = bytes(strings)
+
+    layout = []
+    body = bytearray()
+    for name in SNAPSHOT_SECTIONS:
+        # Keep every section 8-byte aligned
+        body.extend(b'\0' * (-len(body) % 8))
+        layout.extend((SNAPSHOT_HEADER.size + len(body), len(sections[name])))
+        body.extend(sections[name])
+
+    sources = []
+    for entry in source_signature:
+        sources.extend(entry[1:] if entry else (-1, -1))
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, *sources, *layout)
+
+    # Write beside the target and rename so readers only ever map a complete file
+    tmp_file = f"{output_file}.tmp.{os.getpid()}"
+    try:
+        with open(tmp_file, 'wb') as f:
+            f.write(header)
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, output_file)
+    except BaseException:
         try:
-            with open(self.blackhole_recipients_file, 'r') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        self.blackhole_recipients.add(line.lower())
-        except FileNotFoundError:
+            os.unlink(tmp_file)
+        except OSError:
             pass
+        raise
+
+class AddressTable:
+    # Read-only set of addresses looked up in place in the mapped snapshot
+    def __init__(self, buf, offset, length, strings_offset):
+        self.buf = buf
+        self.offset = offset
+        self.count = length // ADDRESS_ENTRY.size
+        self.strings_offset = strings_offset
+
+    def __len__(self):
+        return self.count
 
-        # Load sender restrictions
+    def __contains__(self, address):
+        return self.match(address) is not None
+
+    def match(self, address):
+        # Same matching rules as AddressMatcher, probing the address and
+        # each of its domain keys; returns the key that matched or None
+        address = address.lower()
+        if self.contains_key(address):
+            return address
+        for key in domain_suffixes(address):
+            if self.contains_key(key):
+                return key
+        return None
+
+    def contains_key(self, address):
+        key = address_hash(address)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ADDRESS_ENTRY.unpack_from(self.buf, self.offset + mid * ADDRESS_ENTRY.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # Confirm against the stored string in case of a hash collision
+        data = address.encode('utf-8')
+        while lo < self.count:
+            entry_hash, string_offset, string_length = ADDRESS_ENTRY.unpack_from(
+                self.buf, self.offset + lo * ADDRESS_ENTRY.size)
+            if entry_hash != key:
+                break
+            start = self.strings_offset + string_offset
+            if self.buf[start:start + string_length] == data:
+                return True
+            lo += 1
+        return False
+
+class CompiledCidrIndex:
+    # Same lookup() contract as CidrIndex, bisecting the packed range tables
+    def __init__(self, buf, sections):
+        self.buf = buf
+        self.strings_offset = sections['strings'][0]
+        self.lists_offset = sections['lists'][0]
+        self.entries_offsets = (sections['sender_entries'][0], sections['recipient_entries'][0])
+        self.entries = {}
+        self.tables = {
+            4: (sections['v4_starts'], sections['v4_values'], 4),
+            6: (sections['v6_starts'], sections['v6_values'], 16),
+        }
+        self.allowed_lists = {-1: None}
+
+    def allowed_list(self, list_id):
+        allowed = self.allowed_lists.get(list_id)
+        if allowed is None and list_id != -1:
+            string_offset, string_length = LIST_ENTRY.unpack_from(
+                self.buf, self.lists_offset + list_id * LIST_ENTRY.size)
+            start = self.strings_offset + string_offset
+            allowed = tuple(self.buf[start:start + string_length].decode('utf-8').split())
+            self.allowed_lists[list_id] = allowed
+        return allowed
+
+    def entry(self, kind, position):
+        if position == -1:
+            return None
+        entry = self.entries.get((kind, position))
+        if entry is None:
+            string_offset, string_length, list_id = RESTRICTION_ENTRY.unpack_from(
+                self.buf, self.entries_offsets[kind] + position * RESTRICTION_ENTRY.size)
+            start = self.strings_offset + string_offset
+            entry = (self.buf[start:start + string_length].decode('utf-8'), self.allowed_list(list_id))
+            self.entries[(kind, position)] = entry
+        return entry
+
+    def lookup(self, client_ip):
+        # (allowed senders, allowed recipients), either None
+        return tuple(entry and entry[1] for entry in self.lookup_entries(client_ip))
+
+    def lookup_entries(self, client_ip):
         try:
-            with open(self.sender_restrictions_file, 'r') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        parts = line.split()
-                        if len(parts) >= 2:
-                            try:
-                                network = ipaddress.ip_network(parts[0], strict=False)
-                                allowed_senders = parts[1:]
-                                self.sender_restrictions.append((network, allowed_senders))
-                            except ValueError:
-                                continue
-        except FileNotFoundError:
-            pass
+            ip = ipaddress.ip_address(client_ip)
+        except ValueError:
+            return None, None
+        (starts_offset, starts_length), (values_offset, _), width = self.tables[ip.version]
+        key = int(ip).to_bytes(width, 'big')
+
+        # Big-endian starts compare as bytes in numeric order
+        lo, hi = 0, starts_length // width
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = starts_offset + mid * width
+            if key < self.buf[start:start + width]:
+                hi = mid
+            else:
+                lo = mid + 1
+
+        sender, recipient = RANGE_VALUE.unpack_from(self.buf, values_offset + (lo - 1) * RANGE_VALUE.size)
+        return self.entry(0, sender), self.entry(1, recipient)
+
+class CompiledRules:
+    # PolicyRules backed by a memory-mapped snapshot; the pages are shared
+    # through the page cache by every policy process that maps the file
+    def __init__(self, buf, sections):
+        self.buf = buf
+        strings_offset = sections['strings'][0]
+        self.denied_senders = AddressTable(buf, *sections['denied_senders'], strings_offset)
+        self.blackhole_recipients = AddressTable(buf, *sections['blackhole_recipients'], strings_offset)
+        self.cidr_index = CompiledCidrIndex(buf, sections)
+        self.recipient_matchers = {}
+
+    def recipient_matcher(self, allowed):
+        # Built on first use; only the lists that clients actually hit are decoded
+        matcher = self.recipient_matchers.get(allowed)
+        if matcher is None:
+            matcher = self.recipient_matchers[allowed] = AddressMatcher(allowed)
+        return matcher
+
+    @classmethod
+    def open(cls, snapshot_file, source_signature):
+        # Returns None when the snapshot is missing, unreadable or older than
+        # the rule files, so the caller can fall back to parsing the text
+        try:
+            with open(snapshot_file, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        if len(buf) < SNAPSHOT_HEADER.size:
+            return None
+        header = SNAPSHOT_HEADER.unpack_from(buf, 0)
+        if header[0] != SNAPSHOT_MAGIC or header[1] != SNAPSHOT_VERSION:
+            return None
+
+        sources = header[2:10]
+        for i, entry in enumerate(source_signature):
+            if tuple(sources[i * 2:i * 2 + 2]) != (entry[1:] if entry else (-1, -1)):
+                return None
 
-        # Load recipient restrictions
+        layout = header[10:]
+        sections = {name: (layout[i * 2], layout[i * 2 + 1]) for i, name in enumerate(SNAPSHOT_SECTIONS)}
+        if any(offset + length > len(buf) for offset, length in sections.values()):
+            return None
+        return cls(buf, sections)
+
+class DecisionCache:
+    # Bounded LRU of per-(request type, client, sender) decisions with an
+    # optional TTL. Entries belong to one rule snapshot and are dropped as
+    # soon as a different snapshot is presented.
+    def __init__(self, max_size=10000, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.rules = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self, rules=None):
+        self.entries.clear()
+        self.rules = rules
+
+    def get(self, key, rules):
+        if rules is not self.rules:
+            self.clear(rules)
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if not expires or expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value, rules):
+        if rules is not self.rules or self.max_size <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+RATE_PATTERN = re.compile(r'^(\d+)/(\d*)([smhd]?)$')
+RATE_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_rate(text):
+    # '100/60', '100/60s', '500/h' or '5000/1d' -> (count, seconds)
+    match = RATE_PATTERN.match(text)
+    if not match:
+        raise ValueError(f"Invalid rate: {text}")
+    count, number, unit = match.groups()
+    count, seconds = int(count), int(number or 1) * RATE_UNITS[unit]
+    if count < 1 or seconds < 1:
+        raise ValueError(f"Invalid rate: {text}")
+    return count, seconds
+
+class RateLimits:
+    # Rules from rate_limits.conf; the first matching rule of each kind applies:
+    #   client <network> <rate>   a bucket per client IP within the network
+    #   cidr   <network> <rate>   one bucket shared by the whole network
+    #   sender <address, @domain, @.domain or *> <rate>
+    #                             a bucket per sender address
+    KINDS = ('client', 'cidr', 'sender')
+
+    def __init__(self, rules):
+        # rules: [(kind, selector, count, seconds)], selectors already parsed
+        self.rules = tuple(rules)
+        self.clients = [(network, count, seconds) for kind, network, count, seconds in self.rules if kind == 'client']
+        self.networks = [(network, count, seconds) for kind, network, count, seconds in self.rules if kind == 'cidr']
+        self.senders = [(matcher, count, seconds) for kind, matcher, count, seconds in self.rules if kind == 'sender']
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    @classmethod
+    def parse(cls, lines):
+        rules = []
+        for line in lines:
+            parts = line.split()
+            if len(parts) != 3 or parts[0] not in cls.KINDS:
+                continue
+            kind, selector, rate = parts
+            try:
+                count, seconds = parse_rate(rate)
+                if kind == 'sender':
+                    selector = None if selector == '*' else AddressMatcher([selector])
+                else:
+                    selector = ipaddress.ip_network(selector, strict=False)
+            except ValueError:
+                continue
+            rules.append((kind, selector, count, seconds))
+        return cls(rules)
+
+    @classmethod
+    def load(cls, path):
+        return cls.parse(read_rule_lines(path))
+
+    def buckets(self, client_address, sender):
+        # Returns [(bucket key, count, seconds)] a message from this client
+        # and sender draws from
+        buckets = []
+        if self.clients or self.networks:
+            try:
+                ip = ipaddress.ip_address(client_address)
+            except ValueError:
+                ip = None
+            if ip is not None:
+                for network, count, seconds in self.clients:
+                    if ip in network:
+                        buckets.append((f"client:{ip}", count, seconds))
+                        break
+                for network, count, seconds in self.networks:
+                    if ip in network:
+                        buckets.append((f"cidr:{network}", count, seconds))
+                        break
+        # The null sender (bounces) is not limited per sender
+        if sender:
+            for matcher, count, seconds in self.senders:
+                if matcher is None or sender in matcher:
+                    buckets.append((f"sender:{sender.lower()}", count, seconds))
+                    break
+        return buckets
+
+class RateLimitStore:
+    # Token buckets shared by every policy server process through a small
+    # SQLite database. A bucket holds up to count tokens and refills at
+    # count/seconds; a message takes a token from each bucket it draws from,
+    # or none at all if any of them is empty. Buckets that have refilled
+    # completely are pruned, since a missing bucket starts full.
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = None
+        self.last_prune = 0.0
+
+    def _connect(self):
+        # Opened on first use, in the thread that serves requests
+        if self.db is not None:
+            return self.db
         try:
-            with open(self.recipient_restrictions_file, 'r') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        parts = line.split()
-                        if len(parts) >= 2:
-                            try:
-                                network = ipaddress.ip_network(parts[0], strict=False)
-                                allowed_recipients = parts[1:]
-                                self.recipient_restrictions.append((network, allowed_recipients))
-                            except ValueError:
-                                continue
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            db = sqlite3.connect(self.db_path, timeout=1, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+        except (OSError, sqlite3.Error):
+            # Not writable: count per process rather than not at all
+            db = sqlite3.connect(':memory:', isolation_level=None)
+        # Counters are advisory; losing the last ones in a crash is fine
+        db.execute('PRAGMA synchronous=OFF')
+        db.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                   'updated REAL NOT NULL, full_at REAL NOT NULL)')
+        db.execute('CREATE INDEX IF NOT EXISTS buckets_full_at ON buckets (full_at)')
+        self.db = db
+        return db
+
+    def take(self, buckets, now=None):
+        # True if every bucket had a token left (one is then taken from each)
+        now = time.time() if now is None else now
+        db = self._connect()
+        # IMMEDIATE takes the write lock up front, so concurrent processes
+        # can't both read the same last token
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            updates = []
+            for key, count, seconds in buckets:
+                row = db.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens = count if row is None else min(count, row[0] + max(0, now - row[1]) * count / seconds)
+                if tokens < 1:
+                    break
+                tokens -= 1
+                updates.append((key, tokens, now, now + (count - tokens) * seconds / count))
+            allowed = len(updates) == len(buckets)
+            if allowed:
+                db.executemany('INSERT OR REPLACE INTO buckets (key, tokens, updated, full_at) '
+                               'VALUES (?, ?, ?, ?)', updates)
+            if now - self.last_prune >= self.PRUNE_INTERVAL:
+                db.execute('DELETE FROM buckets WHERE full_at < ?', (now,))
+                self.last_prune = now
+            db.execute('COMMIT')
+        except BaseException:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            raise
+        return allowed
+
+class MemoryRateLimitStore:
+    # The same token buckets kept in this process only, for the --listen
+    # daemon: it answers every smtpd itself, so there is nothing to share,
+    # and a take never waits on a lock held by another process
+    PRUNE_INTERVAL = RateLimitStore.PRUNE_INTERVAL
+
+    def __init__(self):
+        # key -> (tokens, updated, full_at)
+        self.buckets = {}
+        self.last_prune = 0.0
+
+    def take(self, buckets, now=None):
+        now = time.time() if now is None else now
+        updates = []
+        for key, count, seconds in buckets:
+            row = self.buckets.get(key)
+            tokens = count if row is None else min(count, row[0] + max(0, now - row[1]) * count / seconds)
+            if tokens < 1:
+                break
+            tokens -= 1
+            updates.append((key, (tokens, now, now + (count - tokens) * seconds / count)))
+        allowed = len(updates) == len(buckets)
+        if allowed:
+            self.buckets.update(updates)
+        if now - self.last_prune >= self.PRUNE_INTERVAL:
+            self.buckets = {key: row for key, row in self.buckets.items() if row[2] >= now}
+            self.last_prune = now
+        return allowed
+
+class LatencyHistogram:
+    # Fixed-bucket histogram in the Prometheus layout: per-bucket counts are
+    # kept non-cumulative so recording is one bisect and two additions
+    BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+               0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def samples(self, name, labels):
+        cumulative = 0
+        counts = list(self.counts)
+        for bound, count in zip(self.BUCKETS + ('+Inf',), counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.total:.9f}'
+        yield f'{name}_count{{{labels}}} {cumulative}'
+
+def label_value(text):
+    # Escaped for a Prometheus label value
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class PolicyMetrics:
+    # Decision counters and latency histograms. Requests only bump in-memory
+    # counters; a background thread renders them to a Prometheus text file
+    # (one per process, labelled with the pid) that the web interface and
+    # node_exporter's textfile collector can read.
+    ACTIONS = ('DISCARD', 'REJECT', 'REPLACE', 'DEFER_IF_PERMIT', 'OK')
+    RULES = ('blackhole_recipients', 'denied_senders', 'sender_restrictions', 'recipient_restrictions',
+             'rate_limits')
+    # Entries labelled per rule list; matches of entries beyond these are
+    # counted as entry="other" so the number of series stays bounded
+    MAX_LABELLED_ENTRIES = 100
+    OTHER_ENTRY = 'other'
+
+    def __init__(self):
+        self.actions = dict.fromkeys(self.ACTIONS, 0)
+        self.rules = dict.fromkeys(self.RULES, 0)
+        self.entries = {rule: {} for rule in self.RULES}
+        self.errors = 0
+        self.request_latency = LatencyHistogram()
+        self.load_latency = {'snapshot': LatencyHistogram(), 'text': LatencyHistogram()}
+        self.loads = 0
+        self.last_load = 0.0
+        self.started = time.time()
+
+    def record_request(self, response, rule, entry, seconds):
+        action = response[7:].split(None, 1)[0]
+        self.actions[action] = self.actions.get(action, 0) + 1
+        if rule:
+            self.rules[rule] += 1
+            if entry is not None:
+                counts = self.entries[rule]
+                entry = str(entry)
+                if entry not in counts and len(counts) >= self.MAX_LABELLED_ENTRIES:
+                    entry = self.OTHER_ENTRY
+                counts[entry] = counts.get(entry, 0) + 1
+        self.request_latency.observe(seconds)
+
+    def record_error(self):
+        self.errors += 1
+
+    def record_load(self, source, seconds):
+        self.load_latency[source].observe(seconds)
+        self.loads += 1
+        self.last_load = time.time()
+
+    def render(self, cache_stats):
+        labels = f'pid="{os.getpid()}"'
+        lines = [
+            '# HELP policy_requests_total Policy requests answered, by action',
+            '# TYPE policy_requests_total counter',
+        ]
+        lines.extend(f'policy_requests_total{{{labels},action="{action}"}} {count}'
+                     for action, count in dict(self.actions).items())
+        lines.extend([
+            '# HELP policy_rule_matches_total Requests decided by each rule list',
+            '# TYPE policy_rule_matches_total counter',
+        ])
+        lines.extend(f'policy_rule_matches_total{{{labels},rule="{rule}"}} {count}'
+                     for rule, count in self.rules.items())
+        lines.extend([
+            '# HELP policy_rule_entry_matches_total Requests decided by each entry (address, domain or network) '
+            f'of a rule list; entries past the first {self.MAX_LABELLED_ENTRIES} per list count as "{self.OTHER_ENTRY}"',
+            '# TYPE policy_rule_entry_matches_total counter',
+        ])
+        for rule, counts in self.entries.items():
+            lines.extend(f'policy_rule_entry_matches_total{{{labels},rule="{rule}",entry="{label_value(entry)}"}} {count}'
+                         for entry, count in list(counts.items()))
+        lines.extend([
+            '# HELP policy_errors_total Requests answered OK because evaluating them failed, plus messages '
+            'let through unlimited because the rate limit store was busy or broken',
+            '# TYPE policy_errors_total counter',
+            f'policy_errors_total{{{labels}}} {self.errors}',
+            '# HELP policy_request_duration_seconds Time spent in process_request',
+            '# TYPE policy_request_duration_seconds histogram',
+        ])
+        lines.extend(self.request_latency.samples('policy_request_duration_seconds', labels))
+        lines.extend([
+            '# HELP policy_load_config_duration_seconds Time spent loading the rules, by source',
+            '# TYPE policy_load_config_duration_seconds histogram',
+        ])
+        for source, histogram in self.load_latency.items():
+            lines.extend(histogram.samples('policy_load_config_duration_seconds', f'{labels},source="{source}"'))
+        lines.extend([
+            '# HELP policy_decision_cache_hits_total Client/sender decisions served from the cache',
+            '# TYPE policy_decision_cache_hits_total counter',
+            f'policy_decision_cache_hits_total{{{labels}}} {cache_stats["hits"]}',
+            '# HELP policy_decision_cache_misses_total Client/sender decisions evaluated against the rules',
+            '# TYPE policy_decision_cache_misses_total counter',
+            f'policy_decision_cache_misses_total{{{labels}}} {cache_stats["misses"]}',
+            '# HELP policy_rules_loaded_timestamp_seconds When the rules were last loaded',
+            '# TYPE policy_rules_loaded_timestamp_seconds gauge',
+            f'policy_rules_loaded_timestamp_seconds{{{labels}}} {self.last_load:.3f}',
+            '# HELP policy_process_start_time_seconds When this policy server process started',
+            '# TYPE policy_process_start_time_seconds gauge',
+            f'policy_process_start_time_seconds{{{labels}}} {self.started:.3f}',
+        ])
+        return '\n'.join(lines) + '\n'
+
+# Counters of processes that have exited, so totals summed over the metrics
+# directory never go backwards. A process adds its counters to the archive
+# when it exits; one that died without doing so is folded in by the next
+# live process to notice. Gauges are not archived.
+METRICS_ARCHIVE = 'policy-server-archived.prom'
+METRICS_FILE_PATTERN = re.compile(r'^policy-server-(\d+)\.prom$')
+METRICS_SAMPLE_PATTERN = re.compile(r'^(\S+?(?:\{.*\})?)\s+(\S+)$')
+METRICS_PID_PATTERN = re.compile(r'pid="[^"]*"')
+METRICS_ENTRY_PATTERN = re.compile(r'^(.*,rule="[^"]*"),entry="((?:[^"\\]|\\.)*)"\}$')
+
+def parse_metrics(text):
+    # {family: [HELP/TYPE lines, type, {series: value}]} in file order, with
+    # the pid label of each series set to "archived"
+    families = OrderedDict()
+    family = None
+    for line in text.splitlines():
+        if line.startswith('#'):
+            parts = line.split(None, 3)
+            if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                family = families.setdefault(parts[2], [[], 'untyped', OrderedDict()])
+                if line not in family[0]:
+                    family[0].append(line)
+                if parts[1] == 'TYPE' and len(parts) == 4:
+                    family[1] = parts[3].strip()
+            continue
+        match = METRICS_SAMPLE_PATTERN.match(line)
+        if match and family is not None:
+            series = METRICS_PID_PATTERN.sub('pid="archived"', match.group(1))
+            try:
+                family[2][series] = float(match.group(2))
+            except ValueError:
+                continue
+    return families
+
+def fold_metrics(archive, families):
+    # Add the counter and histogram series of families into archive
+    for name, (headers, kind, series) in families.items():
+        if kind not in ('counter', 'histogram'):
+            continue
+        target = archive.setdefault(name, [headers, kind, OrderedDict()])
+        for key, value in series.items():
+            target[2][key] = target[2].get(key, 0) + value
+
+def cap_entry_metrics(families):
+    # Processes each label their own first entries, so the archive keeps only
+    # the most matched ones per rule list and folds the rest into "other"
+    family = families.get('policy_rule_entry_matches_total')
+    if family is None:
+        return
+    by_rule = OrderedDict()
+    for key, value in family[2].items():
+        match = METRICS_ENTRY_PATTERN.match(key)
+        if match:
+            by_rule.setdefault(match.group(1), []).append((match.group(2), key, value))
+    series = OrderedDict()
+    for prefix, entries in by_rule.items():
+        other = f'{prefix},entry="{PolicyMetrics.OTHER_ENTRY}"}}'
+        named = [item for item in entries if item[0] != PolicyMetrics.OTHER_ENTRY]
+        kept = sorted(named, key=lambda item: -item[2])[:PolicyMetrics.MAX_LABELLED_ENTRIES]
+        kept_keys = {item[1] for item in kept}
+        rest = sum(value for entry, key, value in entries if key not in kept_keys)
+        for entry, key, value in named:
+            if key in kept_keys:
+                series[key] = value
+        if rest:
+            series[other] = rest
+    family[2] = series
+
+def render_metrics(families):
+    lines = []
+    for headers, kind, series in families.values():
+        lines.extend(headers)
+        lines.extend(f'{key} {value:.17g}' for key, value in series.items())
+    return '\n'.join(lines) + '\n'
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def archive_metrics(metrics_dir, dead_files, final=None):
+    # Fold the files of exited processes into the archive, then remove them;
+    # final is (file, text) of this process, whose last counters are folded
+    # from memory. The lock serializes processes archiving at the same time;
+    # files already gone were folded by another.
+    with open(os.path.join(metrics_dir, '.archive.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_file = os.path.join(metrics_dir, METRICS_ARCHIVE)
+        try:
+            with open(archive_file) as f:
+                archive = parse_metrics(f.read())
         except FileNotFoundError:
-            pass
+            archive = OrderedDict()
+        texts = []
+        remove = []
+        for path in dead_files:
+            try:
+                with open(path) as f:
+                    texts.append(f.read())
+                remove.append(path)
+            except FileNotFoundError:
+                continue
+        if final is not None:
+            remove.append(final[0])
+            texts.append(final[1])
+        if not texts:
+            return
+        for text in texts:
+            fold_metrics(archive, parse_metrics(text))
+        cap_entry_metrics(archive)
+        tmp_file = f"{archive_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(render_metrics(archive))
+        os.chmod(tmp_file, 0o644)
+        # Between this rename and the unlinks a reader could count the folded
+        # files twice; the window is a few milliseconds
+        os.replace(tmp_file, archive_file)
+        for path in remove:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+class PostfixPolicyServer:
+    # Rate limit answers remembered per (client, message instance)
+    RATE_LIMIT_INSTANCES = 10000
+
+    def __init__(self, snapshot_file=DEFAULT_SNAPSHOT_FILE, cache_size=10000, cache_ttl=0,
+                 config_dir='/etc/postfix',
+                 rate_limit_db='/var/lib/postfixmanager/policy-ratelimit/counters.sqlite'):
+        self.sender_restrictions_file = os.path.join(config_dir, 'sender_restrictions.conf')
+        self.recipient_restrictions_file = os.path.join(config_dir, 'recipient_restrictions.conf')
+        self.denied_senders_file = os.path.join(config_dir, 'denied_senders.conf')
+        self.blackhole_recipients_file = os.path.join(config_dir, 'blackhole_recipients.conf')
+        self.rate_limits_file = os.path.join(config_dir, 'rate_limits.conf')
+        self.snapshot_file = snapshot_file
+
+        self.rules = None
+        self.rate_limits = None
+        self.config_signature = None
+        self.decision_cache = DecisionCache(cache_size, cache_ttl)
+        # No database: counters are kept in memory (daemon mode)
+        self.rate_limit_store = RateLimitStore(rate_limit_db) if rate_limit_db else MemoryRateLimitStore()
+        self.rate_limit_decisions = OrderedDict()
+        self.metrics = PolicyMetrics()
+        self.metrics_file = None
+        self.metrics_lock = threading.Lock()
+        self.metrics_archived = False
+
+        self.load_config()
+
+    def config_files(self):
+        return [self.denied_senders_file, self.blackhole_recipients_file,
+                self.sender_restrictions_file, self.recipient_restrictions_file]
+
+    def get_config_signature(self):
+        # The rule files, the compiled snapshot if one is used, then the rate
+        # limits (which are not part of the snapshot)
+        signature = []
+        paths = self.config_files() + ([self.snapshot_file] if self.snapshot_file else []) + [self.rate_limits_file]
+        for path in paths:
+            try:
+                st = os.stat(path)
+                signature.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def load_config(self):
+        # Take the signature first so an edit racing with the load is seen
+        # as a change on the next poll
+        start = time.perf_counter()
+        signature = self.get_config_signature()
+        rules = None
+        source = 'snapshot'
+        if self.snapshot_file:
+            rules = CompiledRules.open(self.snapshot_file, signature[:4])
+        if rules is None:
+            rules = self.load_text_rules()
+            source = 'text'
+        rate_limits = RateLimits.load(self.rate_limits_file)
+        # Single reference assignment - in-flight requests keep the old snapshot
+        self.rules = rules
+        self.rate_limits = rate_limits
+        self.config_signature = signature
+        self.metrics.record_load(source, time.perf_counter() - start)
+
+    def load_text_rules(self):
+        return PolicyRules.load(self.denied_senders_file, self.blackhole_recipients_file,
+                                self.sender_restrictions_file, self.recipient_restrictions_file)
+
+    def compile_snapshot(self):
+        signature = self.get_config_signature()[:4]
+        write_snapshot(self.load_text_rules(), signature, self.snapshot_file)
+
+    def watch_config(self, interval):
+        # Reload once a changed signature has been stable for one interval,
+        # so a file that is still being written is not picked up half-done
+        pending = None
+        while True:
+            time.sleep(interval)
+            try:
+                signature = self.get_config_signature()
+                if signature == self.config_signature:
+                    pending = None
+                elif signature == pending:
+                    self.load_config()
+                    pending = None
+                else:
+                    pending = signature
+            except Exception:
+                continue
+
+    def start_config_watcher(self, interval):
+        thread = threading.Thread(target=self.watch_config, args=(interval,), daemon=True)
+        thread.start()
+        return thread
 
     def is_in_open_relay(self, client_ip):
         # Not needed - relay_clients.cidr handles this before policy server
         return False
 
+    def get_restrictions(self, client_ip, rules=None):
+        # Returns (allowed_senders, allowed_recipients), either may be None
+        return (rules or self.rules).cidr_index.lookup(client_ip)
+
     def get_sender_restrictions(self, client_ip):
-        try:
-            ip = ipaddress.ip_address(client_ip)
-            for network, allowed_senders in self.sender_restrictions:
-                if ip in network:
-                    return allowed_senders
-        except ValueError:
-            pass
-        return None
+        return self.get_restrictions(client_ip)[0]
 
     def get_recipient_restrictions(self, client_ip):
-        try:
-            ip = ipaddress.ip_address(client_ip)
-            for network, allowed_recipients in self.recipient_restrictions:
-                if ip in network:
-                    return allowed_recipients
-        except ValueError:
-            pass
-        return None
+        return self.get_restrictions(client_ip)[1]
 
     def is_recipient_allowed(self, recipient, allowed_list):
-        for allowed in allowed_list:
-            if allowed.startswith('@'):
-                # Domain check
-                domain = allowed[1:]
-                if recipient.lower().endswith('@' + domain.lower()):
-                    return True
-            else:
-                # Exact email check
-                if recipient.lower() == allowed.lower():
-                    return True
-        return False
+        return recipient in AddressMatcher(allowed_list)
 
     def process_request(self, request_data):
+        start = time.perf_counter()
+        try:
+            response, rule, entry = self.evaluate_request(request_data)
+        except Exception:
+            self.metrics.record_error()
+            raise
+        self.metrics.record_request(response, rule, entry, time.perf_counter() - start)
+        return response
+
+    def evaluate_request(self, request_data):
+        # Returns (response, name of the rule list that decided it or None,
+        # the entry of that list that matched or None)
+
         # Parse request
         attrs = {}
         for line in request_data.strip().split('\n'):
@@ -124,42 +1066,149 @@ class PostfixPolicyServer:
         sender = attrs.get('sender', '')
         recipient = attrs.get('recipient', '')
 
+        # Evaluate the whole request against one snapshot, even if a reload
+        # swaps self.rules meanwhile
+        rules = self.rules
+        rate_limits = self.rate_limits
+
         # Check blackhole recipients first - silently discard
-        if recipient and recipient.lower() in self.blackhole_recipients:
-            return "action=DISCARD\n\n"
+        entry = rules.blackhole_recipients.match(recipient) if recipient else None
+        if entry is not None:
+            return "action=DISCARD\n\n", 'blackhole_recipients', entry
+
+        # Everything but the recipient checks depends only on the client and
+        # sender, which repeat for every RCPT of a message
+        key = (request_type, client_address, sender)
+        decision = self.decision_cache.get(key, rules)
+        if decision is None:
+            decision = self.evaluate_client(rules, request_type, client_address, sender)
+            self.decision_cache.put(key, decision, rules)
+        response, rule, entry, recipient_restriction = decision
+        if rule == 'denied_senders':
+            return response, rule, entry
+
+        # Handle recipient restrictions (a rewritten sender skips them)
+        if request_type in ['smtpd_access_policy'] and recipient and not response:
+            if recipient_restriction is not None:
+                network, allowed = recipient_restriction
+                if recipient not in rules.recipient_matcher(allowed):
+                    return ("action=REJECT Access denied - recipient not allowed\n\n", 'recipient_restrictions',
+                            network)
+
+        # Anything that would be accepted, rewritten or not, counts against
+        # the rate limits
+        if request_type in ['smtpd_access_policy'] and rate_limits:
+            if not self.within_rate_limits(rate_limits, client_address, sender, attrs.get('instance', '')):
+                return "action=DEFER_IF_PERMIT Rate limit exceeded, try again later\n\n", 'rate_limits', None
+
+        if response:
+            return response, rule, entry
+
+        # Client is either within its restrictions or has none configured
+        return "action=OK\n\n", None, None
+
+    def within_rate_limits(self, rate_limits, client_address, sender, instance):
+        # Counted once per message: later RCPTs of the same message, and
+        # requests from other restriction stages, get the first answer
+        key = (client_address, instance)
+        allowed = self.rate_limit_decisions.get(key) if instance else None
+        if allowed is None:
+            buckets = rate_limits.buckets(client_address, sender)
+            try:
+                allowed = self.rate_limit_store.take(buckets) if buckets else True
+            except sqlite3.Error:
+                # The store is busy or broken; let the message through
+                self.metrics.record_error()
+                allowed = True
+            if instance:
+                self.rate_limit_decisions[key] = allowed
+                while len(self.rate_limit_decisions) > self.RATE_LIMIT_INSTANCES:
+                    self.rate_limit_decisions.popitem(last=False)
+        return allowed
+
+    def evaluate_client(self, rules, request_type, client_address, sender):
+        # Returns (response or None, deciding rule list or None, its matching
+        # entry or None, (network, allowed recipients) of the client's
+        # recipient restriction or None)
 
         # Check denied senders - applies to ALL IPs
-        if sender and sender.lower() in self.denied_senders:
-            return "action=REJECT Sender address not allowed\n\n"
+        entry = rules.denied_senders.match(sender) if sender else None
+        if entry is not None:
+            return "action=REJECT Sender address not allowed\n\n", 'denied_senders', entry, None
 
         # Note: relay_clients.cidr is checked first, so we only get here if
         # the IP is NOT in the open relay list
+        sender_restriction, recipient_restriction = rules.cidr_index.lookup_entries(client_address)
 
         # Handle sender restrictions
         if request_type in ['smtpd_access_policy'] and sender:
-            sender_restrictions = self.get_sender_restrictions(client_address)
-            if sender_restrictions is not None:
+            if sender_restriction is not None:
+                network, sender_restrictions = sender_restriction
                 if sender not in sender_restrictions:
                     # Rewrite sender to first allowed sender
                     new_sender = sender_restrictions[0]
-                    return f"action=REPLACE From: <{new_sender}>\n\n"
+                    return f"action=REPLACE From: <{new_sender}>\n\n", 'sender_restrictions', network, None
 
-        # Handle recipient restrictions
-        if request_type in ['smtpd_access_policy'] and recipient:
-            recipient_restrictions = self.get_recipient_restrictions(client_address)
-            if recipient_restrictions is not None:
-                if not self.is_recipient_allowed(recipient, recipient_restrictions):
-                    return "action=REJECT Access denied - recipient not allowed\n\n"
+        return None, None, None, recipient_restriction
 
-        # Check if client has any restrictions configured
-        has_sender_restrictions = self.get_sender_restrictions(client_address) is not None
-        has_recipient_restrictions = self.get_recipient_restrictions(client_address) is not None
+    def log_stats(self):
+        stats = self.decision_cache.stats()
+        sys.stderr.write(f"decision cache: {stats['size']} entries, "
+                         f"{stats['hits']} hits, {stats['misses']} misses\n")
+        actions = ', '.join(f"{count} {action}" for action, count in self.metrics.actions.items())
+        sys.stderr.write(f"requests: {actions}, {self.metrics.errors} errors\n")
+        sys.stderr.flush()
 
-        if has_sender_restrictions or has_recipient_restrictions:
-            return "action=OK\n\n"
+    def write_metrics(self):
+        # Write beside the target and rename so readers never see a partial file
+        if self.metrics_archived:
+            return
+        tmp_file = f"{self.metrics_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(self.metrics.render(self.decision_cache.stats()))
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, self.metrics_file)
 
-        # If no restrictions configured for this IP, let it continue to other checks
-        return "action=OK\n\n"
+    def dead_metrics_files(self):
+        # Metrics files whose process no longer exists
+        metrics_dir = os.path.dirname(self.metrics_file)
+        dead = []
+        for name in os.listdir(metrics_dir):
+            match = METRICS_FILE_PATTERN.match(name)
+            if match and int(match.group(1)) != os.getpid() and not pid_alive(int(match.group(1))):
+                dead.append(os.path.join(metrics_dir, name))
+        return dead
+
+    def archive_metrics(self):
+        # At exit: add this process's final counters to the archive instead
+        # of dropping them with its file
+        with self.metrics_lock:
+            self.metrics_archived = True
+            try:
+                archive_metrics(os.path.dirname(self.metrics_file), [],
+                                (self.metrics_file, self.metrics.render(self.decision_cache.stats())))
+            except OSError:
+                pass
+
+    def export_metrics(self, interval):
+        while True:
+            try:
+                with self.metrics_lock:
+                    self.write_metrics()
+                dead = self.dead_metrics_files()
+                if dead:
+                    archive_metrics(os.path.dirname(self.metrics_file), dead)
+            except Exception:
+                pass
+            time.sleep(interval)
+
+    def start_metrics_exporter(self, metrics_dir, interval):
+        # One file per process; spawned stdin servers run side by side
+        self.metrics_file = os.path.join(metrics_dir, f'policy-server-{os.getpid()}.prom')
+        atexit.register(self.archive_metrics)
+        thread = threading.Thread(target=self.export_metrics, args=(interval,), daemon=True)
+        thread.start()
+        return thread
 
     def run(self):
         while True:
@@ -188,6 +1237,111 @@ class PostfixPolicyServer:
                 sys.stdout.write("action=OK\n\n")
                 sys.stdout.flush()
 
+    async def handle_connection(self, reader, writer):
+        # One smtpd client; Postfix keeps the connection open across requests
+        try:
+            while True:
+                request_lines = []
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        return
+                    line = line.decode('utf-8', 'replace').strip()
+                    if line == '':
+                        break
+                    request_lines.append(line)
+
+                request_data = '\n'.join(request_lines)
+                if not request_data:
+                    continue
+
+                try:
+                    response = self.process_request(request_data)
+                except Exception:
+                    response = "action=OK\n\n"
+                writer.write(response.encode('utf-8'))
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, listen):
+        scheme, _, address = listen.partition(':')
+        if scheme == 'unix':
+            if os.path.exists(address):
+                os.unlink(address)
+            server = await asyncio.start_unix_server(self.handle_connection, path=address)
+            # smtpd connects as the postfix user
+            os.chmod(address, 0o666)
+        elif scheme in ('tcp', 'inet'):
+            host, _, port = address.rpartition(':')
+            server = await asyncio.start_server(self.handle_connection, host.strip('[]') or None, int(port))
+        else:
+            raise ValueError(f"Unsupported listen address: {listen}")
+
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+
+        async with server:
+            await stop
+
+        if scheme == 'unix' and os.path.exists(address):
+            os.unlink(address)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Postfix access policy server')
+    parser.add_argument('command', nargs='?', default='serve', choices=['serve', 'compile'],
+                        help='serve policy requests (default), or compile the rule files '
+                             'into the binary snapshot and exit')
+    parser.add_argument('--config-dir', default='/etc/postfix', metavar='DIR',
+                        help='Directory holding the four rule files and rate_limits.conf (default: %(default)s)')
+    parser.add_argument('--snapshot', default=DEFAULT_SNAPSHOT_FILE, metavar='PATH',
+                        help='Compiled rule snapshot (default: %(default)s, empty to disable)')
+    parser.add_argument('--listen', metavar='ADDRESS',
+                        help='Run as a standalone daemon on unix:/path or tcp:host:port '
+                             'instead of serving a single client on stdin/stdout')
+    parser.add_argument('--cache-size', type=int, default=10000, metavar='ENTRIES',
+                        help='Maximum cached client/sender decisions (default: %(default)s, 0 disables)')
+    parser.add_argument('--cache-ttl', type=float, default=0, metavar='SECONDS',
+                        help='Expire cached decisions after this long (default: only on rule reload)')
+    parser.add_argument('--reload-interval', type=float, default=5, metavar='SECONDS',
+                        help='Poll the rule files for changes and reload them in the background '
+                             '(default: %(default)s, 0 disables)')
+    parser.add_argument('--rate-limit-db', default='/var/lib/postfixmanager/policy-ratelimit/counters.sqlite',
+                        metavar='PATH',
+                        help='SQLite database of rate limit counters shared by all spawned policy '
+                             'server processes (default: %(default)s); a --listen daemon keeps '
+                             'its counters in memory')
+    parser.add_argument('--metrics-dir', metavar='DIR',
+                        help='Write request counters and latency histograms in Prometheus text '
+                             'format to DIR/policy-server-<pid>.prom')
+    parser.add_argument('--metrics-interval', type=float, default=10, metavar='SECONDS',
+                        help='How often to rewrite the metrics file (default: %(default)s)')
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    server = PostfixPolicyServer()
-    server.run()
+    args = parse_args()
+    snapshot_file = args.snapshot
+    if args.command == 'compile' and not snapshot_file:
+        sys.exit('compile needs a --snapshot path')
+    server = PostfixPolicyServer(snapshot_file=snapshot_file, cache_size=args.cache_size,
+                                 cache_ttl=args.cache_ttl, config_dir=args.config_dir,
+                                 rate_limit_db=None if args.listen else args.rate_limit_db)
+    if args.command == 'compile':
+        try:
+            server.compile_snapshot()
+        except OSError as e:
+            sys.exit(f"Cannot write the snapshot {snapshot_file}: {e}")
+        sys.exit(0)
+    if args.reload_interval > 0:
+        server.start_config_watcher(args.reload_interval)
+    if args.metrics_dir:
+        server.start_metrics_exporter(args.metrics_dir, args.metrics_interval)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: server.log_stats())
+    if args.listen:
+        asyncio.run(server.serve(args.listen))
+    else:
+        server.run()
@@ -149,6 +149,7 @@ cleanup_config_permissions() {
         "denied_senders.conf"
         "sender_restrictions.conf"
         "recipient_restrictions.conf"
+        "rate_limits.conf"
         "relay_clients.cidr"
     )
     
@@ -149,6 +149,11 @@ update_system_configuration() {
         log_success "Created /var/lib/postfixmanager directory"
     fi
     
+    # Keep the installed policy server in step with the web interface, which
+    # runs it to compile the rule snapshot
+    install -m 755 "$INSTALL_DIR/postfix-policy-server.py" /usr/local/bin/postfix-policy-server.py
+    log_success "Policy server updated"
+    
     # Update systemd service if needed
     local service_file="/etc/systemd/system/$SERVICE_NAME.service"
     if [[ -f "$service_file" ]]; then